@@ -0,0 +1,59 @@
+"""Compares time and peak memory of turning database rows into the DataFrame
+the Saver writes, through the row-dictionary path and the columnar path of
+the Extractor, on a synthetic sales_order-like table.
+
+Run from the root directory of the project:
+
+    PYTHONPATH=src/extraction_lambda python benchmarks/columnar_extraction.py [ROWS]
+"""  # noqa: E501
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest.mock import patch
+import pandas as pd
+from extraction.extractor import Extractor
+
+COLUMNS = ['sales_order_id', 'created_at', 'last_updated', 'design_id',
+           'staff_id', 'counterparty_id', 'units_sold', 'unit_price',
+           'currency_id', 'agreed_delivery_date', 'agreed_payment_date',
+           'agreed_delivery_location_id']
+
+
+def create_rows(row_count):
+    """Creates rows shaped like those pg8000 returns for sales_order."""
+    start = datetime(2022, 11, 3, 14, 20, 52, 186000)
+    return [[i, start + timedelta(seconds=i), start + timedelta(seconds=i),
+             i % 100, i % 20, i % 20, i % 1000, Decimal('2.43'), i % 3,
+             '2022-11-10', '2022-11-03', i % 30]
+            for i in range(row_count)]
+
+
+def measure(name, to_data_frame, rows):
+    """Times a conversion, then repeats it under tracemalloc (which slows
+    allocation down) to find its peak memory."""
+    start = time.perf_counter()
+    df = to_data_frame(rows)
+    seconds = time.perf_counter() - start
+    del df
+    tracemalloc.start()
+    df = to_data_frame(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<8} {seconds:8.2f} s {peak / 2 ** 20:10.1f} MiB peak '
+          f'{len(df)} rows')
+
+
+def main(row_count):
+    with patch.object(Extractor, 'create_connection'):
+        extractor = Extractor('USER', 'PASSWORD', 'HOST', 'PORT', 'DB')
+    rows = create_rows(row_count)
+    measure('dicts', lambda rows: pd.DataFrame.from_dict(
+        extractor.create_dicts(COLUMNS, rows)), rows)
+    measure('columnar', lambda rows: extractor.create_data_frame(
+        COLUMNS, rows), rows)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,72 @@
+"""Compares time and Parquet size of splitting the timestamps of a fact table
+into date and time columns, as strings through Python date and time objects
+and as native columns with Transformer.split_timestamp, on a synthetic
+sales_order-like frame.
+
+Run from the root directory of the project:
+
+    PYTHONPATH=src:src/transform_lambda python benchmarks/fact_timestamps.py [ROWS]
+"""  # noqa: E501
+import os
+import sys
+import tempfile
+import time
+import pandas as pd
+from shared.parquet import get_parquet_kwargs, write_parquet
+from transform import Transformer
+
+
+def create_data_frame(row_count):
+    """Creates a frame shaped like sales_order read from the CSV file."""
+    timestamps = pd.Series(pd.date_range(
+        '2022-11-03 14:20:52.186', periods=row_count, freq='1373ms'))
+    text = timestamps.dt.strftime('%Y-%m-%d %H:%M:%S.%f').str[:-3]
+    return pd.DataFrame({'sales_order_id': range(1, row_count + 1),
+                         'created_at': text, 'last_updated': text})
+
+
+def split_as_strings(df):
+    result = pd.DataFrame()
+    result['created_date'] = pd.to_datetime(
+        df['created_at']).dt.date.astype(str)
+    result['created_time'] = pd.to_datetime(
+        df['created_at']).dt.time.astype(str)
+    result['last_updated_date'] = pd.to_datetime(
+        df['last_updated']).dt.date.astype(str)
+    result['last_updated_time'] = pd.to_datetime(
+        df['last_updated']).dt.time.astype(str)
+    return result
+
+
+def split_natively(df):
+    result = pd.DataFrame()
+    result['created_date'], result['created_time'] = \
+        Transformer.split_timestamp(df['created_at'])
+    result['last_updated_date'], result['last_updated_time'] = \
+        Transformer.split_timestamp(df['last_updated'])
+    return result
+
+
+def measure(name, split, df, date_columns=()):
+    """Times the split and writes its result as the transform stores it,
+    with 'date_columns' as Parquet dates."""
+    start = time.perf_counter()
+    result = split(df)
+    seconds = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as directory:
+        write_parquet(result, f'{directory}/{name}.parq',
+                      date_columns=date_columns, **get_parquet_kwargs())
+        size = os.path.getsize(f'{directory}/{name}.parq')
+    print(f'{name:<8} {seconds:8.2f} s {size / 2 ** 20:10.1f} MiB '
+          f'Parquet {len(result)} rows')
+
+
+def main(row_count):
+    df = create_data_frame(row_count)
+    measure('strings', split_as_strings, df)
+    measure('native', split_natively, df,
+            date_columns=Transformer.SPLIT_DATE_COLUMNS)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
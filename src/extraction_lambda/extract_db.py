@@ -1,12 +1,17 @@
 import os
 import logging
 import json
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+from queue import LifoQueue
 from extraction.extractor import Extractor
 from extraction.saver import Saver
 from extraction.storer import Storer
 from secret_manager.retrieve_entry import retrieve_entry
 from extraction.monitor import Monitor
+from shared.resource_cache import resource_cache
+from shared.secrets_cache import is_auth_error
+from shared.invoker import LambdaInvoker
+from shared.uploader import Uploader
 
 """ The logging level is set to INFO, which means that only messages of
     level INFO will be logged.
@@ -19,13 +24,19 @@ VALID_TABLES = ['address', 'design', 'counterparty',
                 'payment', 'transaction', 'payment_type',
                 'currency', 'department']
 
+EXTRACT_OPTIONS = {'incremental': False, 'batch_size': 0,
+                   'copy_tables': [], 'concurrency': 1, 'columnar': False,
+                   'file_format': 'csv', 'in_memory': False}
+
 extractor = None
 saver = None
 storer = None
+monitor = None
+db_info = None
 
 
 def extract_db_handler(event, context):
-    global extractor, saver, storer
+    global extractor, saver, storer, monitor, db_info
     try:
         tables_to_extract = []
         if event is None or event == {} or 'extract_table' not in event:
@@ -35,31 +46,77 @@ def extract_db_handler(event, context):
         if type(tables_to_extract) is not list:
             raise (Exception("Event payload requires list "
                              f"in 'extract_table' but got {event} instead"))
+        options = get_extract_options(event)
         db_secret_json = load_env_var('OI_TOTESYS_DB_INFO',
                                       ['host', 'port', 'user',
                                        'password', 'database'], True)
         storer_info_json = load_env_var('OI_STORER_INFO', ['s3_bucket_name'])
         transform_lambda_info_json = load_env_var('OI_TRANSFORM_LAMBDA_INFO',
                                                   ['transform_lambda_arn'])
-        extractor = Extractor(**db_secret_json)
+        try:
+            extractor = get_extractor(db_secret_json)
+        except Exception as e:
+            if not is_auth_error(e):
+                raise e
+            logger.info('Database authentication failed, '
+                        'refreshing credentials...')
+            db_secret_json = load_env_var('OI_TOTESYS_DB_INFO',
+                                          ['host', 'port', 'user',
+                                           'password', 'database'], True,
+                                          force_refresh=True)
+            extractor = get_extractor(db_secret_json)
+        db_info = db_secret_json
+        extractor.columnar = options['columnar']
         saver = Saver()
-        storer = Storer(**storer_info_json)
-        monitor = Monitor(storer_info_json["s3_bucket_name"], extractor)
+        uploader = resource_cache.get(
+            'uploader', Uploader.from_env,
+            config=os.environ.get('OI_UPLOADER_INFO'))
+        storer = Storer(**storer_info_json, uploader=uploader)
+        monitor = Monitor(storer_info_json["s3_bucket_name"], extractor,
+                          s3_client=uploader.s3_client)
         logger.info('Checking state of db...')
-        if monitor.has_state_changed():
-            extract_db_helper(tables_to_extract)
+        changed_tables = monitor.get_changed_tables(tables_to_extract)
+        if changed_tables:
+            extract_db_helper(changed_tables, options)
+            monitor.save_state(changed_tables)
             call_transform_lambda(
                 transform_lambda_info_json['transform_lambda_arn'],
-                event, context)
+                event, context,
+                LambdaInvoker.from_lambda_info(transform_lambda_info_json))
     except Exception as e:
         logger.error(f'An error occurred extracting the data: {e}')
+        resource_cache.discard('extractor')
         raise e
-    finally:
-        if 'extractor' in globals() and extractor is not None:
-            extractor.close()
 
 
-def extract_db_helper(tables_to_extract):
+def get_extractor(db_secret_json):
+    """ Returns the extractor connected with the given credentials, kept
+        alive across warm invocations
+    """
+    return resource_cache.get(
+        'extractor', lambda: Extractor(**db_secret_json),
+        validate=Extractor.ping, close=Extractor.close,
+        config=db_secret_json)
+
+
+def get_extract_options(event):
+    """ Returns the extraction options given in the event payload,
+        falling back to EXTRACT_OPTIONS for any option not given
+    """
+    options = dict(EXTRACT_OPTIONS)
+    for option, default in EXTRACT_OPTIONS.items():
+        if event is not None and option in event:
+            if type(event[option]) is not type(default):
+                raise Exception(f"Event payload requires {type(default)} in "
+                                f"'{option}' but got {event} instead")
+            options[option] = event[option]
+    if options['file_format'] == 'parquet' and options['batch_size'] > 0:
+        raise Exception("Event payload option 'batch_size' cannot be used "
+                        "with 'file_format' parquet")
+    return options
+
+
+def extract_db_helper(tables_to_extract, options=EXTRACT_OPTIONS):
     """ AWS Lambda to extract tables from Totesys DB
 
         Relies on environmental variable 'OI_TOTESYS_DB_INFO'
@@ -80,44 +137,265 @@ def extract_db_helper(tables_to_extract):
         - s3_bucket_name=<Name of the S3 bucket to store extracted files'
 
         or as JSON: {"s3_bucket_name":"BUCKET_NAME"}
+
+        If option 'incremental' is set, only rows updated since the last
+        extraction of a table (its watermark, saved by the monitor) are
+        extracted and stored as a delta object 'delta/<table>/<watermark>',
+        named after the watermark the delta starts from, which the
+        Transformer merges into the table. Tables without a watermark are
+        extracted in full as before.
     """  # noqa: E501
     for table in tables_to_extract:
-        if table in VALID_TABLES:
-            extract_fn = getattr(extractor, f'extract_{table}')
-            data = extract_fn()
-            file_name = f'/tmp/{table}.csv'
-            if not saver.save_data(data, file_name):
-                raise Exception(f"Could not save table '{table}' data")
-            logger.info(
-                f'Data from table {table} saved to file {file_name}')
-            if not storer.store_file(file_name, table):
-                raise Exception(
-                    f"""Could not store data file
-                        '{file_name}' of table '{table}'""")
-            logger.info(f'Data from table {table} stored on S3')
-        else:
+        if table not in VALID_TABLES:
             raise Exception(f"Unsupported table '{table}' to extract")
+    watermarks = monitor.get_watermarks() if options['incremental'] else {}
+    try:
+        if options['concurrency'] > 1:
+            extract_tables_concurrently(tables_to_extract, watermarks,
+                                        options)
+        else:
+            for table in tables_to_extract:
+                watermark = extract_table_to_s3(
+                    extractor, table, watermarks.get(table), options)
+                if options['incremental'] and watermark is not None:
+                    watermarks[table] = watermark
+    finally:
+        if options['incremental']:
+            monitor.save_watermarks(watermarks)
+
+
+def extract_tables_concurrently(tables_to_extract, watermarks, options):
+    """ Extracts tables in parallel using up to 'concurrency' workers, each
+        with its own database connection, so that queries and uploads of
+        different tables overlap.
+
+        Watermarks of successfully extracted tables are updated. If any
+        table fails, an exception listing the failed tables in the order
+        they were given is raised once all tables have been attempted.
+    """
+    concurrency = min(options['concurrency'], len(tables_to_extract))
+    pool = LifoQueue()
+    pool.put(extractor)
+    for _ in range(concurrency - 1):
+        pool.put(None)
+    created_extractors = []
+
+    def extract_with_pool(table):
+        table_extractor = pool.get()
+        try:
+            if table_extractor is None:
+                table_extractor = Extractor(**db_info)
+                table_extractor.columnar = options['columnar']
+                created_extractors.append(table_extractor)
+            return extract_table_to_s3(table_extractor, table,
+                                       watermarks.get(table), options)
+        finally:
+            pool.put(table_extractor)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {table: executor.submit(extract_with_pool, table)
+                       for table in tables_to_extract}
+    finally:
+        for created_extractor in created_extractors:
+            created_extractor.close()
+    failures = []
+    for table, future in futures.items():
+        if future.exception() is not None:
+            failures.append(f'{table} ({future.exception()})')
+        elif options['incremental'] and future.result() is not None:
+            watermarks[table] = future.result()
+    if failures:
+        raise Exception(f"Could not extract tables: {', '.join(failures)}")
+
+
+def extract_table_to_s3(extractor, table, since, options):
+    """ Extracts the rows of a table updated after 'since' (or all rows if
+        'since' is None), saves them to a file and stores it on S3.
+
+        If option 'batch_size' is set, rows are streamed from the database
+        and appended to the file in batches of that size. Tables listed in
+        option 'copy_tables' are written straight to the file with COPY.
+
+        Option 'file_format' selects 'csv', 'csv.gz' or 'parquet' files;
+        COPY always writes CSV.
+
+        If option 'in_memory' is set, the data is serialised in memory and
+        uploaded to S3 directly instead of going through a file in /tmp.
+
+        Returns the watermark of the extracted rows.
+    """
+    key = (table if since is None
+           else f'delta/{table}/{since:%Y%m%d%H%M%S%f}')
+    if options['in_memory']:
+        if table in options['copy_tables']:
+            watermark, row_count = copy_table_to_s3(
+                extractor, table, since, key, options)
+        else:
+            watermark, row_count = save_table_to_s3(
+                extractor, table, since, key, options)
+        file_name = None
+    elif table in options['copy_tables']:
+        file_name = f'/tmp/{table}.csv'
+        watermark, row_count = copy_table_to_file(
+            extractor, table, since, file_name, options)
+    else:
+        file_name = f"/tmp/{table}.{options['file_format']}"
+        watermark, row_count = save_table_to_file(
+            extractor, table, since, file_name, options)
+    if row_count == 0:
+        if since is not None:
+            logger.info(f'No new data in table {table}')
+            return watermark
+        raise Exception(f"Could not save table '{table}' data")
+    if file_name is not None:
+        logger.info(
+            f'Data from table {table} saved to file {file_name}')
+        if not storer.store_file(file_name, key):
+            raise Exception(
+                f"""Could not store data file
+                    '{file_name}' of table '{table}'""")
+    logger.info(f'Data from table {table} stored on S3 as {key}')
+    # the deltas extracted before this full extraction are older than it,
+    # and would otherwise be merged over its rows
+    if since is None and not storer.delete_prefix(f'delta/{table}/'):
+        raise Exception(f"Could not delete deltas of table '{table}'")
+    return watermark
+
+
+def extract_batches(extractor, table, since, options):
+    """ Yields the non-empty batches of rows of a table, streamed from the
+        database if option 'batch_size' is set.
+    """
+    if options['batch_size'] > 0:
+        batches = extractor.stream_table(table, options['batch_size'], since)
+    else:
+        batches = [getattr(extractor, f'extract_{table}')(since=since)]
+    for batch in batches:
+        if len(batch) > 0:
+            yield batch
+
+
+def get_batch_watermark(extractor, watermark, batch, options):
+    """ Returns the later of 'watermark' and the watermark of the batch
+        if option 'incremental' is set, otherwise 'watermark'.
+    """
+    if options['incremental']:
+        batch_watermark = extractor.get_watermark(batch)
+        if watermark is None or batch_watermark > watermark:
+            return batch_watermark
+    return watermark
+
+
+def save_table_to_file(extractor, table, since, file_name, options):
+    """ Extracts rows of a table and saves them to a file with the saver.
+
+        Returns the watermark of the saved rows and their number.
+    """
+    schema = (extractor.extract_schema(table)
+              if options['file_format'] == 'parquet' else None)
+    watermark = since
+    row_count = 0
+    for batch in extract_batches(extractor, table, since, options):
+        if not saver.save_data(batch, file_name, append=row_count > 0,
+                               file_format=options['file_format'],
+                               schema=schema):
+            raise Exception(f"Could not save table '{table}' data")
+        row_count += len(batch)
+        watermark = get_batch_watermark(extractor, watermark, batch, options)
+    return watermark, row_count
+
+
+def save_table_to_s3(extractor, table, since, key, options):
+    """ Extracts rows of a table and uploads them to S3 as they are
+        serialised by the saver, holding at most one upload part in memory.
+
+        Returns the watermark of the stored rows and their number.
+    """
+    schema = (extractor.extract_schema(table)
+              if options['file_format'] == 'parquet' else None)
+    progress = {'watermark': since, 'row_count': 0}
+
+    def serialise_batches():
+        for batch in extract_batches(extractor, table, since, options):
+            chunk = saver.to_bytes(batch, options['file_format'],
+                                   header=progress['row_count'] == 0,
+                                   schema=schema)
+            if chunk is None:
+                raise Exception(f"Could not save table '{table}' data")
+            yield chunk
+            progress['row_count'] += len(batch)
+            progress['watermark'] = get_batch_watermark(
+                extractor, progress['watermark'], batch, options)
+
+    if not storer.store_chunks(serialise_batches(), key):
+        raise Exception(f"Could not store data of table '{table}'")
+    return progress['watermark'], progress['row_count']
+
+
+def copy_table_to_file(extractor, table, since, file_name, options):
+    """ Writes rows of a table to a CSV file with COPY, bypassing the saver.
+
+        Returns the watermark of the written rows and their number.
+    """
+    with open(file_name, 'wb') as f:
+        return copy_table_to_stream(extractor, table, since, f, options)
+
+
+def copy_table_to_s3(extractor, table, since, key, options):
+    """ Writes rows of a table as CSV with COPY straight to an upload to
+        S3, bypassing the saver and the filesystem and holding at most one
+        upload part in memory.
+
+        Returns the watermark of the stored rows and their number.
+    """
+    progress = {'watermark': since, 'row_count': 0}
+
+    def copy_to_stream(stream):
+        progress['watermark'], progress['row_count'] = copy_table_to_stream(
+            extractor, table, since, stream, options)
+        return progress['row_count'] > 0
+
+    if not storer.store_stream(copy_to_stream, key):
+        raise Exception(f"Could not store data of table '{table}'")
+    return progress['watermark'], progress['row_count']
+
+
+def copy_table_to_stream(extractor, table, since, stream, options):
+    """ Writes rows of a table as CSV to a binary stream with COPY.
+
+        Returns the watermark of the written rows and their number.
+    """
+    watermark = None
+    if options['incremental']:
+        watermark = extractor.extract_latest_update(table)
+        if watermark is None or (since is not None and watermark <= since):
+            return since, 0
+    row_count = extractor.copy_table(table, stream, since, watermark)
+    return watermark, row_count
 
 
-def call_transform_lambda(fnArn, event, context):
-    client = boto3.client('lambda')
+def call_transform_lambda(fnArn, event, context, invoker=None):
+    """ Invokes the transform lambda, synchronously unless the invoker is
+        asynchronous. The payload is empty, as the transform finds the
+        changed tables from the ETags of the extracted files
+    """
+    if invoker is None:
+        invoker = LambdaInvoker()
     inputParams = {}
-    response = client.invoke(
-        FunctionName=fnArn,
-        InvocationType='RequestResponse',
-        Payload=json.dumps(inputParams)
-    )
     logger.info('Invoking transform lambda...')
-    res = json.load(response['Payload'])
-    logger.info(f'Tranform lambda responded with {res}')
+    res = invoker.invoke(fnArn, inputParams)
+    if res is not None:
+        logger.info(f'Tranform lambda responded with {res}')
 
 
-def load_env_var(env_key, expected_json_keys, is_secret=False):
+def load_env_var(env_key, expected_json_keys, is_secret=False,
+                 force_refresh=False):
     try:
         if env_key in os.environ:
             env_string = os.environ[env_key]
         elif is_secret:
-            env_string = retrieve_entry(env_key)
+            env_string = retrieve_entry(env_key, force_refresh)
         env_json = json.loads(env_string)
         for key in expected_json_keys:
             if key not in env_json:
@@ -1,4 +1,6 @@
 import pg8000.native
+from pg8000.native import identifier, literal
+import pandas as pd
 
 
 class Extractor:
@@ -7,8 +9,52 @@ class Extractor:
 
     conn = None
 
+    TABLE_QUERIES = {
+        'address': """SELECT address_id,address_line_1,address_line_2,
+              district, city, postal_code, country, phone, created_at,
+              last_updated FROM address""",
+        'counterparty': """SELECT counterparty_id, counterparty_legal_name,
+            legal_address_id, commercial_contact, delivery_contact, created_at,
+            last_updated FROM Counterparty""",
+        'design': """SELECT design_id, created_at, last_updated,
+            design_name, file_location, file_name FROM design""",
+        'sales_order': """SELECT sales_order_id, created_at, last_updated,
+            design_id, staff_id, counterparty_id, units_sold, unit_price,
+            currency_id, agreed_delivery_date, agreed_payment_date,
+            agreed_delivery_location_id FROM sales_order""",
+        'transaction': """SELECT transaction_id, transaction_type,
+            sales_order_id, purchase_order_id, created_at, last_updated
+            FROM transaction""",
+        'payment_type': """SELECT payment_type_id, payment_type_name,
+            created_at, last_updated FROM payment_type""",
+        'payment': """SELECT payment_id, created_at, last_updated,
+            transaction_id, counterparty_id, payment_amount, currency_id,
+            payment_type_id, paid, payment_date, company_ac_number,
+            counterparty_ac_number FROM payment""",
+        'currency': """SELECT currency_id, currency_code,
+            created_at,last_updated FROM currency""",
+        'staff': """SELECT staff_id, first_name, last_name,
+            department_id, email_address, created_at, last_updated
+            FROM staff""",
+        'department': """SELECT department_id, department_name, location,
+            manager, created_at, last_updated FROM department""",
+        'purchase_order': """SELECT purchase_order_id, created_at,
+            last_updated, staff_id, counterparty_id, item_code, item_quantity,
+            item_unit_price, currency_id, agreed_delivery_date,
+            agreed_payment_date, agreed_delivery_location_id
+            From purchase_order"""}
+
+    COPY_QUERIES = {
+        'payment': """SELECT payment_id, created_at, last_updated,
+            transaction_id, counterparty_id, payment_amount, currency_id,
+            payment_type_id,
+            CASE WHEN paid THEN 'True' WHEN NOT paid THEN 'False' END AS paid,
+            payment_date, company_ac_number, counterparty_ac_number
+            FROM payment"""}
+
     def __init__(self, user, password, host, port, database):
         self.database = database
+        self.columnar = False
         self.create_connection(user, password, host, port, database)
 
     def create_connection(self, user, password, host, port, database):
@@ -19,6 +65,11 @@ class Extractor:
 
     """ Convert Extractor to Context Manager using __enter__ and __exit__"""
 
+    def ping(self):
+        """ Checks the database connection is still usable, raising an
+            exception if it is not"""
+        self.conn.run('SELECT 1')
+
     def close(self):
         """ Closes the database connection"""
         if self.conn:
@@ -34,127 +85,177 @@ class Extractor:
                 for row in rows
                 ]
 
-    def extract_address(self):
+    def create_data_frame(self, columns, rows):
+        """This method returns a DataFrame built straight from the rows,
+              without creating a dictionary for each row."""
+
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    def create_rows(self, columns, rows):
+        """This method returns the rows as a DataFrame if the extractor
+              is columnar, otherwise as a list of dictionaries."""
+
+        if self.columnar:
+            return self.create_data_frame(columns, rows)
+        return self.create_dicts(columns, rows)
+
+    def extract_table(self, table, since=None):
+        """This method returns a list of dictionaries, where each
+            dictionary represents a record of the given table, or a
+            DataFrame if the extractor is columnar.
+
+            If 'since' is given, only records with a 'last_updated'
+            later than 'since' are returned."""
+
+        query_string = Extractor.TABLE_QUERIES[table]
+        if since is None:
+            rows = self.conn.run(query_string)
+        else:
+            rows = self.conn.run(
+                f'{query_string} WHERE last_updated > :since', since=since)
+        columns = [meta["name"]for meta in self.conn.columns]
+        return self.create_rows(columns, rows)
+
+    def stream_table(self, table, batch_size, since=None):
+        """This method yields lists of at most 'batch_size' dictionaries,
+            where each dictionary represents a record of the given table.
+
+            Rows are fetched through a server-side cursor, so only one
+            batch is held in memory at a time."""
+
+        query_string = Extractor.TABLE_QUERIES[table]
+        if since is not None:
+            query_string += f' WHERE last_updated > {literal(since)}'
+        cursor = identifier(f'{table}_cursor')
+        self.conn.run('START TRANSACTION')
+        try:
+            self.conn.run(
+                f'DECLARE {cursor} NO SCROLL CURSOR FOR {query_string}')
+            while True:
+                rows = self.conn.run(
+                    f'FETCH FORWARD {int(batch_size)} FROM {cursor}')
+                if not rows:
+                    break
+                columns = [meta["name"]for meta in self.conn.columns]
+                yield self.create_rows(columns, rows)
+        finally:
+            self.conn.run('ROLLBACK')
+
+    def copy_table(self, table, stream, since=None, until=None):
+        """This method writes the records of the given table as CSV with a
+            header row to the binary 'stream' using COPY ... TO STDOUT,
+            without creating Python objects for the rows.
+
+            Records can be limited to a 'last_updated' later than 'since'
+            and no later than 'until'. Returns the number of records."""
+
+        query_string = Extractor.COPY_QUERIES.get(
+            table, Extractor.TABLE_QUERIES[table])
+        conditions = []
+        if since is not None:
+            conditions.append(f'last_updated > {literal(since)}')
+        if until is not None:
+            conditions.append(f'last_updated <= {literal(until)}')
+        if conditions:
+            query_string += f' WHERE {" AND ".join(conditions)}'
+        self.conn.run(
+            f'COPY ({query_string}) TO STDOUT WITH (FORMAT CSV, HEADER)',
+            stream=stream)
+        return self.conn.row_count
+
+    def extract_schema(self, table):
+        """This method returns a dictionary mapping each column of the
+            given table to its Postgres data type."""
+
+        rows = self.conn.run(
+            """SELECT column_name, data_type FROM information_schema.columns
+            WHERE table_name = :table""", table=table)
+        return {column: data_type for column, data_type in rows}
+
+    def extract_latest_update(self, table):
+        """This method returns the latest 'last_updated' value
+            of the given table, or None if it is empty."""
+
+        rows = self.conn.run(
+            f'SELECT max(last_updated) FROM {identifier(table)}')
+        return rows[0][0]
+
+    def get_watermark(self, data):
+        """This method returns the latest 'last_updated' value
+            of the given records, or None if there are none."""
+
+        if isinstance(data, pd.DataFrame):
+            if data.empty:
+                return None
+            return data['last_updated'].max().to_pydatetime()
+        return max((row['last_updated'] for row in data), default=None)
+
+    def extract_address(self, since=None):
         """This method returns a list of dictionaries,
             where each dictionary represents an address record."""
 
-        query_string = """SELECT address_id,address_line_1,address_line_2,
-              district, city, postal_code, country, phone, created_at,
-              last_updated FROM address"""
-        rows = self.conn.run(query_string)
-        columns = [meta["name"]for meta in self.conn.columns]
-        return self.create_dicts(columns, rows)
+        return self.extract_table('address', since)
 
-    def extract_counterparty(self):
+    def extract_counterparty(self, since=None):
         """This method returns a list of dictionaries,
         where each dictionary represents a counter party record."""
 
-        query_string = """SELECT counterparty_id, counterparty_legal_name,
-            legal_address_id, commercial_contact, delivery_contact, created_at,
-            last_updated FROM Counterparty"""
-        rows = self.conn.run(query_string)
-        columns = [meta["name"]for meta in self.conn.columns]
-        return self.create_dicts(columns, rows)
+        return self.extract_table('counterparty', since)
 
-    def extract_design(self):
+    def extract_design(self, since=None):
         """This method returns a list of dictionaries,
             where each dictionary represents a design record."""
 
-        query_string = """SELECT design_id, created_at, last_updated,
-            design_name, file_location, file_name FROM design"""
-        rows = self.conn.run(query_string)
-        columns = [meta["name"]for meta in self.conn.columns]
-        return self.create_dicts(columns, rows)
+        return self.extract_table('design', since)
 
-    def extract_sales_order(self,):
+    def extract_sales_order(self, since=None):
         """This method returns a list of dictionaries,
             where each dictionary represents a sales order record."""
 
-        query_string = """SELECT sales_order_id, created_at, last_updated,
-            design_id, staff_id, counterparty_id, units_sold, unit_price,
-            currency_id, agreed_delivery_date, agreed_payment_date,
-            agreed_delivery_location_id FROM sales_order"""
-        rows = self.conn.run(query_string)
-        columns = [meta["name"]for meta in self.conn.columns]
-        return self.create_dicts(columns, rows)
+        return self.extract_table('sales_order', since)
 
-    def extract_transaction(self):
+    def extract_transaction(self, since=None):
         """This method returns a list of dictionaries,
             where each dictionary represents a transaction record."""
 
-        query_string = """SELECT transaction_id, transaction_type,
-            sales_order_id, purchase_order_id, created_at, last_updated
-            FROM transaction"""
-        rows = self.conn.run(query_string)
-        columns = [meta["name"]for meta in self.conn.columns]
-        return self.create_dicts(columns, rows)
+        return self.extract_table('transaction', since)
 
-    def extract_payment_type(self):
+    def extract_payment_type(self, since=None):
         """This method returns a list of dictionaries,
             where each dictionary represents a payment type record."""
 
-        query_string = """SELECT payment_type_id, payment_type_name,
-            created_at, last_updated FROM payment_type"""
-        rows = self.conn.run(query_string)
-        columns = [meta["name"]for meta in self.conn.columns]
-        return self.create_dicts(columns, rows)
+        return self.extract_table('payment_type', since)
 
-    def extract_payment(self):
+    def extract_payment(self, since=None):
         """This method returns a list of dictionaries,
             where each dictionary represents a payment record."""
 
-        query_string = """SELECT payment_id, created_at, last_updated,
-            transaction_id, counterparty_id, payment_amount, currency_id,
-            payment_type_id, paid, payment_date, company_ac_number,
-            counterparty_ac_number FROM payment"""
-        rows = self.conn.run(query_string)
-        columns = [meta["name"]for meta in self.conn.columns]
-        return self.create_dicts(columns, rows)
+        return self.extract_table('payment', since)
 
-    def extract_currency(self):
+    def extract_currency(self, since=None):
         """This method returns a list of dictionaries,
             where each dictionary represents a currency record."""
 
-        query_string = """SELECT currency_id, currency_code,
-            created_at,last_updated FROM currency"""
-        rows = self.conn.run(query_string)
-        columns = [meta["name"]for meta in self.conn.columns]
-        return self.create_dicts(columns, rows)
+        return self.extract_table('currency', since)
 
-    def extract_staff(self):
+    def extract_staff(self, since=None):
         """This method returns a list of dictionaries,
             where each dictionary represents a staff record."""
 
-        query_string = """SELECT staff_id, first_name, last_name,
-            department_id, email_address, created_at, last_updated
-            FROM staff"""
-        rows = self.conn.run(query_string)
-        columns = [meta["name"]for meta in self.conn.columns]
-        return self.create_dicts(columns, rows)
+        return self.extract_table('staff', since)
 
-    def extract_department(self):
+    def extract_department(self, since=None):
         """This method returns a list of dictionaries,
             where each dictionary represents a department record."""
 
-        query_string = """SELECT department_id, department_name, location,
-            manager, created_at, last_updated FROM department"""
-        rows = self.conn.run(query_string)
-        columns = [meta["name"]for meta in self.conn.columns]
-        return self.create_dicts(columns, rows)
+        return self.extract_table('department', since)
 
-    def extract_purchase_order(self):
+    def extract_purchase_order(self, since=None):
         """This method returns a list of dictionaries,
             where each dictionary represents a purchase order record."""
 
-        query_string = """SELECT purchase_order_id, created_at, last_updated,
-            staff_id, counterparty_id, item_code, item_quantity,
-            item_unit_price, currency_id, agreed_delivery_date,
-            agreed_payment_date, agreed_delivery_location_id
-            From purchase_order"""
-        rows = self.conn.run(query_string)
-        columns = [meta["name"]for meta in self.conn.columns]
-        return self.create_dicts(columns, rows)
- 
+        return self.extract_table('purchase_order', since)
+
     def extract_db_stats(self):
         """This method returns a list of dictionaries, 
         where each dictionary represents the state of db."""
@@ -164,3 +265,15 @@ class Extractor:
         rows = self.conn.run(query_string)
         columns = [meta["name"]for meta in self.conn.columns]
         return self.create_dicts(columns, rows)[0]
+
+    def extract_table_stats(self):
+        """This method returns a dictionary mapping each extracted table
+        to its counters of inserted, updated and deleted rows."""
+
+        rows = self.conn.run(
+            """SELECT relname, n_tup_ins, n_tup_upd, n_tup_del
+            FROM pg_stat_user_tables WHERE schemaname = current_schema()""")
+        return {table: {'n_tup_ins': inserted, 'n_tup_upd': updated,
+                        'n_tup_del': deleted}
+                for table, inserted, updated, deleted in rows
+                if table in Extractor.TABLE_QUERIES}
@@ -11,44 +11,58 @@ logger.setLevel(logging.INFO)
 class Monitor:
     DB_STATE_KEY = 'db_state'
 
-    STAT_KEYS = ['tup_inserted', 'tup_updated', 'tup_deleted']
+    WATERMARKS_KEY = 'db_watermarks'
 
-    def __init__(self, s3_bucket_name, extractor):
+    STAT_KEYS = ['n_tup_ins', 'n_tup_upd', 'n_tup_del']
+
+    def __init__(self, s3_bucket_name, extractor, s3_client=None):
         self.s3_bucket_name = s3_bucket_name
-        self.s3_client = boto3.client('s3')
+        self.s3_client = (s3_client if s3_client is not None
+                          else boto3.client('s3'))
         self.current_state = None  # this is the state of the s3 bucket
         self.new_state = None
         self.extractor = extractor
 
-    def has_state_changed(self):
+    def get_changed_tables(self, tables):
+        """Returns the given tables whose insert, update or delete counters
+        have changed since the saved state, in the order given. All tables
+        are returned if there is no saved state or a table has no
+        counters."""
         self.get_db_stats()
         res = self.get_current_state()
-        if res == 1:
-            for tup_key in Monitor.STAT_KEYS:
-                if self.current_state[tup_key] != self.new_state[tup_key]:
-                    logger.info(f"State ({tup_key}) has changed")
-                    self.save_state()
-                    return True
-            logger.info("State hasn't changed")
-            self.save_state()
-            return False
-        elif res == -1:
+        if res == -1:
             logger.info("No DB state file found")
-            self.save_state()
-            logger.info("Created new DB state file")
-            return True
-        else:
-            return False
+            return list(tables)
+        changed_tables = []
+        for table in tables:
+            new_stats = self.new_state['tables'].get(table)
+            if new_stats is None or \
+                    self.current_state['tables'].get(table) != new_stats:
+                logger.info(f"State of table ({table}) has changed")
+                changed_tables.append(table)
+        if not changed_tables:
+            logger.info("State hasn't changed")
+        return changed_tables
 
     def get_db_stats(self):
-        self.new_state = self.extractor.extract_db_stats()
+        self.new_state = {'tables': self.extractor.extract_table_stats()}
 
     def get_utc_timestamp(self):
         return datetime.now().replace(
             tzinfo=timezone.utc).timestamp()
 
-    def save_state(self):
+    def save_state(self, tables=None):
+        """Saves the new state to S3. If 'tables' is given, only the
+        counters of those tables are updated in the saved state, so that
+        changes to other tables are still detected on the next run."""
         try:
+            if tables is not None:
+                table_stats = (dict(self.current_state['tables'])
+                               if self.current_state is not None else {})
+                for table in tables:
+                    if table in self.new_state['tables']:
+                        table_stats[table] = self.new_state['tables'][table]
+                self.new_state['tables'] = table_stats
             self.new_state['retrieved_at'] = self.get_utc_timestamp()
             self.s3_client.put_object(Bucket=self.s3_bucket_name, Body=json.dumps(
                 self.new_state), Key=Monitor.DB_STATE_KEY)
@@ -62,11 +76,16 @@ class Monitor:
             db_stats = self.s3_client.get_object(Bucket=self.s3_bucket_name,
                                                  Key=Monitor.DB_STATE_KEY)
             stats = json.loads(db_stats['Body'].read())
-            for stat_key in Monitor.STAT_KEYS:
-                if not (stat_key in stats
-                        and type(stats[stat_key]) is int):
-                    raise Exception("S3 object db_state has missing/invalid"
-                                    f' JSON entry: ({stat_key})')
+            if 'tables' not in stats:
+                logger.info('db_state has no table counters')
+                return -1
+            for table, table_stats in stats['tables'].items():
+                for stat_key in Monitor.STAT_KEYS:
+                    if not (stat_key in table_stats
+                            and type(table_stats[stat_key]) is int):
+                        raise Exception(
+                            "S3 object db_state has missing/invalid"
+                            f' JSON entry: ({table}.{stat_key})')
             self.current_state = stats
             return 1
         except ClientError as e:
@@ -79,3 +98,35 @@ class Monitor:
         except Exception as e:
             logger.error(e)
             raise e
+
+    def get_watermarks(self):
+        """Returns the last extracted 'last_updated' value of each table,
+        or an empty dict if no watermarks have been saved yet."""
+        try:
+            obj = self.s3_client.get_object(Bucket=self.s3_bucket_name,
+                                            Key=Monitor.WATERMARKS_KEY)
+            watermarks = json.loads(obj['Body'].read())
+            return {table: datetime.fromisoformat(watermark)
+                    for table, watermark in watermarks.items()}
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                logger.info('db_watermarks key not found')
+                return {}
+            else:
+                logger.error(e)
+                raise e
+        except Exception as e:
+            logger.error(e)
+            raise e
+
+    def save_watermarks(self, watermarks):
+        """Saves the last extracted 'last_updated' value of each table."""
+        try:
+            self.s3_client.put_object(
+                Bucket=self.s3_bucket_name, Key=Monitor.WATERMARKS_KEY,
+                Body=json.dumps({table: watermark.isoformat()
+                                 for table, watermark in watermarks.items()}))
+            logger.info("Watermarks saved to S3")
+        except Exception as e:
+            logger.error(e)
+            raise e
@@ -1,5 +1,7 @@
+import gzip
 import pandas as pd
 import logging
+from shared.parquet import ParquetBuffer, write_parquet
 
 logger = logging.getLogger('MyLogger')
 logger.setLevel(logging.INFO)
@@ -8,21 +10,117 @@ logger.setLevel(logging.INFO)
 class Saver:
     """A class for saving data to a file."""
 
+    FILE_FORMATS = ['csv', 'csv.gz', 'parquet']
+
+    # pandas dtypes for Postgres data types, as named in information_schema.
+    # numeric values are kept as the Decimals the driver returns, so they
+    # are not rounded, and dates are written to Parquet as dates.
+    PG_DTYPES = {'smallint': 'Int64',
+                 'integer': 'Int64',
+                 'bigint': 'Int64',
+                 'numeric': 'object',
+                 'real': 'float64',
+                 'double precision': 'float64',
+                 'boolean': 'boolean',
+                 'date': 'datetime64[ns]',
+                 'timestamp without time zone': 'datetime64[ns]',
+                 'character varying': 'object',
+                 'text': 'object'}
+
     def __init__(self):
         pass
 
-    def save_data(self, data, file_name):
-        """Saves the data to a file given file name."""
-        if type(data) is not list or data in (None, []):
+    def save_data(self, data, file_name, append=False, file_format='csv',
+                  schema=None):
+        """Saves the data to a file given file name. The data is either a
+        list of records as dictionaries or a DataFrame.
+
+        The file is written as 'csv', gzip compressed 'csv.gz' or 'parquet'.
+        A schema mapping columns to their Postgres data types sets the
+        column types explicitly instead of inferring them.
+
+        If 'append' is set, the data is appended to the file without
+        repeating the header row. Parquet files cannot be appended to."""
+        if not self.is_valid_data(data):
             logger.error(f"Argument 'data' ({data}) is invalid")
             return False
         if file_name in (None, ''):
             logger.error("Argument 'file_name' ({file_name}) is invalid")
             return False
+        if file_format not in Saver.FILE_FORMATS or (
+                append and file_format == 'parquet'):
+            logger.error(f"Argument 'file_format' ({file_format}) is invalid")
+            return False
         try:
-            df = pd.DataFrame.from_dict(data, orient="columns", dtype=None)
-            df.to_csv(file_name, index=False)
+            df = self.create_data_frame(data, schema)
+            if file_format == 'parquet':
+                write_parquet(df, file_name,
+                              date_columns=self.get_date_columns(schema))
+            else:
+                df.to_csv(file_name, index=False,
+                          mode='a' if append else 'w', header=not append,
+                          compression='gzip' if file_format == 'csv.gz'
+                          else None)
         except Exception as e:
             logger.error(e)
             return False
         return True
+
+    def to_bytes(self, data, file_format='csv', header=True, schema=None):
+        """Returns the data serialised in the given file format, or None if
+        the arguments are invalid.
+
+        CSV without a 'header' row and gzip members can be concatenated to
+        the output of a previous call, which allows streaming uploads."""
+        if not self.is_valid_data(data):
+            logger.error(f"Argument 'data' ({data}) is invalid")
+            return None
+        if file_format not in Saver.FILE_FORMATS:
+            logger.error(f"Argument 'file_format' ({file_format}) is invalid")
+            return None
+        try:
+            df = self.create_data_frame(data, schema)
+            if file_format == 'parquet':
+                buffer = ParquetBuffer()
+                write_parquet(df, buffer,
+                              date_columns=self.get_date_columns(schema))
+                return buffer.getvalue()
+            csv = df.to_csv(index=False, header=header).encode('utf-8')
+            return gzip.compress(csv) if file_format == 'csv.gz' else csv
+        except Exception as e:
+            logger.error(e)
+            return None
+
+    def create_data_frame(self, data, schema=None):
+        """Returns the data as a DataFrame with the dtypes of the schema."""
+        if isinstance(data, pd.DataFrame):
+            df = data
+        else:
+            df = pd.DataFrame.from_dict(data, orient="columns", dtype=None)
+        if schema is not None:
+            df = df.astype(self.get_dtypes(schema))
+        return df
+
+    def is_valid_data(self, data):
+        """Checks the data is a non-empty list of records or a non-empty
+        DataFrame."""
+        if type(data) is list:
+            return data != []
+        if isinstance(data, pd.DataFrame):
+            return not data.empty
+        return False
+
+    def get_dtypes(self, schema):
+        """Returns the pandas dtypes of the columns in a schema of Postgres
+        data types, leaving out columns of unknown data types."""
+        return {column: Saver.PG_DTYPES[data_type]
+                for column, data_type in schema.items()
+                if data_type in Saver.PG_DTYPES}
+
+    def get_date_columns(self, schema):
+        """Returns the columns of a schema of Postgres data types that are
+        dates, which are written to Parquet as dates by pyarrow."""
+        if schema is None:
+            return []
+        return [column for column, data_type in schema.items()
+                if data_type == 'date']
@@ -1,6 +1,6 @@
-import boto3
 from botocore.exceptions import ClientError, ParamValidationError
 import logging
+from shared.uploader import Uploader
 
 
 logger = logging.getLogger('MyLogger')
@@ -9,9 +9,11 @@ logger.setLevel(logging.INFO)
 
 class Storer:
 
-    def __init__(self, s3_bucket_name):
+    def __init__(self, s3_bucket_name, uploader=None):
         self.s3_bucket_name = s3_bucket_name
-        self.s3_client = boto3.client('s3')
+        self.uploader = (uploader if uploader is not None
+                         else Uploader.from_env())
+        self.s3_client = self.uploader.s3_client
 
     def store_file(self, file_name, key):
         if type(file_name) is not str or file_name in (None, ''):
@@ -21,7 +23,7 @@ class Storer:
             logger.error(f"Invalid 'key' ({key})")
             return False
         try:
-            self.s3_client.upload_file(file_name, self.s3_bucket_name, key)
+            self.uploader.upload_file(file_name, self.s3_bucket_name, key)
         except ParamValidationError as e:
             logger.error(e)
             return False
@@ -32,3 +34,69 @@ class Storer:
             logger.error(e)
             return False
         return True
+
+    def store_buffer(self, buffer, key):
+        """Uploads bytes or a binary file object held in memory to S3,
+        without writing it to the filesystem first."""
+        if not isinstance(buffer, (bytes, bytearray)) and not hasattr(
+                buffer, 'read'):
+            logger.error(f"Invalid 'buffer' ({buffer})")
+            return False
+        if type(key) is not str or key in (None, ''):
+            logger.error(f"Invalid 'key' ({key})")
+            return False
+        try:
+            self.uploader.upload_buffer(buffer, self.s3_bucket_name, key)
+        except Exception as e:
+            logger.error(e)
+            return False
+        return True
+
+    def store_chunks(self, chunks, key):
+        """Uploads an iterable of bytes chunks to S3 as a single object,
+        holding only one upload part in memory at a time. Nothing is
+        uploaded if there are no chunks."""
+        if type(key) is not str or key in (None, ''):
+            logger.error(f"Invalid 'key' ({key})")
+            return False
+        try:
+            self.uploader.upload_chunks(chunks, self.s3_bucket_name, key)
+        except Exception as e:
+            logger.error(e)
+            return False
+        return True
+
+    def store_stream(self, write, key):
+        """Uploads what 'write' writes to the binary stream it is called
+        with to S3 as a single object, holding only one upload part in
+        memory at a time. Nothing is uploaded if 'write' returns False."""
+        if type(key) is not str or key in (None, ''):
+            logger.error(f"Invalid 'key' ({key})")
+            return False
+        try:
+            self.uploader.upload_stream(write, self.s3_bucket_name, key)
+        except Exception as e:
+            logger.error(e)
+            return False
+        return True
+
+    def delete_prefix(self, prefix):
+        """Deletes every object whose key starts with 'prefix', e.g. the
+        deltas of a table once a full extraction of it is stored."""
+        if type(prefix) is not str or prefix in (None, ''):
+            logger.error(f"Invalid 'prefix' ({prefix})")
+            return False
+        try:
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.s3_bucket_name,
+                                           Prefix=prefix):
+                objects = [{'Key': item['Key']}
+                           for item in page.get('Contents', [])]
+                if objects:
+                    self.s3_client.delete_objects(
+                        Bucket=self.s3_bucket_name,
+                        Delete={'Objects': objects, 'Quiet': True})
+        except Exception as e:
+            logger.error(e)
+            return False
+        return True
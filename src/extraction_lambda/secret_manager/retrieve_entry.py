@@ -1,16 +1,15 @@
-import boto3
 import logging
+from shared.secrets_cache import secrets_cache
 
 logger = logging.getLogger('MyLogger')
 logger.setLevel(logging.INFO)
 
 
-def retrieve_entry(secret_id):
-    client = boto3.client('secretsmanager')
+def retrieve_entry(secret_id, force_refresh=False):
+    """Returns the secret string of 'secret_id', cached for warm
+    invocations unless 'force_refresh' is set."""
     try:
-        response = client.get_secret_value(
-            SecretId=secret_id)
-        secret = response.get('SecretString')
+        secret = secrets_cache.get(secret_id, force_refresh)
     except Exception as e:
         logger.error(f'An error occurred because: {e}')
         raise e
@@ -3,14 +3,25 @@ import boto3
 import logging
 import os
 import json
+import re
+from datetime import date, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from io import BytesIO
 from sqlalchemy import URL
 from sqlalchemy import create_engine, text
+from shared.resource_cache import resource_cache
+from shared.secrets_cache import is_auth_error, secrets_cache
 
 
 logger = logging.getLogger('MyLogger')
 logger.setLevel(logging.INFO)
 
+LOAD_OPTIONS = {'to_sql_tables': [], 'chunk_size': 10000,
+                'load_mode': 'replace', 'concurrency': 1,
+                'changed_tables': [], 'manifest': {}}
+
+LOAD_MODES = ['replace', 'upsert', 'swap']
+
 
 def loader_handler(event, context):
     dw_secret_json = load_env_var('OI_TOTESYS_DW_INFO',
@@ -18,27 +29,138 @@ def loader_handler(event, context):
                                    'password', 'database'], True)
     s3_processed_bucket_name = load_env_var(
         'OI_PROCESSED_INFO', ['s3_bucket_name'])['s3_bucket_name']
-    loader = Loader(s3_processed_bucket_name)
-    loader.connect_db(**dw_secret_json)
-    # Delete in reverse order, starting with fact tables, to comply
-    # With integrity constraints
-    for table in list(Loader.FILE_LIST.values())[::-1]:
-        loader.delete_table(table)
-    # Load all dim tables, then fact table (ordered last)
-    for key, table_name in loader.FILE_LIST.items():
-        loader.load_table(key, table_name)
-
-
-def load_env_var(env_key, expected_json_keys, is_secret=False):
+    options = get_load_options(event)
+    # The S3 client is kept for warm invocations, like the engine
+    s3_client = resource_cache.get('s3_client', lambda: boto3.client('s3'))
+    loader = Loader(s3_processed_bucket_name,
+                    to_sql_tables=options['to_sql_tables'],
+                    chunk_size=options['chunk_size'],
+                    load_mode=options['load_mode'],
+                    changed_tables=options['changed_tables'],
+                    s3_client=s3_client)
+    try:
+        load_tables(loader, dw_secret_json, options['concurrency'])
+    except Exception as e:
+        resource_cache.discard('engine')
+        if not is_auth_error(e):
+            raise e
+        logger.info('Data warehouse authentication failed, '
+                    'refreshing credentials...')
+        dw_secret_json = load_env_var('OI_TOTESYS_DW_INFO',
+                                      ['host', 'port', 'user',
+                                       'password', 'database'], True,
+                                      force_refresh=True)
+        try:
+            load_tables(loader, dw_secret_json, options['concurrency'])
+        except Exception as e:
+            resource_cache.discard('engine')
+            raise e
+    # Recorded only once the tables are loaded, so that the transform
+    # lambda hands tables that failed to load to the loader again
+    if options['manifest']:
+        loader.write_manifest(options['manifest'])
+
+
+def get_load_options(event):
+    """ Returns the load options given in the event payload,
+        falling back to LOAD_OPTIONS for any option not given
+    """
+    options = dict(LOAD_OPTIONS)
+    for option, default in LOAD_OPTIONS.items():
+        if event is not None and option in event:
+            if type(event[option]) is not type(default):
+                raise Exception(f"Event payload requires {type(default)} in "
+                                f"'{option}' but got {event} instead")
+            options[option] = event[option]
+    for option in ['chunk_size', 'concurrency']:
+        if options[option] < 1:
+            raise Exception(
+                f"Event payload option '{option}' must be positive")
+    if options['load_mode'] not in LOAD_MODES:
+        raise Exception(f"Event payload option 'load_mode' must be one of "
+                        f"{LOAD_MODES} but got {event} instead")
+    for key in options['changed_tables']:
+        if key not in Loader.FILE_LIST:
+            raise Exception(f"Event payload option 'changed_tables' must "
+                            f"contain keys of {list(Loader.FILE_LIST)} but "
+                            f"got {event} instead")
+    return options
+
+
+def load_tables(loader, dw_secret_json, concurrency=1):
+    # The engine and its connection pool are kept for warm invocations
+    loader.engine = resource_cache.get(
+        'engine', lambda: Loader.create_db_engine(**dw_secret_json),
+        validate=Loader.ping, close=lambda engine: engine.dispose(),
+        config=dw_secret_json)
+    if loader.load_mode == 'replace':
+        # Delete in reverse order, starting with fact tables, to comply
+        # With integrity constraints
+        for key in loader.tables[::-1]:
+            loader.delete_table(Loader.FILE_LIST[key])
+    if concurrency > 1:
+        load_tables_concurrently(loader, concurrency)
+    else:
+        # Load all dim tables, then fact table (ordered last)
+        for key in loader.tables:
+            loader.load_table(key, Loader.FILE_LIST[key])
+    if loader.load_mode == 'swap':
+        loader.swap_tables([Loader.FILE_LIST[key] for key in loader.tables])
+
+
+def load_tables_concurrently(loader, concurrency):
+    """ Loads the tables of the loader in parallel using up to
+        'concurrency' workers, each
+        with its own connection from the engine pool. A table is started
+        as soon as all the tables it depends on (Loader.DEPENDENCIES) are
+        loaded, so dimensions load side by side and each fact table
+        starts once its dimensions are done.
+
+        If any table fails, tables depending on it are not loaded and an
+        exception listing the failed tables in FILE_LIST order is raised
+        once the running tables have finished.
+    """
+    dependencies = {key: dependencies & set(loader.tables)
+                    for key, dependencies
+                    in loader.get_dependencies().items()}
+    pending = list(loader.tables)
+    loaded = set()
+    failures = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while pending or running:
+            for key in list(pending):
+                if any(dependency in failures
+                       for dependency in dependencies[key]):
+                    pending.remove(key)
+                    failures[key] = 'a table it depends on failed'
+                elif dependencies[key] <= loaded:
+                    pending.remove(key)
+                    running[executor.submit(
+                        loader.load_table, key, Loader.FILE_LIST[key])] = key
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                if future.exception() is not None:
+                    failures[key] = future.exception()
+                else:
+                    loaded.add(key)
+    if failures:
+        raise Exception('Could not load tables: ' + ', '.join(
+            f'{key} ({failures[key]})'
+            for key in loader.tables if key in failures))
+
+
+def load_env_var(env_key, expected_json_keys, is_secret=False,
+                 force_refresh=False):
     env_string = ''
     try:
         if env_key in os.environ:
             env_string = os.environ[env_key]
         elif is_secret:
-            client = boto3.client('secretsmanager')
-            response = client.get_secret_value(
-                SecretId=env_key)
-            env_string = response.get('SecretString')
+            env_string = secrets_cache.get(env_key, force_refresh)
         env_json = json.loads(env_string)
         for key in expected_json_keys:
             if key not in env_json:
@@ -63,24 +185,144 @@ class Loader:
                  'payment': 'fact_payment',
                  'sales_order': 'fact_sales_order'}
 
+    # Dimension tables (keys of FILE_LIST) each fact table references
+    DEPENDENCIES = {'purchase_order': ['staff', 'counterparty', 'currency',
+                                       'address', 'date'],
+                    'payment': ['transaction', 'counterparty', 'currency',
+                                'payment_type', 'date'],
+                    'sales_order': ['staff', 'counterparty', 'currency',
+                                    'design', 'address', 'date']}
+
+    # Object in the processed bucket recording what the transform lambda
+    # transformed the loaded files from (see Transformer.MANIFEST_KEY)
+    MANIFEST_KEY = 'manifest.json'
+
+    # Date and time columns of each table (keys of FILE_LIST), converted
+    # from the types they are stored as in Parquet by coerce_columns
+    COLUMN_TYPES = {
+        'date': {'date_id': 'date'},
+        'sales_order': {'created_date': 'date', 'created_time': 'time',
+                        'last_updated_date': 'date',
+                        'last_updated_time': 'time',
+                        'agreed_delivery_date': 'date',
+                        'agreed_payment_date': 'date'},
+        'purchase_order': {'created_date': 'date', 'created_time': 'time',
+                           'last_updated_date': 'date',
+                           'last_updated_time': 'time',
+                           'agreed_delivery_date': 'date',
+                           'agreed_payment_date': 'date'},
+        'payment': {'created_date': 'date', 'created_time': 'time',
+                    'last_updated_date': 'date', 'last_updated_time': 'time',
+                    'payment_date': 'date'}}
+
+    # Columns of each table (keys of FILE_LIST) named differently in the
+    # warehouse
+    COLUMN_RENAMES = {'payment': {'last_updated_time': 'last_updated'}}
+
+    COLUMN_PYTHON_TYPES = {'date': date, 'time': time}
+
+    # Natural key of each table that rows are upserted on
+    NATURAL_KEYS = {'dim_location': 'location_id',
+                    'dim_design': 'design_id',
+                    'dim_counterparty': 'counterparty_id',
+                    'dim_staff': 'staff_id',
+                    'dim_currency': 'currency_id',
+                    'dim_date': 'date_id',
+                    'dim_payment_type': 'payment_type_id',
+                    'dim_transaction': 'transaction_id',
+                    'fact_purchase_order': 'purchase_order_id',
+                    'fact_payment': 'payment_id',
+                    'fact_sales_order': 'sales_order_id'}
+
+    # SERIAL keys of fact tables, assigned by the warehouse on upsert
+    SURROGATE_KEYS = {'fact_purchase_order': 'purchase_record_id',
+                      'fact_payment': 'payment_record_id',
+                      'fact_sales_order': 'sales_record_id'}
+
+    # Name and table of an index definition, replaced to build the index
+    # on a shadow table with a generated name
+    INDEX_TARGET = re.compile(
+        r'^(CREATE (?:UNIQUE )?INDEX) \S+ ON (?:ONLY )?\S+ ')
+
     conn = None
     engine = None
 
-    def __init__(self, bucket_name):
-        self.s3_client = boto3.client('s3')
+    def __init__(self, bucket_name, to_sql_tables=None, chunk_size=10000,
+                 load_mode='replace', changed_tables=None, s3_client=None):
+        """ Tables are written with COPY FROM STDIN in CSV chunks of
+            'chunk_size' rows, except for the tables (keys of FILE_LIST)
+            in 'to_sql_tables' and databases other than PostgreSQL, which
+            are written with DataFrame.to_sql.
+
+            With 'load_mode' 'replace' rows are appended to tables emptied
+            beforehand, with 'upsert' they are merged into the existing
+            rows on their natural keys and with 'swap' they are loaded
+            into shadow tables that replace the tables once all are
+            loaded.
+
+            If 'changed_tables' (keys of FILE_LIST) are given, only those
+            tables and the tables depending on them are loaded, otherwise
+            all tables are.
+
+            An 's3_client' kept across invocations can be passed in,
+            otherwise one is created"""
+        self.s3_client = (s3_client if s3_client is not None
+                          else boto3.client('s3'))
         self.s3_processed_bucket_name = bucket_name
+        self.to_sql_tables = to_sql_tables if to_sql_tables else []
+        self.chunk_size = chunk_size
+        self.load_mode = load_mode
+        self.tables = self.get_tables_to_load(changed_tables)
+
+    def get_dependencies(self):
+        """ Returns the set of tables (keys of FILE_LIST) each table
+            depends on"""
+        return {key: set(Loader.DEPENDENCIES.get(key, []))
+                for key in Loader.FILE_LIST}
+
+    def get_tables_to_load(self, changed_tables=None):
+        """ Returns the changed tables (keys of FILE_LIST) and the tables
+            depending on them in FILE_LIST order, or all tables if no
+            changed tables are given. Fact tables are reloaded with their
+            dimensions as emptying or swapping a dimension affects the
+            rows referencing it"""
+        if not changed_tables:
+            return list(Loader.FILE_LIST)
+        dependencies = self.get_dependencies()
+        return [key for key in Loader.FILE_LIST
+                if key in changed_tables or
+                dependencies[key] & set(changed_tables)]
+
+    def write_manifest(self, manifest):
+        """ Stores the manifest handed over by the transform lambda in the
+            processed bucket, once the tables have been loaded"""
+        self.s3_client.put_object(
+            Bucket=self.s3_processed_bucket_name, Key=Loader.MANIFEST_KEY,
+            Body=json.dumps(manifest, indent=2).encode('utf-8'))
+
+    @staticmethod
+    def create_db_engine(user, password, host, port, database):
+        url_object = URL.create(
+            "postgresql+pg8000",
+            username=user,
+            password=password,  # plain (unescaped) text
+            host=host,
+            port=port,
+            database=database
+        )
+        return create_engine(url_object)
+
+    @staticmethod
+    def ping(engine):
+        """ Checks the engine can still reach the database, raising an
+            exception if it cannot"""
+        with engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
 
     def connect_db(self, user, password, host, port, database):
         if self.engine is None:
-            url_object = URL.create(
-                "postgresql+pg8000",
-                username=user,
-                password=password,  # plain (unescaped) text
-                host=host,
-                port=port,
-                database=database
-            )
-            self.engine = create_engine(url_object)
+            self.engine = Loader.create_db_engine(
+                user, password, host, port, database)
         if self.conn is None:
             self.conn = self.engine.connect()
 
@@ -102,58 +344,265 @@ class Loader:
         except Exception as e:
             raise e
 
-    def write_to_dw(self, table_name, df):
+    def write_to_dw(self, table_name, df, use_copy=False):
+        if use_copy and self.can_copy():
+            self.copy_to_dw(table_name, df)
+            return
         with self.engine.begin() as con:
-            df.to_sql(table_name, con, if_exists='append', index=False)
+            df.to_sql(table_name, con, if_exists='append', index=False,
+                      chunksize=self.chunk_size)
+
+    def can_copy(self):
+        """ Returns True if the engine supports COPY FROM STDIN"""
+        return self.engine.dialect.name == 'postgresql' and \
+            self.engine.dialect.driver == 'pg8000'
+
+    def upsert_to_dw(self, table_name, df):
+        """ Merges the dataframe into the table on its natural key,
+            touching only new and changed rows, and returns the number of
+            rows written.
+
+            The rows are copied into a temporary stage table first. Rows
+            of dimension tables, keyed on their primary key, are merged
+            with INSERT ... ON CONFLICT DO UPDATE. The natural keys of fact
+            tables are not unique constraints, so changed rows are updated
+            in place, keeping their surrogate key, and new rows inserted.
+            The sequence of the surrogate key is first moved past its
+            largest value, as the other load modes copy the record ids of
+            the transformer without advancing it"""
+        if not self.can_copy():
+            raise Exception('Upsert loading requires PostgreSQL with pg8000')
+        quote = self.engine.dialect.identifier_preparer.quote
+        key = Loader.NATURAL_KEYS[table_name]
+        df = df.drop(columns=Loader.SURROGATE_KEYS.get(table_name, []),
+                     errors='ignore')
+        stage = quote(f'stage_{table_name}')
+        table = quote(table_name)
+        columns = [quote(column) for column in df.columns]
+        values = [column for column in columns if column != quote(key)]
+        column_list = ', '.join(columns)
+        raw_conn = self.engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            cursor.execute(f'CREATE TEMP TABLE {stage} ON COMMIT DROP AS '
+                           f'SELECT {column_list} FROM {table} WITH NO DATA')
+            self.copy_rows(cursor, f'stage_{table_name}', df)
+            if table_name in Loader.SURROGATE_KEYS:
+                cursor.execute(
+                    f"UPDATE {table} AS t SET "
+                    f"{', '.join(f'{c} = s.{c}' for c in values)} "
+                    f"FROM {stage} AS s WHERE t.{quote(key)} = s.{quote(key)} "
+                    f"AND {Loader.is_distinct('t', 's', values)}")
+                row_count = cursor.rowcount
+                surrogate_key = Loader.SURROGATE_KEYS[table_name]
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', "
+                    f"'{surrogate_key}'), "
+                    f"COALESCE(MAX({quote(surrogate_key)}), 0) + 1, false) "
+                    f"FROM {table}")
+                cursor.execute(
+                    f"INSERT INTO {table} ({column_list}) SELECT "
+                    f"{column_list} FROM {stage} AS s WHERE NOT EXISTS "
+                    f"(SELECT 1 FROM {table} AS t "
+                    f"WHERE t.{quote(key)} = s.{quote(key)})")
+            else:
+                cursor.execute(
+                    f"INSERT INTO {table} AS t ({column_list}) SELECT "
+                    f"{column_list} FROM {stage} AS s "
+                    f"ON CONFLICT ({quote(key)}) DO UPDATE SET "
+                    f"{', '.join(f'{c} = EXCLUDED.{c}' for c in values)} "
+                    f"WHERE {Loader.is_distinct('t', 'EXCLUDED', values)}")
+                row_count = 0
+            row_count += cursor.rowcount
+            raw_conn.commit()
+        except Exception as e:
+            raw_conn.rollback()
+            raise e
+        finally:
+            raw_conn.close()
+        logger.info(f'Upserted {row_count} rows into {table_name}')
+        return row_count
+
+    @staticmethod
+    def is_distinct(left, right, columns):
+        """ Returns an SQL condition that is true if the columns of the
+            'left' and 'right' rows differ, treating NULLs as equal"""
+        return (f"({', '.join(f'{left}.{c}' for c in columns)}) IS DISTINCT "
+                f"FROM ({', '.join(f'{right}.{c}' for c in columns)})")
+
+    def copy_to_dw(self, table_name, df):
+        """ Appends the dataframe to the table with a single COPY FROM
+            STDIN, streaming it as CSV one chunk of rows at a time.
+
+            Missing values are written as \\N so that they are told apart
+            from empty strings, and whole floats without a decimal point so
+            that they can be copied into integer columns"""
+        raw_conn = self.engine.raw_connection()
+        try:
+            self.copy_rows(raw_conn.cursor(), table_name, df)
+            raw_conn.commit()
+        except Exception as e:
+            raw_conn.rollback()
+            raise e
+        finally:
+            raw_conn.close()
+
+    @staticmethod
+    def coerce_column(series, column_type):
+        """ Returns the column as Python dates or times ('date' or 'time'),
+            whether it holds them already, datetimes, times of day as
+            timedeltas or their strings"""
+        if pd.api.types.is_datetime64_any_dtype(series):
+            values = series
+        elif series.dropna().map(type).eq(
+                Loader.COLUMN_PYTHON_TYPES[column_type]).all():
+            return series
+        elif column_type == 'time':
+            values = pd.Timestamp(0) + pd.to_timedelta(series)
+        else:
+            values = pd.to_datetime(series, format='%Y-%m-%d')
+        return values.dt.date if column_type == 'date' else values.dt.time
+
+    def coerce_columns(self, key, df):
+        """ Converts the columns of the table to the types of the warehouse
+            as declared in COLUMN_TYPES and renames them as in
+            COLUMN_RENAMES"""
+        for column, column_type in Loader.COLUMN_TYPES.get(key, {}).items():
+            if column in df.columns:
+                df[column] = Loader.coerce_column(df[column], column_type)
+        return df.rename(columns=Loader.COLUMN_RENAMES.get(key, {}))
 
     def load_table(self, key, table_name):
-        df = self.read_s3_parquet(key)
-        if key == 'date':
-            df['date_id'] = pd.to_datetime(
-                df['date_id'], format='%Y-%m-%d').dt.date
-        elif key == 'sales_order':
-            df['created_date'] = pd.to_datetime(
-                df['created_date'], format='%Y-%m-%d').dt.date
-            df['created_time'] = pd.to_datetime(
-                df['created_time'], infer_datetime_format=True).dt.time
-            df['last_updated_time'] = pd.to_datetime(
-                df['last_updated_time'], infer_datetime_format=True).dt.time
-            df['last_updated_date'] = pd.to_datetime(
-                df['last_updated_date'], format='%Y-%m-%d').dt.date
-            df['agreed_delivery_date'] = pd.to_datetime(
-                df['agreed_delivery_date'], format='%Y-%m-%d').dt.date
-            df['agreed_payment_date'] = pd.to_datetime(
-                df['agreed_payment_date'], format='%Y-%m-%d').dt.date
-        elif key == 'purchase_order':
-            df['created_date'] = pd.to_datetime(
-                df['created_date'], format='%Y-%m-%d').dt.date
-            df['created_time'] = pd.to_datetime(
-                df['created_time'], infer_datetime_format=True).dt.time
-            df['last_updated_date'] = pd.to_datetime(
-                df['last_updated_date'], format='%Y-%m-%d').dt.date
-            df['last_updated_time'] = pd.to_datetime(
-                df['last_updated_time'], infer_datetime_format=True).dt.time
-            df['agreed_delivery_date'] = pd.to_datetime(
-                df['agreed_delivery_date'], format='%Y-%m-%d').dt.date
-            df['agreed_payment_date'] = pd.to_datetime(
-                df['agreed_payment_date'], format='%Y-%m-%d').dt.date
-        elif key == 'payment':
-            df['created_date'] = pd.to_datetime(
-                df['created_date'], format='%Y-%m-%d').dt.date
-            df['created_time'] = pd.to_datetime(
-                df['created_time'], infer_datetime_format=True).dt.time
-            df['last_updated_date'] = pd.to_datetime(
-                df['last_updated_date'], format='%Y-%m-%d').dt.date
-            df['last_updated_time'] = pd.to_datetime(
-                df['last_updated_time'], infer_datetime_format=True).dt.time
-            df.rename(columns={'last_updated_time': 'last_updated'},
-                      inplace=True)
-            df['payment_date'] = pd.to_datetime(
-                df['payment_date'], format='%Y-%m-%d').dt.date
+        df = self.coerce_columns(key, self.read_s3_parquet(key))
+        try:
+            if self.load_mode == 'upsert':
+                self.upsert_to_dw(table_name, df)
+            elif self.load_mode == 'swap':
+                self.load_shadow_table(table_name, df)
+            else:
+                self.write_to_dw(table_name, df,
+                                 use_copy=key not in self.to_sql_tables)
+        except Exception as e:
+            raise e
+
+    def copy_rows(self, cursor, table_name, df):
+        quote = self.engine.dialect.identifier_preparer.quote
+        columns = ', '.join(quote(column) for column in df.columns)
+        chunks = (df.iloc[start:start + self.chunk_size].to_csv(
+                      index=False, header=False, na_rep='\\N',
+                      float_format='%.15g')
+                  for start in range(0, len(df), self.chunk_size))
+        cursor.execute(f'COPY {quote(table_name)} ({columns}) FROM STDIN '
+                       "WITH (FORMAT CSV, NULL '\\N')", stream=chunks)
+
+    @staticmethod
+    def get_shadow_name(table_name):
+        return f'{table_name}__shadow'
+
+    def load_shadow_table(self, table_name, df):
+        """ Loads the dataframe into a new shadow table of the table, ready
+            to be swapped in by swap_tables.
+
+            The rows are copied into the shadow table before it is given
+            the primary key, unique constraints and indexes of the table
+            and analyzed. It is created logged: copying into an unlogged
+            table and then setting it logged would write the rows to the
+            WAL all the same, and rewrite the table on top"""
+        if not self.can_copy():
+            raise Exception('Swap loading requires PostgreSQL with pg8000')
+        quote = self.engine.dialect.identifier_preparer.quote
+        table = quote(table_name)
+        shadow = quote(Loader.get_shadow_name(table_name))
+        raw_conn = self.engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            cursor.execute(f'DROP TABLE IF EXISTS {shadow}')
+            cursor.execute(f'CREATE TABLE {shadow} (LIKE {table} '
+                           'INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+            self.copy_rows(cursor, Loader.get_shadow_name(table_name), df)
+            cursor.execute(
+                """SELECT pg_get_constraintdef(oid) FROM pg_constraint
+                WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'x')
+                ORDER BY contype""", (table_name,))
+            for (definition,) in cursor.fetchall():
+                cursor.execute(f'ALTER TABLE {shadow} ADD {definition}')
+            cursor.execute(
+                """SELECT pg_get_indexdef(indexrelid) FROM pg_index
+                WHERE indrelid = %s::regclass AND indexrelid NOT IN
+                (SELECT conindid FROM pg_constraint)""", (table_name,))
+            for (definition,) in cursor.fetchall():
+                cursor.execute(Loader.INDEX_TARGET.sub(
+                    lambda match: f'{match.group(1)} ON {shadow} ',
+                    definition, count=1))
+            cursor.execute(
+                """SELECT grantee, privilege_type
+                FROM information_schema.role_table_grants
+                WHERE table_name = %s AND grantee <> current_user""",
+                (table_name,))
+            for grantee, privilege in cursor.fetchall():
+                grantee = grantee if grantee == 'PUBLIC' else quote(grantee)
+                cursor.execute(f'GRANT {privilege} ON {shadow} TO {grantee}')
+            cursor.execute(f'ANALYZE {shadow}')
+            raw_conn.commit()
+        except Exception as e:
+            raw_conn.rollback()
+            raise e
+        finally:
+            raw_conn.close()
+        logger.info(f'Loaded shadow table of {table_name}')
+
+    def swap_tables(self, table_names):
+        """ Replaces the tables with their loaded shadow tables in a single
+            transaction, so readers see either all old or all new tables
+            and never an empty one.
+
+            Foreign keys between the tables are dropped before the swap and
+            recreated on the new tables without scanning them (NOT VALID),
+            then validated after the swap without blocking readers. SERIAL
+            sequences are handed over to the new tables"""
+        quote = self.engine.dialect.identifier_preparer.quote
+        raw_conn = self.engine.raw_connection()
         try:
-            self.write_to_dw(table_name, df)
+            cursor = raw_conn.cursor()
+            cursor.execute(
+                """SELECT conrelid::regclass::text, conname,
+                pg_get_constraintdef(oid) FROM pg_constraint
+                WHERE contype = 'f' AND conrelid = ANY(%s::regclass[])""",
+                (table_names,))
+            foreign_keys = cursor.fetchall()
+            for table_name, name, _ in foreign_keys:
+                cursor.execute(f'ALTER TABLE {quote(table_name)} '
+                               f'DROP CONSTRAINT {quote(name)}')
+            for table_name in table_names:
+                table = quote(table_name)
+                shadow_name = Loader.get_shadow_name(table_name)
+                column = Loader.SURROGATE_KEYS.get(table_name)
+                if column is not None:
+                    cursor.execute('SELECT pg_get_serial_sequence(%s, %s)',
+                                   (table_name, column))
+                    sequence = cursor.fetchone()[0]
+                    if sequence is not None:
+                        cursor.execute(
+                            f'ALTER SEQUENCE {sequence} OWNED BY '
+                            f'{quote(shadow_name)}.{quote(column)}')
+                cursor.execute(f'DROP TABLE {table}')
+                cursor.execute(f'ALTER TABLE {quote(shadow_name)} '
+                               f'RENAME TO {table}')
+            for table_name, name, definition in foreign_keys:
+                cursor.execute(f'ALTER TABLE {quote(table_name)} ADD '
+                               f'CONSTRAINT {quote(name)} {definition} '
+                               'NOT VALID')
+            raw_conn.commit()
+            for table_name, name, _ in foreign_keys:
+                cursor.execute(f'ALTER TABLE {quote(table_name)} '
+                               f'VALIDATE CONSTRAINT {quote(name)}')
+            raw_conn.commit()
         except Exception as e:
+            raw_conn.rollback()
             raise e
+        finally:
+            raw_conn.close()
+        logger.info(f'Swapped in {len(table_names)} loaded tables')
 
     def delete_table(self, table):
         with self.engine.begin() as conn:
@@ -0,0 +1,83 @@
+import json
+import logging
+import boto3
+from shared.resource_cache import resource_cache
+
+
+logger = logging.getLogger('MyLogger')
+logger.setLevel(logging.INFO)
+
+INVOCATION_TYPES = ['RequestResponse', 'Event']
+
+
+class LambdaInvoker:
+    """Invokes the next lambda of the pipeline.
+
+    With 'invocation_type' 'RequestResponse' the invoking lambda waits for
+    the invoked one to finish and gets its response. With 'Event' the
+    payload is queued by Lambda and the invoking lambda can return at
+    once, so it is not billed while the next stage runs; failed
+    invocations are then retried by Lambda rather than reported back."""
+
+    def __init__(self, invocation_type='RequestResponse', lambda_client=None):
+        if invocation_type not in INVOCATION_TYPES:
+            raise ValueError(
+                f"Invalid 'invocation_type' ({invocation_type})")
+        self.invocation_type = invocation_type
+        self.lambda_client = lambda_client
+
+    @classmethod
+    def from_lambda_info(cls, lambda_info, lambda_client=None):
+        """Returns an invoker with the optional 'invocation_type' of the
+        JSON of a lambda info environment variable, e.g.
+        {"transform_lambda_arn": "...", "invocation_type": "Event"}."""
+        return cls(lambda_info.get('invocation_type', 'RequestResponse'),
+                   lambda_client=lambda_client)
+
+    def invoke(self, function_arn, payload):
+        """Invokes the lambda with the payload and returns its response,
+        or None if it was invoked asynchronously. Raises an exception if
+        the lambda was invoked synchronously and failed.
+
+        Without a 'lambda_client', the client kept across warm
+        invocations in resource_cache is used."""
+        if self.lambda_client is None:
+            self.lambda_client = resource_cache.get(
+                'lambda_client', lambda: boto3.client('lambda'))
+        response = self.lambda_client.invoke(
+            FunctionName=function_arn,
+            InvocationType=self.invocation_type,
+            Payload=json.dumps(payload))
+        if self.invocation_type == 'Event':
+            logger.info(f'Queued invocation of {function_arn} with {payload}')
+            return None
+        result = json.load(response['Payload'])
+        if 'FunctionError' in response:
+            raise Exception(f'Invocation of {function_arn} failed: {result}')
+        return result
+
+
+class LocalInvoker:
+    """Stands in for LambdaInvoker in tests and local runs by calling the
+    handlers of the lambdas in process, e.g.
+    LocalInvoker({'ARN': transform_handler}).
+
+    The invocations are recorded in 'calls' as (function_arn, payload).
+    With 'invocation_type' 'Event' the handlers are not called, as the
+    invoking lambda would not wait for them either."""
+
+    def __init__(self, handlers=None, invocation_type='RequestResponse'):
+        if invocation_type not in INVOCATION_TYPES:
+            raise ValueError(
+                f"Invalid 'invocation_type' ({invocation_type})")
+        self.handlers = handlers if handlers is not None else {}
+        self.invocation_type = invocation_type
+        self.calls = []
+
+    def invoke(self, function_arn, payload):
+        self.calls.append((function_arn, payload))
+        if self.invocation_type == 'Event' or \
+                function_arn not in self.handlers:
+            return None
+        return self.handlers[function_arn](
+            json.loads(json.dumps(payload)), None)
@@ -0,0 +1,121 @@
+import importlib.util
+from io import BytesIO
+
+
+COMPRESSIONS = ['snappy', 'zstd', 'gzip']
+
+
+class ParquetBuffer(BytesIO):
+    """An in-memory file that stays readable after a Parquet engine closes
+    it, as fastparquet does once it has written the file."""
+
+    def close(self):
+        pass
+
+
+def get_parquet_engine():
+    """Returns the engine DataFrame.to_parquet uses by default, pyarrow if
+    it is installed (as in the Lambda layer), otherwise fastparquet."""
+    if importlib.util.find_spec('pyarrow') is not None:
+        return 'pyarrow'
+    return 'fastparquet'
+
+
+def get_parquet_kwargs(compression='snappy', row_group_size=0,
+                       use_dictionary=True, engine=None):
+    """Returns the keyword arguments of DataFrame.to_parquet for the engine
+    that write with the compression codec, at most 'row_group_size' rows
+    per row group (0 for the engine's default) and dictionary encoding.
+
+    fastparquet has no option for dictionary encoding and only uses it
+    for categorical columns, so 'use_dictionary' applies to pyarrow."""
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Invalid 'compression' ({compression})")
+    if type(row_group_size) is not int or row_group_size < 0:
+        raise ValueError(f"Invalid 'row_group_size' ({row_group_size})")
+    engine = engine if engine is not None else get_parquet_engine()
+    kwargs = {'engine': engine, 'compression': compression}
+    if engine == 'pyarrow':
+        kwargs['use_dictionary'] = use_dictionary
+        if row_group_size:
+            kwargs['row_group_size'] = row_group_size
+    elif row_group_size:
+        kwargs['row_group_offsets'] = row_group_size
+    return kwargs
+
+
+def to_arrow_table(df, date_columns=()):
+    """Returns the DataFrame as a pyarrow Table with 'date_columns' of
+    midnight datetimes as date32 and timedelta columns of times of day as
+    time64[us], Parquet's DATE and TIME types. pyarrow would otherwise
+    write them as timestamps and durations."""
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for index, field in enumerate(table.schema):
+        column = table.column(index)
+        if field.name in date_columns:
+            column = column.cast(pa.date32())
+        elif pa.types.is_duration(field.type):
+            column = column.cast(pa.duration('us'), safe=False).cast(
+                pa.int64()).cast(pa.time64('us'))
+        else:
+            continue
+        table = table.set_column(index, field.name, column)
+    return table
+
+
+def write_parquet(df, path, date_columns=(), **kwargs):
+    """Writes the DataFrame to a Parquet file or buffer with the keyword
+    arguments returned by get_parquet_kwargs.
+
+    With pyarrow, 'date_columns' and timedelta columns are written as
+    dates and times (see to_arrow_table). fastparquet writes timedeltas
+    as times itself but has no date type, so dates stay timestamps."""
+    kwargs = dict(kwargs)
+    engine = kwargs.pop('engine', None) or get_parquet_engine()
+    if engine == 'pyarrow':
+        import pyarrow.parquet as pq
+        pq.write_table(to_arrow_table(df, date_columns), path, **kwargs)
+    else:
+        df.to_parquet(path, engine=engine, **kwargs)
+
+
+class ParquetFileWriter:
+    """Writes DataFrames to a Parquet file one after the other, each as
+    one or more row groups, so a table can be written chunk by chunk
+    without holding all of it in memory.
+
+    Takes the keyword arguments returned by get_parquet_kwargs and the
+    'date_columns' of write_parquet. The first DataFrame sets the schema
+    of the file."""
+
+    def __init__(self, path, date_columns=(), **kwargs):
+        self.path = path
+        self.date_columns = date_columns
+        self.kwargs = dict(kwargs)
+        self.engine = self.kwargs.pop('engine', None) or get_parquet_engine()
+        self.writer = None
+        self.written = 0
+
+    def write(self, df):
+        if self.engine == 'pyarrow':
+            import pyarrow.parquet as pq
+            table = to_arrow_table(df, self.date_columns)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(
+                    self.path, table.schema,
+                    compression=self.kwargs.get('compression'),
+                    use_dictionary=self.kwargs.get('use_dictionary', True))
+            else:
+                table = table.cast(self.writer.schema)
+            self.writer.write_table(
+                table, row_group_size=self.kwargs.get('row_group_size'))
+        else:
+            df.to_parquet(self.path, engine='fastparquet', index=False,
+                          append=self.written > 0, **self.kwargs)
+        self.written += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
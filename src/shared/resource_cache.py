@@ -0,0 +1,83 @@
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger('MyLogger')
+logger.setLevel(logging.INFO)
+
+
+class ResourceCache:
+    """Keeps connections and clients alive across warm Lambda invocations.
+
+    A resource is created on first use and returned from the cache by
+    later invocations in the same container. A resource that has been idle
+    for more than 'max_idle_seconds' is validated before it is returned
+    (e.g. with SELECT 1) and recreated if validation fails, so idle
+    connections dropped by the server are replaced transparently. A
+    resource is also recreated if the config it was created from, such as
+    database credentials, has changed."""
+
+    def __init__(self, max_idle_seconds=60):
+        self.max_idle_seconds = max_idle_seconds
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, create, validate=None, close=None, config=None):
+        """Returns the cached resource called 'name', creating it with
+        'create()' if there is none, its 'config' differs, or it has been
+        idle too long and 'validate(resource)' fails. 'close(resource)' is
+        called on resources that are replaced."""
+        with self.lock:
+            entry = self.entries.get(name)
+            now = time.monotonic()
+            if entry is not None and entry['config'] != config:
+                logger.info(f'Config of cached resource ({name}) changed')
+                self.close_entry(name, entry)
+                entry = None
+            if entry is not None and validate is not None and \
+                    now - entry['used_at'] > self.max_idle_seconds and \
+                    not self.is_valid(name, entry['resource'], validate):
+                self.close_entry(name, entry)
+                entry = None
+            if entry is None:
+                logger.info(f'Creating resource ({name})')
+                entry = {'resource': create(), 'config': config,
+                         'close': close}
+                self.entries[name] = entry
+            else:
+                logger.info(f'Reusing cached resource ({name})')
+            entry['used_at'] = now
+            return entry['resource']
+
+    def discard(self, name):
+        """Closes and removes the resource called 'name', e.g. after an
+        error left it in an unknown state."""
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is not None:
+                self.close_entry(name, entry)
+
+    def clear(self):
+        """Closes and removes all cached resources."""
+        for name in list(self.entries):
+            self.discard(name)
+
+    def is_valid(self, name, resource, validate):
+        try:
+            validate(resource)
+            return True
+        except Exception as e:
+            logger.info(f'Cached resource ({name}) is no longer valid: {e}')
+            return False
+
+    def close_entry(self, name, entry):
+        self.entries.pop(name, None)
+        if entry['close'] is not None:
+            try:
+                entry['close'](entry['resource'])
+            except Exception as e:
+                logger.info(f'Could not close resource ({name}): {e}')
+
+
+resource_cache = ResourceCache()
@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+import boto3
+
+
+logger = logging.getLogger('MyLogger')
+logger.setLevel(logging.INFO)
+
+
+class SecretsCache:
+    """Caches secret strings from AWS Secrets Manager across warm Lambda
+    invocations.
+
+    A secret is fetched on first use and returned from the cache until it
+    is 'ttl_seconds' old. Once it is within 'refresh_seconds' of expiring,
+    the cached value is still returned while a background thread fetches
+    the latest value, so rotated secrets are picked up without a request
+    on the critical path. A refresh can be forced, e.g. when the cached
+    credentials fail to authenticate."""
+
+    def __init__(self, ttl_seconds=300, refresh_seconds=60):
+        self.ttl_seconds = ttl_seconds
+        self.refresh_seconds = refresh_seconds
+        self.entries = {}
+        self.refreshing = set()
+        self.client = None
+        self.lock = threading.Lock()
+
+    def get(self, secret_id, force_refresh=False):
+        """Returns the secret string of 'secret_id', fetching it from
+        Secrets Manager if it is not cached, has expired or
+        'force_refresh' is set."""
+        entry = self.entries.get(secret_id)
+        if entry is not None and not force_refresh:
+            age = time.monotonic() - entry['fetched_at']
+            if age < self.ttl_seconds - self.refresh_seconds:
+                return entry['value']
+            if age < self.ttl_seconds:
+                self.refresh_in_background(secret_id)
+                return entry['value']
+        return self.fetch(secret_id)
+
+    def fetch(self, secret_id):
+        response = self.get_client().get_secret_value(SecretId=secret_id)
+        value = response.get('SecretString')
+        self.entries[secret_id] = {'value': value,
+                                   'fetched_at': time.monotonic()}
+        logger.info(f'Fetched secret ({secret_id})')
+        return value
+
+    def refresh_in_background(self, secret_id):
+        with self.lock:
+            if secret_id in self.refreshing:
+                return
+            self.refreshing.add(secret_id)
+
+        def refresh():
+            try:
+                self.fetch(secret_id)
+            except Exception as e:
+                logger.error(f'Could not refresh secret ({secret_id}): {e}')
+            finally:
+                with self.lock:
+                    self.refreshing.discard(secret_id)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def get_client(self):
+        with self.lock:
+            if self.client is None:
+                self.client = boto3.client('secretsmanager')
+            return self.client
+
+    def invalidate(self, secret_id):
+        """Removes 'secret_id' from the cache."""
+        self.entries.pop(secret_id, None)
+
+    def clear(self):
+        """Removes all secrets and the client from the cache."""
+        self.entries.clear()
+        self.client = None
+
+
+def is_auth_error(error):
+    """Returns True if a database error was caused by invalid credentials
+    (Postgres error code 28P01), so that the credentials can be refreshed
+    and the connection retried."""
+    return '28P01' in str(error) or \
+        'password authentication failed' in str(error)
+
+
+secrets_cache = SecretsCache()
@@ -0,0 +1,243 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+from io import BytesIO
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+
+logger = logging.getLogger('MyLogger')
+logger.setLevel(logging.INFO)
+
+MiB = 1024 * 1024
+
+
+class Uploader:
+    """Uploads files, in-memory buffers, chunk iterators and streams to S3
+    with a
+    tunable transfer configuration, shared by the lambdas.
+
+    Files and buffers of at least 'multipart_threshold' bytes are sent as
+    multipart uploads of 'multipart_chunksize' byte parts, using up to
+    'max_concurrency' threads. 'checksum_algorithm' ('CRC32', 'CRC32C',
+    'SHA1' or 'SHA256') has S3 verify every part, and 'content_md5' sends
+    a Content-MD5 header with uploads small enough to go in one request.
+
+    Each upload logs its size, duration and number of parts."""
+
+    MIN_PART_SIZE = 5 * MiB
+    CHECKSUM_ALGORITHMS = ['CRC32', 'CRC32C', 'SHA1', 'SHA256']
+
+    def __init__(self, multipart_threshold=8 * MiB,
+                 multipart_chunksize=8 * MiB, max_concurrency=10,
+                 checksum_algorithm=None, content_md5=False,
+                 s3_client=None):
+        if type(multipart_threshold) is not int or multipart_threshold < 1:
+            raise ValueError(
+                f"Invalid 'multipart_threshold' ({multipart_threshold})")
+        if type(multipart_chunksize) is not int or \
+                multipart_chunksize < Uploader.MIN_PART_SIZE:
+            raise ValueError(
+                f"Invalid 'multipart_chunksize' ({multipart_chunksize})")
+        if type(max_concurrency) is not int or max_concurrency < 1:
+            raise ValueError(f"Invalid 'max_concurrency' ({max_concurrency})")
+        if checksum_algorithm is not None and \
+                checksum_algorithm not in Uploader.CHECKSUM_ALGORITHMS:
+            raise ValueError(
+                f"Invalid 'checksum_algorithm' ({checksum_algorithm})")
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.checksum_algorithm = checksum_algorithm
+        self.content_md5 = content_md5
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency)
+        self.s3_client = (s3_client if s3_client is not None
+                          else boto3.client('s3'))
+
+    @classmethod
+    def from_env(cls, env_key='OI_UPLOADER_INFO', s3_client=None):
+        """Returns an uploader configured by the JSON in the optional
+        environment variable, e.g. {"max_concurrency": 4}, or with the
+        default configuration if it is not set."""
+        config = json.loads(os.environ.get(env_key, '{}'))
+        return cls(**config, s3_client=s3_client)
+
+    def upload_file(self, file_name, bucket, key):
+        """Uploads a file to S3 and returns the upload metrics."""
+        size = os.path.getsize(file_name)
+        start = time.perf_counter()
+        if self.content_md5 and size < self.multipart_threshold:
+            with open(file_name, 'rb') as f:
+                self.put_object(f.read(), bucket, key)
+        else:
+            self.s3_client.upload_file(
+                file_name, bucket, key, ExtraArgs=self.get_extra_args(),
+                Config=self.transfer_config)
+        return self.log_metrics(bucket, key, size,
+                                time.perf_counter() - start,
+                                self.count_parts(size))
+
+    def upload_buffer(self, buffer, bucket, key):
+        """Uploads bytes or a binary file object to S3 and returns the
+        upload metrics."""
+        if isinstance(buffer, (bytes, bytearray)):
+            buffer = BytesIO(buffer)
+        position = buffer.tell()
+        size = buffer.seek(0, os.SEEK_END) - position
+        buffer.seek(position)
+        start = time.perf_counter()
+        if self.content_md5 and size < self.multipart_threshold:
+            self.put_object(buffer.read(), bucket, key)
+        else:
+            self.s3_client.upload_fileobj(
+                buffer, bucket, key, ExtraArgs=self.get_extra_args(),
+                Config=self.transfer_config)
+        return self.log_metrics(bucket, key, size,
+                                time.perf_counter() - start,
+                                self.count_parts(size))
+
+    def upload_chunks(self, chunks, bucket, key):
+        """Uploads an iterable of bytes chunks to S3 as a single object and
+        returns the upload metrics, or None if there were no chunks.
+
+        The chunks are written to an UploadStream, so only one part is
+        held in memory at a time."""
+        def write_chunks(stream):
+            has_chunks = False
+            for chunk in chunks:
+                has_chunks = True
+                stream.write(chunk)
+            return has_chunks
+
+        return self.upload_stream(write_chunks, bucket, key)
+
+    def upload_stream(self, write, bucket, key):
+        """Uploads what 'write' writes to the UploadStream it is called
+        with to S3 as a single object and returns the upload metrics.
+
+        If 'write' returns False, nothing is uploaded and None is
+        returned. A failed multipart upload is aborted."""
+        stream = UploadStream(self, bucket, key)
+        try:
+            if write(stream) is False:
+                stream.abort()
+                return None
+            return stream.close()
+        except Exception:
+            stream.abort()
+            raise
+
+    def upload_part(self, bucket, key, upload_id, part_number, part):
+        kwargs = {}
+        if self.checksum_algorithm is not None:
+            kwargs['ChecksumAlgorithm'] = self.checksum_algorithm
+        elif self.content_md5:
+            kwargs['ContentMD5'] = self.get_content_md5(part)
+        response = self.s3_client.upload_part(
+            Bucket=bucket, Key=key, UploadId=upload_id,
+            PartNumber=part_number, Body=bytes(part), **kwargs)
+        uploaded_part = {'ETag': response['ETag'], 'PartNumber': part_number}
+        checksum_key = f'Checksum{self.checksum_algorithm}'
+        if checksum_key in response:
+            uploaded_part[checksum_key] = response[checksum_key]
+        return uploaded_part
+
+    def put_object(self, body, bucket, key):
+        kwargs = self.get_extra_args()
+        if self.content_md5:
+            kwargs['ContentMD5'] = self.get_content_md5(body)
+        self.s3_client.put_object(Bucket=bucket, Key=key, Body=body, **kwargs)
+
+    def get_extra_args(self):
+        if self.checksum_algorithm is None:
+            return {}
+        return {'ChecksumAlgorithm': self.checksum_algorithm}
+
+    def get_content_md5(self, body):
+        return base64.b64encode(hashlib.md5(
+            body, usedforsecurity=False).digest()).decode('ascii')
+
+    def count_parts(self, size):
+        if size < self.multipart_threshold:
+            return 1
+        return -(-size // self.multipart_chunksize)
+
+    def log_metrics(self, bucket, key, size, seconds, parts):
+        metrics = {'bucket': bucket, 'key': key, 'bytes': size,
+                   'seconds': round(seconds, 3), 'parts': parts}
+        logger.info(f'Uploaded s3://{bucket}/{key}: {size} bytes in '
+                    f'{seconds:.3f} s with {parts} part(s)')
+        return metrics
+
+
+class UploadStream:
+    """Writable binary stream uploading the bytes written to it to S3 as a
+    single object, e.g. for COPY ... TO STDOUT.
+
+    Bytes are gathered into parts of the uploader's 'multipart_chunksize'
+    and each part is sent as soon as it is full, so only one part is held
+    in memory at a time. Data smaller than a part is sent in a single
+    request when the stream is closed."""
+
+    def __init__(self, uploader, bucket, key):
+        self.uploader = uploader
+        self.s3_client = uploader.s3_client
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = None
+        self.parts = []
+        self.part = bytearray()
+        self.size = 0
+        self.start = time.perf_counter()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.part += data
+        if len(self.part) >= self.uploader.multipart_chunksize:
+            self.send_part()
+        return len(data)
+
+    def send_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key,
+                **self.uploader.get_extra_args())['UploadId']
+        self.parts.append(self.uploader.upload_part(
+            self.bucket, self.key, self.upload_id, len(self.parts) + 1,
+            self.part))
+        self.size += len(self.part)
+        self.part = bytearray()
+
+    def close(self):
+        """Sends the rest of the data, completes the upload and returns
+        the upload metrics."""
+        if self.upload_id is None:
+            self.uploader.put_object(bytes(self.part), self.bucket, self.key)
+            self.size = len(self.part)
+            self.part = bytearray()
+            return self.uploader.log_metrics(
+                self.bucket, self.key, self.size,
+                time.perf_counter() - self.start, 1)
+        if self.part:
+            self.send_part()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts})
+        return self.uploader.log_metrics(
+            self.bucket, self.key, self.size,
+            time.perf_counter() - self.start, len(self.parts))
+
+    def abort(self):
+        """Aborts the multipart upload, if one was started."""
+        self.part = bytearray()
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
@@ -1,8 +1,15 @@
 import pandas as pd
-import boto3
 import logging
 import os
 import json
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+from shared.invoker import LambdaInvoker
+from shared.resource_cache import resource_cache
+from shared.parquet import (COMPRESSIONS, ParquetBuffer, ParquetFileWriter,
+                            get_parquet_kwargs, write_parquet)
+from shared.uploader import Uploader
 
 
 logger = logging.getLogger('MyLogger')
@@ -10,6 +17,11 @@ logger.setLevel(logging.INFO)
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+TRANSFORM_OPTIONS = {'concurrency': 1, 'in_memory': False,
+                     'compression': 'snappy', 'row_group_size': 0,
+                     'use_dictionary': True, 'chunk_size': 0,
+                     'optimise_dtypes': False, 'skip_unchanged': True}
+
 
 def transform_handler(event, context):
     """reads environment variables for S3 bucket names,
@@ -20,55 +32,75 @@ def transform_handler(event, context):
     processed_info_json = load_env_var('OI_PROCESSED_INFO', ['s3_bucket_name'])
     loader_lambda_json = load_env_var('OI_LOAD_LAMBDA_INFO',
                                       ['load_lambda_arn'])
+    options = get_transform_options(event)
+    uploader = resource_cache.get(
+        'uploader', Uploader.from_env,
+        config=os.environ.get('OI_UPLOADER_INFO'))
     transformer = Transformer(storer_info_json['s3_bucket_name'],
-                              processed_info_json['s3_bucket_name'])
+                              processed_info_json['s3_bucket_name'],
+                              uploader=uploader,
+                              in_memory=options['in_memory'],
+                              compression=options['compression'],
+                              row_group_size=options['row_group_size'],
+                              use_dictionary=options['use_dictionary'],
+                              chunk_size=options['chunk_size'],
+                              optimise_dtypes=options['optimise_dtypes'],
+                              skip_unchanged=options['skip_unchanged'])
     transformer.list_csv_files()
-    df_address = transformer.read_csv('address')
-    transformer.store_as_parquet(
-        'address', transformer.transform_address(df_address))
-    df_department = transformer.read_csv('department')
-    transformer.store_as_parquet(
-        'currency',
-        transformer.transform_currency(transformer.read_csv('currency')))
-    transformer.store_as_parquet(
-        'design', transformer.transform_design(transformer.read_csv('design')))
-    transformer.store_as_parquet(
-        'staff', transformer.transform_staff(
-            transformer.read_csv('staff'), df_department))
-    transformer.store_as_parquet(
-        'counterparty', transformer.transform_counterparty(
-            transformer.read_csv('counterparty'), df_address))
-    transformer.store_as_parquet('date', transformer.create_dim_date())
-    transformer.store_as_parquet(
-        'sales_order', transformer.transform_sales_order(
-            transformer.read_csv('sales_order')))
-    transformer.store_as_parquet(
-        'payment_type', transformer.transform_payment_type(
-            transformer.read_csv('payment_type')))
-    transformer.store_as_parquet(
-        'transaction', transformer.transform_transaction(
-            transformer.read_csv('transaction')))
-    transformer.store_as_parquet(
-        'payment', transformer.transform_payment(
-            transformer.read_csv('payment')))
-    transformer.store_as_parquet(
-        'purchase_order', transformer.transform_purchase_order(
-            transformer.read_csv('purchase_order')))
-
-    call_loader_lambda(loader_lambda_json['load_lambda_arn'], event, context)
-
-
-def call_loader_lambda(fnArn, event, context):
-    client = boto3.client('lambda')
+    changed_tables = transformer.transform_tables(options['concurrency'])
+    if not changed_tables:
+        logger.info('No tables changed, not invoking loader lambda')
+        transformer.write_manifest()
+    else:
+        # the loader records the manifest once it has loaded the tables,
+        # also when invoked with 'Event', so that tables it failed to load
+        # are transformed and handed to it again
+        call_loader_lambda(loader_lambda_json['load_lambda_arn'], event,
+                           context, changed_tables,
+                           LambdaInvoker.from_lambda_info(loader_lambda_json),
+                           manifest=transformer.manifest)
+
+
+def get_transform_options(event):
+    """return the transform options given in the event payload,
+    falling back to TRANSFORM_OPTIONS for any option not given.
+    """
+    options = dict(TRANSFORM_OPTIONS)
+    for option, default in TRANSFORM_OPTIONS.items():
+        if event is not None and option in event:
+            if type(event[option]) is not type(default):
+                raise Exception(f"Event payload requires {type(default)} in "
+                                f"'{option}' but got {event} instead")
+            options[option] = event[option]
+    if options['concurrency'] < 1:
+        raise Exception("Event payload option 'concurrency' must be positive")
+    for option in ['row_group_size', 'chunk_size']:
+        if options[option] < 0:
+            raise Exception(
+                f"Event payload option '{option}' cannot be negative")
+    if options['compression'] not in COMPRESSIONS:
+        raise Exception(f"Event payload option 'compression' must be one of "
+                        f"{COMPRESSIONS} but got {event} instead")
+    return options
+
+
+def call_loader_lambda(fnArn, event, context, changed_tables=None,
+                       invoker=None, manifest=None):
+    """invoke the loader lambda with the changed tables and the manifest
+    for it to record after loading them in the payload, synchronously
+    unless the invoker is asynchronous.
+    """
+    if invoker is None:
+        invoker = LambdaInvoker()
     inputParams = {}
-    response = client.invoke(
-        FunctionName=fnArn,
-        InvocationType='RequestResponse',
-        Payload=json.dumps(inputParams)
-    )
+    if changed_tables is not None:
+        inputParams['changed_tables'] = changed_tables
+    if manifest is not None:
+        inputParams['manifest'] = manifest
     logger.info('Invoking loader lambda...')
-    res = json.load(response['Payload'])
-    logger.info(f'Loader lambda responded with {res}')
+    res = invoker.invoke(fnArn, inputParams)
+    if res is not None:
+        logger.info(f'Loader lambda responded with {res}')
 
 
 def load_env_var(env_key, expected_json_keys):
@@ -94,38 +126,618 @@ class Transformer:
                  'payment', 'transaction', 'payment_type',
                  'currency', 'department']
 
-    def __init__(self, bucket_name, processed_bucket_name):
-        self.s3_client = boto3.client('s3')
+    # Transform method and extracted files (keys of FILE_LIST) passed to
+    # it for each Parquet file stored in the processed bucket
+    TRANSFORMS = {'address': ('transform_address', ['address']),
+                  'currency': ('transform_currency', ['currency']),
+                  'design': ('transform_design', ['design']),
+                  'staff': ('transform_staff', ['staff', 'department']),
+                  'counterparty': ('transform_counterparty',
+                                   ['counterparty', 'address']),
+                  'date': ('transform_date',
+                           ['sales_order', 'payment', 'purchase_order']),
+                  'sales_order': ('transform_sales_order', ['sales_order']),
+                  'payment_type': ('transform_payment_type',
+                                   ['payment_type']),
+                  'transaction': ('transform_transaction', ['transaction']),
+                  'payment': ('transform_payment', ['payment']),
+                  'purchase_order': ('transform_purchase_order',
+                                     ['purchase_order'])}
+
+    # Object in the processed bucket recording the ETags of the extracted
+    # files each stored Parquet file was transformed from, and the options
+    # it was written with
+    MANIFEST_KEY = 'manifest.json'
+
+    # Columns read from each extracted file and their dtypes, with
+    # 'datetime' for timestamps. Other columns, such as the created_at
+    # and last_updated of dimensions, are not read at all.
+    CSV_SCHEMAS = {
+        'address': {'address_id': 'int64', 'address_line_1': 'object',
+                    'address_line_2': 'object', 'district': 'object',
+                    'city': 'object', 'postal_code': 'object',
+                    'country': 'object', 'phone': 'object'},
+        'counterparty': {'counterparty_id': 'int64',
+                         'counterparty_legal_name': 'object',
+                         'legal_address_id': 'int64'},
+        'currency': {'currency_id': 'int64', 'currency_code': 'object'},
+        'department': {'department_id': 'int64',
+                       'department_name': 'object', 'location': 'object'},
+        'design': {'design_id': 'int64', 'design_name': 'object',
+                   'file_location': 'object', 'file_name': 'object'},
+        'payment_type': {'payment_type_id': 'int64',
+                         'payment_type_name': 'object'},
+        'staff': {'staff_id': 'int64', 'first_name': 'object',
+                  'last_name': 'object', 'department_id': 'int64',
+                  'email_address': 'object'},
+        'transaction': {'transaction_id': 'int64',
+                        'transaction_type': 'object',
+                        'sales_order_id': 'Int64',
+                        'purchase_order_id': 'Int64'},
+        'sales_order': {'sales_order_id': 'int64', 'created_at': 'datetime',
+                        'last_updated': 'datetime', 'design_id': 'int64',
+                        'staff_id': 'int64', 'counterparty_id': 'int64',
+                        'units_sold': 'int64', 'unit_price': 'float64',
+                        'currency_id': 'int64',
+                        'agreed_delivery_date': 'object',
+                        'agreed_payment_date': 'object',
+                        'agreed_delivery_location_id': 'int64'},
+        'payment': {'payment_id': 'int64', 'created_at': 'datetime',
+                    'last_updated': 'datetime', 'transaction_id': 'int64',
+                    'counterparty_id': 'int64', 'payment_amount': 'float64',
+                    'currency_id': 'int64', 'payment_type_id': 'int64',
+                    'paid': 'bool', 'payment_date': 'object'},
+        'purchase_order': {'purchase_order_id': 'int64',
+                           'created_at': 'datetime',
+                           'last_updated': 'datetime', 'staff_id': 'int64',
+                           'counterparty_id': 'int64', 'item_code': 'object',
+                           'item_quantity': 'int64',
+                           'item_unit_price': 'float64',
+                           'currency_id': 'int64',
+                           'agreed_delivery_date': 'object',
+                           'agreed_payment_date': 'object',
+                           'agreed_delivery_location_id': 'int64'}}
+
+    # Date columns of the extracted fact files, whose range dim_date
+    # covers. Files transformed in chunks are read with only these
+    # columns for dim_date.
+    DATE_COLUMNS = {'sales_order': ['created_at', 'last_updated',
+                                    'agreed_delivery_date',
+                                    'agreed_payment_date'],
+                    'payment': ['created_at', 'last_updated', 'payment_date'],
+                    'purchase_order': ['created_at', 'last_updated',
+                                       'agreed_delivery_date',
+                                       'agreed_payment_date']}
+
+    # Columns of the transformed fact files holding the dates returned by
+    # split_timestamp, which are written as Parquet dates
+    SPLIT_DATE_COLUMNS = ['created_date', 'last_updated_date']
+
+    # Transforms of a single file that number their rows, which can be
+    # run chunk by chunk on large files
+    CHUNKED_TRANSFORMS = ['sales_order', 'payment', 'purchase_order']
+
+    # Number of deltas of an extracted file at which they are merged back
+    # into it once its transforms have run, see compact_deltas
+    COMPACT_DELTAS = 10
+
+    # Largest ratio of distinct values to rows of a string column that is
+    # stored as a categorical (dictionary encoded) column
+    CATEGORY_RATIO = 0.5
+
+    def __init__(self, bucket_name, processed_bucket_name, uploader=None,
+                 in_memory=False, compression='snappy', row_group_size=0,
+                 use_dictionary=True, chunk_size=0, optimise_dtypes=False,
+                 skip_unchanged=False):
+        """Parquet files are written with the 'compression' codec, at
+        most 'row_group_size' rows per row group (0 for the engine's
+        default) and dictionary encoding if 'use_dictionary' is set.
+        With 'in_memory' they are serialised into memory and uploaded
+        from there instead of through a file in /tmp.
+
+        With a 'chunk_size', the files of CHUNKED_TRANSFORMS are read,
+        transformed and written that many rows at a time.
+
+        With 'optimise_dtypes', transformed dataframes that are not
+        written in chunks go through optimise_dtypes before being stored,
+        and the bytes saved for each file are kept in 'bytes_saved'.
+
+        With 'skip_unchanged', transforms whose extracted files have the
+        same ETags, and which are written with the same options, as when
+        they were last stored (see MANIFEST_KEY) are skipped.
+        """
+        self.in_memory = in_memory
+        self.chunk_size = chunk_size
+        self.optimise = optimise_dtypes
+        self.bytes_saved = {}
+        self.skip_unchanged = skip_unchanged
+        self.etags = {}
+        self.manifest = {}
+        self.parquet_kwargs = get_parquet_kwargs(
+            compression, row_group_size, use_dictionary)
+        self.output_options = {**self.parquet_kwargs,
+                               'chunk_size': chunk_size,
+                               'optimise_dtypes': optimise_dtypes}
+        self.uploader = (uploader if uploader is not None
+                         else Uploader.from_env())
+        self.s3_client = self.uploader.s3_client
         self.s3_bucket_name = bucket_name
         self.s3_processed_bucket_name = processed_bucket_name
 
     def list_csv_files(self):
         """list the expected CSV files and
         raise an exception if any are missing.
+
+        The ETags of the files are kept to find unchanged transforms.
         """
-        ingestion_csv_files = self.s3_client.list_objects_v2(
-            Bucket=self.s3_bucket_name)['Contents']
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        self.etags = {
+            item['Key']: item['ETag']
+            for page in paginator.paginate(Bucket=self.s3_bucket_name)
+            for item in page.get('Contents', [])}
+        ingestion_csv_files = list(self.etags)
         for file in Transformer.FILE_LIST:
-            if file not in [item['Key'] for item in ingestion_csv_files]:
+            if file not in ingestion_csv_files:
                 msg = 'ERROR: Files are not complete'
                 logger.error(msg)
                 raise Exception(msg)
 
         return Transformer.FILE_LIST
 
-    def read_csv(self, key):
-        """read a CSV file from S3 and return a Pandas dataframe."""
+    def read_csv(self, key, columns=None):
+        """read an extracted file from S3 and return a Pandas dataframe.
+
+        The file may be CSV, gzip compressed CSV or Parquet, which is
+        recognised from its first bytes. Only the columns in CSV_SCHEMAS
+        are read, with their dtypes, unless the file has no schema, and
+        of those only 'columns' if given.
+
+        Delta objects stored for the file by incremental extraction are
+        merged into it, see update_rows.
+        """
+        deltas = self.get_delta_keys(key)
+        if not deltas:
+            return self.read_object(key, columns)
+        id_column = f'{key}_id'
+        read_columns = (None if columns is None
+                        else list(dict.fromkeys([id_column] + columns)))
+        df_deltas = self.read_deltas(key, deltas, read_columns)
+        df = self.update_rows(key, self.read_object(key, read_columns),
+                              df_deltas)
+        df = pd.concat([df, self.get_new_rows(key, df_deltas, df[id_column])],
+                       ignore_index=True)
+        logger.info(f'Merged {len(deltas)} delta(s) into {key}')
+        return df if columns is None else df[columns]
+
+    def get_delta_keys(self, key):
+        """return the keys of the delta objects 'delta/<key>/<watermark>'
+        listed for an extracted file, oldest first, as their names are
+        the watermarks the deltas start from."""
+        prefix = f'delta/{key}/'
+        return sorted(item for item in self.etags if item.startswith(prefix))
+
+    def read_deltas(self, key, deltas, columns=None):
+        """read the delta objects of an extracted file and return their
+        rows deduplicated on the id of the file, keeping the row of the
+        latest delta, which holds the latest last_updated as deltas only
+        have rows updated after the previous one."""
+        df = pd.concat([self.read_object(delta, columns) for delta in deltas],
+                       ignore_index=True)
+        return df.drop_duplicates(f'{key}_id', keep='last')
+
+    def update_rows(self, key, df, df_deltas):
+        """return the rows of an extracted file (or a chunk of them) with
+        those updated by the deltas replaced in place, so the rows keep
+        their positions, and so their record ids, whether the file is
+        read whole or in chunks of any size."""
+        id_column = f'{key}_id'
+        updated = df[id_column].isin(df_deltas[id_column])
+        if not updated.any():
+            return df
+        df_updated = df_deltas.set_index(id_column).loc[
+            df.loc[updated, id_column]].reset_index()[df.columns]
+        df_updated.index = df.index[updated]
+        return pd.concat([df[~updated], df_updated]).sort_index()
+
+    def get_new_rows(self, key, df_deltas, ids):
+        """return the rows of the deltas whose ids are not in 'ids', the
+        ids of the extracted file, in the order of their ids. They follow
+        the rows of the file."""
+        id_column = f'{key}_id'
+        return df_deltas[~df_deltas[id_column].isin(ids)].sort_values(
+            id_column, ignore_index=True)
+
+    def read_object(self, key, columns=None):
         try:
             obj = self.s3_client.get_object(Bucket=self.s3_bucket_name,
                                             Key=key)
-            df = pd.read_csv(obj['Body'], index_col=False)
+            body = BytesIO(obj['Body'].read())
+            magic = body.read(4)
+            body.seek(0)
+            if magic == b'PAR1':
+                df = self.read_parquet(body, key, columns)
+            else:
+                df = pd.read_csv(body, index_col=False,
+                                 compression='gzip'
+                                 if magic[:2] == b'\x1f\x8b' else None,
+                                 **self.get_read_csv_kwargs(key, columns))
             return df
         except Exception as e:
             logger.error(f'An error occurred reading csv file: {e}')
             raise RuntimeError()
 
+    def transform_tables(self, concurrency=1):
+        """read the extracted files, transform them and store them as
+        Parquet files as described by TRANSFORMS, using up to
+        'concurrency' threads.
+
+        Transforms are started in TRANSFORMS order, each queued after the
+        reads of its extracted files (files transformed in chunks are
+        read as they are transformed), and each waits only for its own
+        files, e.g. staff for staff and department, so transforms and
+        their uploads run while later files are still being read or
+        transformed. Because reads are queued first, a waiting transform
+        never holds up a read.
+
+        At most 'concurrency' files are held in memory at a time (more
+        only if a single transform needs more), so a transform is not
+        started while others are running if its reads would exceed that.
+        A file read is dropped once the last transform needing it has
+        finished.
+
+        If any transform fails, an exception listing the failed files in
+        TRANSFORMS order is raised once all transforms have finished.
+        Otherwise the Parquet files that were stored are returned. The
+        transforms that ran are added to 'manifest', which is only
+        stored by write_manifest, and extracted files they read with at
+        least COMPACT_DELTAS deltas are compacted.
+        """
+        self.manifest = self.read_manifest()
+        transforms = {
+            file_name: inputs
+            for file_name, (_, inputs) in Transformer.TRANSFORMS.items()
+            if not self.is_unchanged(file_name, inputs)}
+        skipped = [file_name for file_name in Transformer.TRANSFORMS
+                   if file_name not in transforms]
+        if skipped:
+            logger.info(f'Skipping unchanged transforms: {skipped}')
+        chunked = (Transformer.CHUNKED_TRANSFORMS if self.chunk_size
+                   else [])
+        keys = {file_name: [] if file_name in chunked else inputs
+                for file_name, inputs in transforms.items()}
+        dependents = Counter(key for inputs in keys.values()
+                             for key in inputs)
+        waiting = list(transforms)
+        reads, stores, running = {}, {}, {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while waiting or running:
+                while waiting:
+                    file_name = waiting[0]
+                    unread = [key for key in keys[file_name]
+                              if key not in reads]
+                    if running and len(reads) + len(unread) > concurrency:
+                        break
+                    for key in unread:
+                        reads[key] = executor.submit(
+                            self.read_csv, key, Transformer.DATE_COLUMNS[key]
+                            if key in chunked else None)
+                    if file_name in chunked:
+                        future = executor.submit(
+                            self.transform_table_in_chunks, file_name)
+                    else:
+                        future = executor.submit(
+                            self.transform_table, file_name,
+                            [reads[key] for key in keys[file_name]])
+                    stores[file_name] = future
+                    running[future] = waiting.pop(0)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for key in keys[running.pop(future)]:
+                        dependents[key] -= 1
+                        if not dependents[key]:
+                            del reads[key]
+        failures = {file_name: future.exception()
+                    for file_name, future in stores.items()
+                    if future.exception() is not None}
+        if self.bytes_saved:
+            logger.info(f'Optimised dtypes saved {self.bytes_saved} bytes')
+        for file_name, inputs in transforms.items():
+            if file_name not in failures:
+                self.manifest[file_name] = self.get_manifest_entry(inputs)
+        if failures:
+            raise Exception('Could not transform tables: ' + ', '.join(
+                f'{file_name} ({error!r})'
+                for file_name, error in failures.items()))
+        for key in dict.fromkeys(key for inputs in transforms.values()
+                                 for key in inputs):
+            if len(self.get_delta_keys(key)) >= Transformer.COMPACT_DELTAS:
+                self.compact_deltas(key)
+        return [file_name for file_name, future in stores.items()
+                if future.result()]
+
+    def is_unchanged(self, file_name, inputs):
+        """return True if unchanged transforms are skipped and the
+        extracted files of the transform have the ETags, and the output
+        options the values, recorded in the manifest when it was last
+        stored."""
+        entry = self.get_manifest_entry(inputs)
+        return self.skip_unchanged and bool(inputs) and \
+            None not in entry['etags'].values() and \
+            self.manifest.get(file_name) == entry
+
+    def get_manifest_entry(self, inputs):
+        return {'etags': self.get_input_etags(inputs),
+                'options': self.output_options}
+
+    def get_input_etags(self, inputs):
+        """return the ETags of the extracted files and of their deltas."""
+        return {item: self.etags.get(item) for key in inputs
+                for item in [key] + self.get_delta_keys(key)}
+
+    def compact_deltas(self, key):
+        """write an extracted file merged with its deltas back to the
+        ingestion bucket as Parquet and delete the deltas, so that later
+        runs read (and list) a single object again. Manifest entries
+        recorded for the file and these deltas get the ETag of the
+        compacted file, so their transforms are still skipped.
+
+        Nothing is written if the file changed since it was listed, e.g.
+        as a full extraction replaced it. Errors are logged rather than
+        raised: the transforms have been stored, and as merging is
+        idempotent a compacted file whose deltas were not deleted still
+        reads the same.
+        """
+        deltas = self.get_delta_keys(key)
+        etags = self.get_input_etags([key])
+        path = f'/tmp/{key}.compacted.parq'
+        try:
+            if self.s3_client.head_object(Bucket=self.s3_bucket_name,
+                                          Key=key)['ETag'] != etags[key]:
+                logger.info(f'{key} changed since it was listed, '
+                            f'not compacting its deltas')
+                return
+            if self.chunk_size:
+                writer = ParquetFileWriter(path, **self.parquet_kwargs)
+                try:
+                    for chunk in self.read_csv_chunks(key):
+                        writer.write(chunk)
+                finally:
+                    writer.close()
+            else:
+                write_parquet(self.read_csv(key), path, **self.parquet_kwargs)
+            self.uploader.upload_file(path, self.s3_bucket_name, key)
+            etag = self.s3_client.head_object(Bucket=self.s3_bucket_name,
+                                              Key=key)['ETag']
+            for start in range(0, len(deltas), 1000):
+                self.s3_client.delete_objects(
+                    Bucket=self.s3_bucket_name,
+                    Delete={'Objects': [{'Key': delta} for delta
+                                        in deltas[start:start + 1000]],
+                            'Quiet': True})
+        except Exception as e:
+            logger.error(f'An error occurred compacting deltas of {key}: {e}')
+            return
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        for entry in self.manifest.values():
+            recorded = entry.get('etags', {})
+            if all(recorded.get(item) == value
+                   for item, value in etags.items()):
+                for delta in deltas:
+                    del recorded[delta]
+                recorded[key] = etag
+        for delta in deltas:
+            del self.etags[delta]
+        self.etags[key] = etag
+        logger.info(f'Compacted {len(deltas)} delta(s) into {key}')
+
+    def read_manifest(self):
+        """read the manifest of ETags from the processed bucket, or return
+        an empty one if there is none."""
+        try:
+            obj = self.s3_client.get_object(
+                Bucket=self.s3_processed_bucket_name,
+                Key=Transformer.MANIFEST_KEY)
+        except self.s3_client.exceptions.NoSuchKey:
+            return {}
+        return json.loads(obj['Body'].read())
+
+    def write_manifest(self):
+        """store the manifest of the transforms that ran in the processed
+        bucket, if the extracted files were listed. When the loader is
+        invoked, it stores the manifest instead (see Loader.MANIFEST_KEY).
+        """
+        if self.etags:
+            self.uploader.upload_buffer(
+                json.dumps(self.manifest, indent=2).encode('utf-8'),
+                self.s3_processed_bucket_name, Transformer.MANIFEST_KEY)
+
+    def transform_table(self, file_name, reads):
+        """transform the dataframes read by the given futures with the
+        transform of 'file_name' in TRANSFORMS and store the result,
+        unless the transform returns None as there is nothing to store.
+        Returns True if the result was stored."""
+        method, _ = Transformer.TRANSFORMS[file_name]
+        df = getattr(self, method)(*[read.result() for read in reads])
+        if df is None:
+            logger.info(f'{file_name} is unchanged and was not stored')
+            return False
+        if self.optimise:
+            df = self.optimise_dtypes(file_name, df)
+        self.store_as_parquet(file_name, df)
+        return True
+
+    def optimise_dtypes(self, file_name, df):
+        """return the dataframe with string columns of few distinct values
+        (at most CATEGORY_RATIO of the rows) as categoricals, which are
+        dictionary encoded in Parquet, and integer columns downcast to
+        the smallest integer type that holds their values.
+
+        The bytes saved in memory are logged and kept in 'bytes_saved'.
+        Chunked transforms are not optimised, as the categories and
+        downcast types of their chunks could differ.
+        """
+        bytes_before = df.memory_usage(index=False, deep=True).sum()
+        df = df.copy()
+        for column in df.columns:
+            series = df[column]
+            if pd.api.types.is_object_dtype(series) and len(series) and \
+                    series.nunique() <= Transformer.CATEGORY_RATIO * \
+                    len(series) and series.dropna().map(type).eq(str).all():
+                df[column] = series.astype('category')
+            elif pd.api.types.is_integer_dtype(series):
+                df[column] = pd.to_numeric(series, downcast='integer')
+        bytes_after = df.memory_usage(index=False, deep=True).sum()
+        self.bytes_saved[file_name] = int(bytes_before - bytes_after)
+        logger.info(f'Optimised dtypes of {file_name}: {bytes_before} bytes '
+                    f'to {bytes_after} bytes, '
+                    f'{self.bytes_saved[file_name]} bytes saved')
+        return df
+
+    def transform_table_in_chunks(self, file_name):
+        """transform the extracted file of 'file_name' in CHUNKED_TRANSFORMS
+        'chunk_size' rows at a time and store it as a Parquet file, with
+        the record ids numbered on from one chunk to the next.
+
+        Each chunk is appended to the file as a row group. The file is
+        written to /tmp even with 'in_memory', as only the compressed
+        Parquet data of the chunks written so far is kept there, and is
+        then uploaded in parts. A file left in /tmp by an earlier
+        invocation is removed first, and if the extracted file has no
+        rows, an empty frame is transformed so the stored file still has
+        the columns of the table.
+        """
+        method, (key,) = Transformer.TRANSFORMS[file_name]
+        path = f'/tmp/{file_name}.parq'
+        if os.path.exists(path):
+            os.remove(path)
+        writer = ParquetFileWriter(
+            path, date_columns=Transformer.SPLIT_DATE_COLUMNS,
+            **self.parquet_kwargs)
+        first_record_id = 1
+        try:
+            for chunk in self.read_csv_chunks(key):
+                df = getattr(self, method)(chunk.reset_index(drop=True),
+                                           first_record_id=first_record_id)
+                writer.write(df)
+                first_record_id += len(df)
+            if writer.written == 0:
+                writer.write(getattr(self, method)(
+                    self.get_empty_frame(key), first_record_id=1))
+        except Exception as e:
+            msg = f'An error occurred transforming chunks of {key}: {e}'
+            logger.error(msg)
+            raise Exception(msg)
+        finally:
+            writer.close()
+        logger.info(f'Transformed {first_record_id - 1} rows of {key} in '
+                    f'{writer.written} chunk(s)')
+
+        try:
+            self.uploader.upload_file(
+                path, self.s3_processed_bucket_name, file_name)
+
+        except Exception as e:
+            msg = f'An error occurred writing parquet file to bucket: {e}'
+            logger.error(msg)
+            raise Exception(msg)
+        return True
+
+    def read_csv_chunks(self, key):
+        """read an extracted file from S3 and yield it as Pandas dataframes
+        of at most 'chunk_size' rows.
+
+        CSV and gzip compressed CSV files are streamed from S3, so only
+        one chunk is held in memory at a time. Parquet files are read
+        whole and then split.
+
+        Delta objects of the file are read whole and merged into it as
+        in read_csv: rows they update are replaced within their chunks,
+        and new rows are yielded after the chunks of the file.
+        """
+        deltas = self.get_delta_keys(key)
+        if not deltas:
+            yield from self.read_object_chunks(key)
+            return
+        id_column = f'{key}_id'
+        df_deltas = self.read_deltas(key, deltas)
+        new_ids = df_deltas[id_column]
+        for chunk in self.read_object_chunks(key):
+            new_ids = new_ids[~new_ids.isin(chunk[id_column])]
+            yield self.update_rows(key, chunk, df_deltas)
+        df_new = df_deltas[df_deltas[id_column].isin(new_ids)].sort_values(
+            id_column, ignore_index=True)
+        logger.info(f'Merged {len(deltas)} delta(s) into {key}')
+        for start in range(0, len(df_new), self.chunk_size):
+            yield df_new.iloc[start:start + self.chunk_size]
+
+    def read_object_chunks(self, key):
+        magic = self.s3_client.get_object(
+            Bucket=self.s3_bucket_name, Key=key,
+            Range='bytes=0-3')['Body'].read()
+        obj = self.s3_client.get_object(Bucket=self.s3_bucket_name, Key=key)
+        if magic == b'PAR1':
+            df = self.read_parquet(BytesIO(obj['Body'].read()), key)
+            for start in range(0, max(len(df), 1), self.chunk_size):
+                yield df.iloc[start:start + self.chunk_size]
+        else:
+            yield from pd.read_csv(obj['Body'], index_col=False,
+                                   chunksize=self.chunk_size,
+                                   compression='gzip'
+                                   if magic[:2] == b'\x1f\x8b' else None,
+                                   **self.get_read_csv_kwargs(key))
+
+    def get_read_csv_kwargs(self, key, columns=None):
+        """return the keyword arguments of pd.read_csv that read only the
+        columns of an extracted file in CSV_SCHEMAS (or only 'columns' of
+        them) with their dtypes, so pandas does not infer them, or none
+        if it has no schema.
+        """
+        schema = self.get_csv_schema(key, columns)
+        if schema is None:
+            return {}
+        return {'usecols': list(schema),
+                'dtype': {column: dtype for column, dtype in schema.items()
+                          if dtype != 'datetime'},
+                'parse_dates': [column for column, dtype in schema.items()
+                                if dtype == 'datetime'],
+                'engine': 'c'}
+
+    def read_parquet(self, body, key, columns=None):
+        """read an extracted Parquet file with only the columns of its
+        schema in CSV_SCHEMAS (or only 'columns' of them), cast to their
+        dtypes as if it were read from CSV, e.g. its numeric Decimals to
+        floats. Timestamps and 'object' columns, such as dates, keep the
+        types the file carries.
+        """
+        schema = self.get_csv_schema(key, columns)
+        if schema is None:
+            return pd.read_parquet(body)
+        df = pd.read_parquet(body, columns=list(schema))
+        return df.astype({column: dtype for column, dtype in schema.items()
+                          if dtype not in ('datetime', 'object')})
+
+    def get_empty_frame(self, key):
+        """return a dataframe without rows with the columns and dtypes of
+        an extracted file in CSV_SCHEMAS, as read_csv would read it."""
+        return pd.DataFrame({
+            column: pd.Series(dtype='datetime64[ns]'
+                              if dtype == 'datetime' else dtype)
+            for column, dtype in Transformer.CSV_SCHEMAS[key].items()})
+
+    def get_csv_schema(self, key, columns=None):
+        schema = Transformer.CSV_SCHEMAS.get(key)
+        if schema is None or columns is None:
+            return schema
+        return {column: schema[column] for column in columns}
+
     def store_as_parquet(self, file_name, df):
-        """store a dataframe as a Parquet file in a specified S3 bucket."""
+        """store a dataframe as a Parquet file in a specified S3 bucket.
+
+        Large files are sent by the uploader as multipart uploads, from
+        memory as well as from /tmp.
+        """
         if not isinstance(df, pd.DataFrame):
             msg = 'ERROR: object not a dataframe'
             logger.error(msg)
@@ -137,7 +749,16 @@ class Transformer:
             raise TypeError(msg)
 
         try:
-            df.to_parquet(f'/tmp/{file_name}.parq')
+            if self.in_memory:
+                buffer = ParquetBuffer()
+                write_parquet(df, buffer,
+                              date_columns=Transformer.SPLIT_DATE_COLUMNS,
+                              **self.parquet_kwargs)
+                buffer.seek(0)
+            else:
+                write_parquet(df, f'/tmp/{file_name}.parq',
+                              date_columns=Transformer.SPLIT_DATE_COLUMNS,
+                              **self.parquet_kwargs)
 
         except Exception as e:
             msg = f'An error occurred converting dataframe to parquet: {e}'
@@ -145,9 +766,13 @@ class Transformer:
             raise Exception(msg)
 
         try:
-            self.s3_client.upload_file(
-                f'/tmp/{file_name}.parq', self.s3_processed_bucket_name,
-                file_name)
+            if self.in_memory:
+                self.uploader.upload_buffer(
+                    buffer, self.s3_processed_bucket_name, file_name)
+            else:
+                self.uploader.upload_file(
+                    f'/tmp/{file_name}.parq', self.s3_processed_bucket_name,
+                    file_name)
 
         except Exception as e:
             msg = f'An error occurred writing parquet file to bucket: {e}'
@@ -166,49 +791,106 @@ class Transformer:
         df_currency = df_currency.join(
             df_currency_info.set_index('currency_code'),
             on='currency_code', how='left')
-        return df_currency.drop(columns=['created_at', 'last_updated'])
+        return df_currency.drop(columns=['created_at', 'last_updated'],
+                                errors='ignore')
 
     def transform_design(self, df_design):
         """ transform the design dataframe by dropping some columns."""
-        return df_design.drop(columns=['created_at', 'last_updated'])
+        return df_design.drop(columns=['created_at', 'last_updated'],
+                              errors='ignore')
 
     def transform_address(self, df_address):
         """ transform the address dataframe by dropping
         some columns and renaming a column.
         """
-        return df_address.drop(columns=['created_at', 'last_updated']).rename(
+        return df_address.drop(columns=['created_at', 'last_updated'],
+                               errors='ignore').rename(
             columns={'address_id': 'location_id'})
 
     def create_dim_date(self, from_date_string='2022-11-3',
                         to_date_string='2023-5-1'):
         """create a dataframe of dates between two specified dates."""
-        df = pd.DataFrame(pd.date_range(
-            from_date_string, to_date_string), columns=['date'])
-        df['date_id'] = df['date'].dt.strftime('%Y-%m-%d')
-        df['year'] = df['date'].dt.year
-        df['month'] = df['date'].dt.month
-        df['day'] = df['date'].dt.day
-        df['day_of_week'] = df['date'].dt.dayofweek
-        df['day_name'] = df['date'].dt.strftime("%A")
-        df['month_name'] = df['date'].dt.strftime("%B")
-        df['quarter'] = df['date'].dt.quarter
-        return df.loc[:, df.columns != 'date']
-
-    def transform_sales_order(self, df_sales_order):
+        dates = pd.Series(pd.date_range(from_date_string, to_date_string))
+        return pd.DataFrame({'date_id': dates.dt.strftime('%Y-%m-%d'),
+                             'year': dates.dt.year,
+                             'month': dates.dt.month,
+                             'day': dates.dt.day,
+                             'day_of_week': dates.dt.dayofweek,
+                             'day_name': dates.dt.day_name(),
+                             'month_name': dates.dt.month_name(),
+                             'quarter': dates.dt.quarter})
+
+    def transform_date(self, *df_facts):
+        """create the date dimension for the range of dates in the given
+        fact dataframes (in the order of DATE_COLUMNS).
+
+        dim_date is only stored once and then extended: if the dim_date
+        already in the processed bucket covers the range, None is
+        returned, otherwise the missing dates are appended to it. Without
+        any fact dates or a stored dim_date, the default range of
+        create_dim_date is used.
+        """
+        date_columns = Transformer.DATE_COLUMNS.values()
+        dates = pd.concat(
+            [pd.Series(dtype='datetime64[ns]')] +
+            [pd.to_datetime(df[column]).dt.normalize()
+             for df, columns in zip(df_facts, date_columns)
+             for column in columns if column in df.columns],
+            ignore_index=True)
+        df_date = self.read_dim_date()
+        if df_date is None:
+            if dates.notna().any():
+                return self.create_dim_date(dates.min(), dates.max())
+            return self.create_dim_date()
+        stored_dates = pd.to_datetime(df_date['date_id'])
+        if not dates.notna().any() or (
+                dates.min() >= stored_dates.min() and
+                dates.max() <= stored_dates.max()):
+            return None
+        df_new = self.create_dim_date(min(dates.min(), stored_dates.min()),
+                                      max(dates.max(), stored_dates.max()))
+        df_new = df_new[~df_new['date_id'].isin(df_date['date_id'])]
+        logger.info(f'Extending dim_date by {len(df_new)} dates')
+        return pd.concat([df_date, df_new]).sort_values(
+            'date_id', ignore_index=True)
+
+    def read_dim_date(self):
+        """read the dim_date stored in the processed bucket, or return
+        None if there is none yet."""
+        try:
+            obj = self.s3_client.get_object(
+                Bucket=self.s3_processed_bucket_name, Key='date')
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return pd.read_parquet(BytesIO(obj['Body'].read()))
+
+    @staticmethod
+    def split_timestamp(timestamps):
+        """parse a column of timestamps once and return its dates (as
+        midnight datetimes) and times of day (as timedeltas).
+
+        Both stay vectorised, so no Python date or time objects are
+        created per row. They are stored as Parquet DATE and TIME columns
+        by pyarrow, as in the Lambda layer (see SPLIT_DATE_COLUMNS), and
+        as timestamps and TIME columns by fastparquet, so the loader
+        needs no parsing.
+        """
+        timestamps = pd.to_datetime(timestamps)
+        dates = timestamps.dt.normalize()
+        return dates, timestamps - dates
+
+    def transform_sales_order(self, df_sales_order, first_record_id=1):
         """transforms a pandas DataFrame of sales
         orders into a format suitable for insertion into a star schema.
         """
         df = pd.DataFrame()
-        df['sales_record_id'] = df_sales_order.reset_index().index + 1
+        df['sales_record_id'] = \
+            df_sales_order.reset_index().index + first_record_id
         df['sales_order_id'] = df_sales_order['sales_order_id']
-        df['created_date'] = pd.to_datetime(
-            df_sales_order['created_at']).dt.date.astype(str)
-        df['created_time'] = pd.to_datetime(
-            df_sales_order['created_at']).dt.time.astype(str)
-        df['last_updated_date'] = pd.to_datetime(
-            df_sales_order['last_updated']).dt.date.astype(str)
-        df['last_updated_time'] = pd.to_datetime(
-            df_sales_order['last_updated']).dt.time.astype(str)
+        df['created_date'], df['created_time'] = \
+            self.split_timestamp(df_sales_order['created_at'])
+        df['last_updated_date'], df['last_updated_time'] = \
+            self.split_timestamp(df_sales_order['last_updated'])
         df['sales_staff_id'] = df_sales_order['staff_id']
         df['counterparty_id'] = df_sales_order['counterparty_id']
         df['units_sold'] = df_sales_order['units_sold']
@@ -228,9 +910,10 @@ class Transformer:
         format suitable for insertion into a star schema.
         """
         staff_table = df_staff.drop(
-            columns=['created_at', 'last_updated'])
+            columns=['created_at', 'last_updated'], errors='ignore')
         department_table = df_department.drop(
-            columns=['created_at', 'last_updated', 'manager'])
+            columns=['created_at', 'last_updated', 'manager'],
+            errors='ignore')
         merged_table = pd.merge(
             staff_table, department_table, on='department_id')
         return merged_table.drop(columns=['department_id'])
@@ -245,11 +928,11 @@ class Transformer:
             # drop counterparty columns
             counterparty_table = df_counterparty.drop(
                 columns=['commercial_contact', 'delivery_contact',
-                         'created_at', 'last_updated'])
+                         'created_at', 'last_updated'], errors='ignore')
 
             # drop address table
             address_table = df_address.drop(
-                columns=['created_at', 'last_updated']
+                columns=['created_at', 'last_updated'], errors='ignore'
             )
 
         except Exception as e:
@@ -289,26 +972,23 @@ class Transformer:
 
     def transform_payment_type(self, df_payment_type):
         df_payment_type = df_payment_type.drop(
-            columns=['created_at', 'last_updated'])
+            columns=['created_at', 'last_updated'], errors='ignore')
         return df_payment_type
 
     def transform_transaction(self, df_transaction):
         df_transaction = df_transaction.drop(
-            columns=['created_at', 'last_updated'])
+            columns=['created_at', 'last_updated'], errors='ignore')
         return df_transaction
 
-    def transform_payment(self, df_payment):
+    def transform_payment(self, df_payment, first_record_id=1):
         df = pd.DataFrame()
-        df['payment_record_id'] = df_payment.reset_index().index + 1
+        df['payment_record_id'] = \
+            df_payment.reset_index().index + first_record_id
         df['payment_id'] = df_payment['payment_id']
-        df['created_date'] = pd.to_datetime(
-            df_payment['created_at']).dt.date.astype(str)
-        df['created_time'] = pd.to_datetime(
-            df_payment['created_at']).dt.time.astype(str)
-        df['last_updated_date'] = pd.to_datetime(
-            df_payment['last_updated']).dt.date.astype(str)
-        df['last_updated_time'] = pd.to_datetime(
-            df_payment['last_updated']).dt.time.astype(str)
+        df['created_date'], df['created_time'] = \
+            self.split_timestamp(df_payment['created_at'])
+        df['last_updated_date'], df['last_updated_time'] = \
+            self.split_timestamp(df_payment['last_updated'])
         df['transaction_id'] = df_payment['transaction_id']
         df['counterparty_id'] = df_payment['counterparty_id']
         df['payment_amount'] = df_payment['payment_amount']
@@ -318,18 +998,15 @@ class Transformer:
         df['payment_date'] = df_payment['payment_date']
         return df
 
-    def transform_purchase_order(self, df_purchase_order):
+    def transform_purchase_order(self, df_purchase_order, first_record_id=1):
         df = pd.DataFrame()
-        df['purchase_record_id'] = df_purchase_order.reset_index().index + 1
+        df['purchase_record_id'] = \
+            df_purchase_order.reset_index().index + first_record_id
         df['purchase_order_id'] = df_purchase_order['purchase_order_id']
-        df['created_date'] = pd.to_datetime(
-            df_purchase_order['created_at']).dt.date.astype(str)
-        df['created_time'] = pd.to_datetime(
-            df_purchase_order['created_at']).dt.time.astype(str)
-        df['last_updated_date'] = pd.to_datetime(
-            df_purchase_order['last_updated']).dt.date.astype(str)
-        df['last_updated_time'] = pd.to_datetime(
-            df_purchase_order['last_updated']).dt.time.astype(str)
+        df['created_date'], df['created_time'] = \
+            self.split_timestamp(df_purchase_order['created_at'])
+        df['last_updated_date'], df['last_updated_time'] = \
+            self.split_timestamp(df_purchase_order['last_updated'])
         df['staff_id'] = df_purchase_order['staff_id']
         df['counterparty_id'] = df_purchase_order['counterparty_id']
         df['item_code'] = df_purchase_order['item_code']
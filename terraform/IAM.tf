@@ -14,11 +14,13 @@ data "aws_iam_policy_document" "extraction_lambda_bucket_access" {
     ]
   }
 
-  # put, get objects, and list bucket contents in extraction zone bucket
+  # put, get, delete objects, and list bucket contents in extraction zone
+  # bucket, deleting the deltas of a table once it is extracted in full
   statement {
     actions = [
       "s3:PutObject",
       "s3:GetObject",
+      "s3:DeleteObject",
       "s3:ListBucket"
     ]
     resources = [
@@ -153,8 +155,9 @@ data "aws_iam_policy_document" "transform_lambda_bucket_access" {
     ]
   }
   statement {
-    # get and list objects from extraction zone bucket
-    actions = ["s3:GetObject", "s3:ListBucket"]
+    # get and list objects from extraction zone bucket, and put and delete
+    # them to compact the deltas of extracted files into the files
+    actions = ["s3:GetObject", "s3:ListBucket", "s3:PutObject", "s3:DeleteObject"]
 
     resources = [
       "${aws_s3_bucket.ingestion_zone_bucket.arn}/*",
@@ -162,8 +165,9 @@ data "aws_iam_policy_document" "transform_lambda_bucket_access" {
     ]
   }
   statement {
-
-    actions = ["s3:PutObject", "s3:ListBucket"]
+    # put, get and list objects of transformed zone bucket, which keeps
+    # the stored dim_date to extend and the manifest of transformed files
+    actions = ["s3:PutObject", "s3:GetObject", "s3:ListBucket"]
 
     resources = [
       "${aws_s3_bucket.transformed_zone_bucket.arn}/*",
@@ -278,6 +282,22 @@ data "aws_iam_policy_document" "load_lambda_bucket_access" {
       "${aws_s3_bucket.transformed_zone_bucket.arn}/*"
     ]
   }
+  statement {
+    # put the manifest of the transformed files once they are loaded
+    actions = ["s3:PutObject"]
+
+    resources = [
+      "${aws_s3_bucket.transformed_zone_bucket.arn}/manifest.json"
+    ]
+  }
+  statement {
+    # publish failed asynchronous invocations to the error alerts topic
+    actions = ["sns:Publish"]
+
+    resources = [
+      aws_sns_topic.error_alerts.arn
+    ]
+  }
 }
 
 #creates above policy in IAM
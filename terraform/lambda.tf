@@ -138,6 +138,17 @@ resource "aws_lambda_function" "load_lambda" {
 }
 
 
+# sends asynchronous invocations of the load_lambda function that still fail after Lambda's retries, e.g. from the transform_lambda function with "invocation_type" "Event", to the error alerts topic
+resource "aws_lambda_function_event_invoke_config" "load_lambda_async" {
+  function_name = aws_lambda_function.load_lambda.function_name
+
+  destination_config {
+    on_failure {
+      destination = aws_sns_topic.error_alerts.arn
+    }
+  }
+}
+
 # gives permission for the lambda.amazonaws.com principal to invoke the load_lambda function in response to the transform_lambda function
 resource "aws_lambda_permission" "allow_transform_lambda" {
   action        = "lambda:InvokeFunction"
@@ -1,10 +1,19 @@
 import json
+from io import BytesIO
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import call, patch
 from extract_db import (extract_db_handler, extract_db_helper, load_env_var,
-                        VALID_TABLES)
+                        extract_table_to_s3, get_extract_options,
+                        VALID_TABLES, EXTRACT_OPTIONS)
 from extraction.extractor import Extractor
+from extraction.saver import Saver
 from extraction.monitor import Monitor
+from extraction.storer import Storer
+from shared.invoker import LocalInvoker
+from shared.resource_cache import resource_cache
+from shared.uploader import Uploader
+from transform import Transformer
+from moto import mock_s3
 import pytest
 import boto3
 import os
@@ -15,6 +24,12 @@ S3_TEST_BUCKET_NAME = f'''test-extraction-bucket-{
    int(datetime.now().timestamp())}'''
 
 
+@pytest.fixture(scope='function', autouse=True)
+def clear_resource_cache():
+    yield
+    resource_cache.clear()
+
+
 @pytest.fixture(scope='function')
 def info():
     os.environ['OI_STORER_INFO'] = f'''{{"s3_bucket_name":
@@ -88,11 +103,51 @@ def test_extracts_db_table_and_stores_file_in_s3(mock_tf_lambda, s3,
 
 @patch('extract_db.call_transform_lambda')
 @patch('extract_db.extract_db_helper')
-@patch('extract_db.Monitor.has_state_changed', return_value=True)
+@patch('extract_db.Monitor.save_state')
+@patch('extract_db.Monitor.get_changed_tables',
+       side_effect=lambda tables: tables)
 def test_extracts_all_db_tables_given_no_payload(
-        mock_monitor, mock_db_helper, mock_tf_lambda, info):
+        mock_monitor, mock_save_state, mock_db_helper, mock_tf_lambda, info):
+    extract_db_handler({}, None)
+    mock_db_helper.assert_called_once_with(VALID_TABLES, EXTRACT_OPTIONS)
+    mock_save_state.assert_called_once_with(VALID_TABLES)
+
+
+@patch('extract_db.call_transform_lambda')
+@patch('extract_db.extract_db_helper')
+@patch('extract_db.Monitor.save_state')
+@patch('extract_db.Monitor.get_changed_tables', return_value=['staff'])
+@patch('extract_db.Extractor')
+@patch('extract_db.retrieve_entry',
+       return_value='{"host": "", "port": "", "user": "",'
+       '"password": "", "database": ""}')
+def test_extracts_only_changed_tables(
+        mock_retrieve, mock_extractor, mock_monitor, mock_save_state,
+        mock_db_helper, mock_tf_lambda, info):
+    extract_db_handler({}, None)
+    mock_monitor.assert_called_once_with(VALID_TABLES)
+    mock_db_helper.assert_called_once_with(['staff'], EXTRACT_OPTIONS)
+    mock_save_state.assert_called_once_with(['staff'])
+    mock_tf_lambda.assert_called_once()
+    _, _, _, invoker = mock_tf_lambda.call_args.args
+    assert invoker.invocation_type == 'RequestResponse'
+
+
+@patch('extract_db.call_transform_lambda')
+@patch('extract_db.extract_db_helper')
+@patch('extract_db.Monitor.save_state')
+@patch('extract_db.Monitor.get_changed_tables', return_value=[])
+@patch('extract_db.Extractor')
+@patch('extract_db.retrieve_entry',
+       return_value='{"host": "", "port": "", "user": "",'
+       '"password": "", "database": ""}')
+def test_skips_extraction_if_no_table_changed(
+        mock_retrieve, mock_extractor, mock_monitor, mock_save_state,
+        mock_db_helper, mock_tf_lambda, info):
     extract_db_handler({}, None)
-    mock_db_helper.assert_called_once_with(VALID_TABLES)
+    mock_db_helper.assert_not_called()
+    mock_save_state.assert_not_called()
+    mock_tf_lambda.assert_not_called()
 
 
 @patch('extract_db.call_transform_lambda')
@@ -102,27 +157,50 @@ def test_extraction_runs_if_no_state_file_and_else_not(
     extract_db_handler({}, None)
     obj = s3.get_object(Bucket=S3_TEST_BUCKET_NAME, Key=Monitor.DB_STATE_KEY)
     test_stats = json.loads(obj['Body'].read())
-    for tup_key in test_stats:
-        assert test_stats[tup_key] >= 0
+    for table_stats in test_stats['tables'].values():
+        for tup_key in Monitor.STAT_KEYS:
+            assert table_stats[tup_key] >= 0
     # Re-run extraction lambda
     extract_db_handler({}, None)
     obj2 = s3.get_object(Bucket=S3_TEST_BUCKET_NAME, Key=Monitor.DB_STATE_KEY)
     test_stats2 = json.loads(obj2['Body'].read())
-    for tup_key in Monitor.STAT_KEYS:
-        assert test_stats2[tup_key] == test_stats[tup_key]
+    assert test_stats2['tables'] == test_stats['tables']
     assert test_stats2['retrieved_at'] >= test_stats['retrieved_at']
-    mock_db_helper.assert_called_once_with(VALID_TABLES)
+    mock_db_helper.assert_called_once_with(VALID_TABLES, EXTRACT_OPTIONS)
 
 
 @patch('extract_db.extract_db_helper')
-@patch('extraction.monitor.Monitor.has_state_changed', return_value=True)
+@patch('extraction.monitor.Monitor.save_state')
+@patch('extraction.monitor.Monitor.get_changed_tables',
+       return_value=VALID_TABLES)
 @patch('extract_db.call_transform_lambda')
 def test_extraction_calls_transformation_lambda_if_db_changed(
-        mock_call_tf_lambda, mock_monitor, mock_db_helper, info):
+        mock_call_tf_lambda, mock_monitor, mock_save_state, mock_db_helper,
+        info):
     extract_db_handler({}, None)
     mock_call_tf_lambda.assert_called_once()
 
 
+@patch.dict(os.environ, {'OI_TRANSFORM_LAMBDA_INFO': json.dumps(
+    {'transform_lambda_arn': 'ARN', 'invocation_type': 'Event'})})
+@patch('extract_db.extract_db_helper')
+@patch('extract_db.Monitor.save_state')
+@patch('extract_db.Monitor.get_changed_tables', return_value=['staff'])
+@patch('extract_db.Extractor')
+@patch('extract_db.retrieve_entry',
+       return_value='{"host": "", "port": "", "user": "",'
+       '"password": "", "database": ""}')
+def test_extraction_hands_off_to_transform_asynchronously(
+        mock_retrieve, mock_extractor, mock_monitor, mock_save_state,
+        mock_db_helper, info):
+    invoker = LocalInvoker(invocation_type='Event')
+    with patch('extract_db.LambdaInvoker.from_lambda_info',
+               return_value=invoker) as from_lambda_info:
+        extract_db_handler({}, None)
+    assert from_lambda_info.call_args.args[0]['invocation_type'] == 'Event'
+    assert invoker.calls == [('ARN', {})]
+
+
 @patch('extract_db.retrieve_entry',
        return_value='{"host": "", "port": "", "user": "",'
        '"password": "", "database": ""}')
@@ -156,7 +234,7 @@ def test_load_env_var_uses_secret_manager_if_is_secret_set_to_true(
 
     res_json = load_env_var(no_such_env_key, expected_keys, True)
 
-    mock_retrieve.assert_called_once_with(no_such_env_key)
+    mock_retrieve.assert_called_once_with(no_such_env_key, False)
     assert res_json == {"HELLO": "ORION", "WORLD": "INSIGHTS"}
 
 
@@ -166,3 +244,322 @@ def test_load_env_var_raises_error_if_env_var_contains_invalid_keys():
     os.environ[env_key] = '{"HELL":"ORION", "WOLD":"INSIGHTS"}'
     with pytest.raises(Exception, match='Error loading JSON for env var'):
         load_env_var(env_key, expected_keys)
+
+
+def test_get_extract_options_defaults_and_validates_types():
+    assert get_extract_options(None) == EXTRACT_OPTIONS
+    assert get_extract_options({'incremental': True})['incremental']
+    with pytest.raises(Exception, match="payload requires"):
+        get_extract_options({'incremental': 'yes'})
+    with pytest.raises(Exception, match="cannot be used"):
+        get_extract_options({'file_format': 'parquet', 'batch_size': 10})
+
+
+@patch('extract_db.storer')
+@patch('extract_db.saver')
+@patch('extract_db.monitor')
+@patch('extract_db.extractor')
+def test_incremental_extraction_stores_delta_and_saves_watermark(
+        mock_extractor, mock_monitor, mock_saver, mock_storer):
+    since = datetime(2023, 3, 1)
+    latest = datetime(2023, 3, 2, 10, 30, 0, 5)
+    mock_monitor.get_watermarks.return_value = {'payment': since}
+    mock_extractor.extract_payment.return_value = [
+        {'payment_id': 1, 'last_updated': latest}]
+    mock_extractor.get_watermark.side_effect = \
+        lambda data: Extractor.get_watermark(None, data)
+    extract_db_helper(['payment'], {**EXTRACT_OPTIONS, 'incremental': True})
+    mock_extractor.extract_payment.assert_called_once_with(since=since)
+    mock_storer.store_file.assert_called_once_with(
+        '/tmp/payment.csv', 'delta/payment/20230301000000000000')
+    mock_monitor.save_watermarks.assert_called_once_with({'payment': latest})
+
+
+@mock_s3
+@patch.dict(os.environ, {'AWS_DEFAULT_REGION': 'us-east-1',
+                         'AWS_ACCESS_KEY_ID': 'testing',
+                         'AWS_SECRET_ACCESS_KEY': 'testing'})
+@patch('extract_db.saver', Saver())
+@patch('extract_db.monitor')
+@patch('extract_db.extractor')
+def test_transform_merges_incremental_extractions_into_table(
+        mock_extractor, mock_monitor):
+    s3_client = boto3.client('s3')
+    s3_client.create_bucket(Bucket=S3_TEST_BUCKET_NAME)
+    for table in VALID_TABLES:
+        s3_client.put_object(Bucket=S3_TEST_BUCKET_NAME, Key=table, Body=b'')
+    s3_client.put_object(
+        Bucket=S3_TEST_BUCKET_NAME, Key='design',
+        Body=b'design_id,design_name,file_location,file_name\n'
+             b'1,Old,/a,a.json\n2,Old,/b,b.json\n')
+    watermarks = {'design': datetime(2023, 3, 1)}
+    mock_monitor.get_watermarks.side_effect = lambda: dict(watermarks)
+    mock_monitor.save_watermarks.side_effect = watermarks.update
+    mock_extractor.get_watermark.side_effect = \
+        lambda data: Extractor.get_watermark(None, data)
+    uploader = Uploader(s3_client=s3_client)
+    with patch('extract_db.storer', Storer(S3_TEST_BUCKET_NAME, uploader)):
+        for rows in [[(2, 'New', datetime(2023, 3, 2))],
+                     [(2, 'Newer', datetime(2023, 3, 3)),
+                      (3, 'Added', datetime(2023, 3, 3))]]:
+            mock_extractor.extract_design.return_value = [
+                {'design_id': design_id, 'design_name': design_name,
+                 'file_location': '/c', 'file_name': 'c.json',
+                 'last_updated': last_updated}
+                for design_id, design_name, last_updated in rows]
+            extract_db_helper(['design'],
+                              {**EXTRACT_OPTIONS, 'incremental': True})
+    transformer = Transformer(S3_TEST_BUCKET_NAME, 'processed',
+                              uploader=uploader)
+    transformer.list_csv_files()
+    df = transformer.transform_design(transformer.read_csv('design'))
+    assert df['design_id'].tolist() == [1, 2, 3]
+    assert df['design_name'].tolist() == ['Old', 'Newer', 'Added']
+    assert list(transformer.get_input_etags(['design'])) == [
+        'design', 'delta/design/20230301000000000000',
+        'delta/design/20230302000000000000']
+
+
+@mock_s3
+@patch.dict(os.environ, {'AWS_DEFAULT_REGION': 'us-east-1',
+                         'AWS_ACCESS_KEY_ID': 'testing',
+                         'AWS_SECRET_ACCESS_KEY': 'testing'})
+@patch('extract_db.saver', Saver())
+@patch('extract_db.monitor')
+@patch('extract_db.extractor')
+def test_full_extraction_deletes_deltas_older_than_it(
+        mock_extractor, mock_monitor):
+    s3_client = boto3.client('s3')
+    s3_client.create_bucket(Bucket=S3_TEST_BUCKET_NAME)
+    for table in VALID_TABLES:
+        s3_client.put_object(Bucket=S3_TEST_BUCKET_NAME, Key=table, Body=b'')
+    s3_client.put_object(
+        Bucket=S3_TEST_BUCKET_NAME, Key='delta/design/20230301000000000000',
+        Body=b'design_id,design_name,file_location,file_name\n'
+             b'1,Stale,/a,a.json\n')
+    s3_client.put_object(
+        Bucket=S3_TEST_BUCKET_NAME, Key='delta/staff/20230301000000000000',
+        Body=b'staff_id\n1\n')
+    mock_monitor.get_watermarks.return_value = {}
+    mock_extractor.get_watermark.side_effect = \
+        lambda data: Extractor.get_watermark(None, data)
+    mock_extractor.extract_design.return_value = [
+        {'design_id': 1, 'design_name': 'Fresh', 'file_location': '/a',
+         'file_name': 'a.json', 'last_updated': datetime(2023, 3, 2)}]
+    uploader = Uploader(s3_client=s3_client)
+    with patch('extract_db.storer', Storer(S3_TEST_BUCKET_NAME, uploader)):
+        extract_db_helper(['design'], EXTRACT_OPTIONS)
+    keys = [item['Key'] for item in s3_client.list_objects_v2(
+        Bucket=S3_TEST_BUCKET_NAME)['Contents']]
+    assert 'delta/design/20230301000000000000' not in keys
+    assert 'delta/staff/20230301000000000000' in keys
+    transformer = Transformer(S3_TEST_BUCKET_NAME, 'processed',
+                              uploader=uploader)
+    transformer.list_csv_files()
+    df = transformer.read_csv('design')
+    assert df['design_name'].tolist() == ['Fresh']
+
+
+@patch('extract_db.storer')
+@patch('extract_db.saver')
+@patch('extract_db.monitor')
+@patch('extract_db.extractor')
+def test_incremental_extraction_skips_tables_without_new_data(
+        mock_extractor, mock_monitor, mock_saver, mock_storer):
+    since = datetime(2023, 3, 1)
+    mock_monitor.get_watermarks.return_value = {'payment': since}
+    mock_extractor.extract_payment.return_value = []
+    extract_db_helper(['payment'], {**EXTRACT_OPTIONS, 'incremental': True})
+    mock_storer.store_file.assert_not_called()
+    mock_monitor.save_watermarks.assert_called_once_with({'payment': since})
+
+
+@patch('extract_db.storer')
+@patch('extract_db.saver')
+@patch('extract_db.extractor')
+def test_streamed_extraction_appends_batches_to_one_file(
+        mock_extractor, mock_saver, mock_storer):
+    batches = [[{'design_id': 1}, {'design_id': 2}], [{'design_id': 3}]]
+    mock_extractor.stream_table.return_value = iter(batches)
+    extract_db_helper(['design'], {**EXTRACT_OPTIONS, 'batch_size': 2})
+    mock_extractor.stream_table.assert_called_once_with('design', 2, None)
+    assert mock_saver.save_data.call_args_list == [
+        call(batches[0], '/tmp/design.csv', append=False,
+             file_format='csv', schema=None),
+        call(batches[1], '/tmp/design.csv', append=True,
+             file_format='csv', schema=None)]
+    mock_storer.store_file.assert_called_once_with('/tmp/design.csv',
+                                                   'design')
+
+
+@patch('extract_db.storer')
+@patch('extract_db.saver')
+@patch('extract_db.extractor')
+def test_copy_extraction_writes_file_without_saver(
+        mock_extractor, mock_saver, mock_storer, downloaded_file):
+    table_name, file_name = downloaded_file
+
+    def copy_table(table, stream, since, until):
+        stream.write(f'{table}_id\n1\n'.encode('utf-8'))
+        return 1
+
+    mock_extractor.copy_table.side_effect = copy_table
+    extract_db_helper([table_name],
+                      {**EXTRACT_OPTIONS, 'copy_tables': [table_name]})
+    mock_saver.save_data.assert_not_called()
+    mock_storer.store_file.assert_called_once_with(file_name, table_name)
+    with open(file_name, 'r', encoding='utf-8') as f:
+        assert f.read() == f'{table_name}_id\n1\n'
+
+
+@patch('extract_db.db_info', {})
+@patch('extract_db.Extractor')
+@patch('extract_db.storer')
+@patch('extract_db.saver')
+@patch('extract_db.extractor')
+def test_concurrent_extraction_reports_failed_tables_in_order(
+        mock_extractor, mock_saver, mock_storer, mock_extractor_class):
+    worker_extractor = mock_extractor_class.return_value
+    for table_extractor in (mock_extractor, worker_extractor):
+        table_extractor.extract_payment.side_effect = Exception('PAYMENT')
+        table_extractor.extract_address.side_effect = Exception('ADDRESS')
+        table_extractor.extract_design.return_value = [{'design_id': 1}]
+        table_extractor.extract_staff.return_value = [{'staff_id': 1}]
+    with pytest.raises(Exception) as e:
+        extract_db_helper(['payment', 'design', 'address', 'staff'],
+                          {**EXTRACT_OPTIONS, 'concurrency': 3})
+    assert str(e.value) == ('Could not extract tables: '
+                            'payment (PAYMENT), address (ADDRESS)')
+    assert sorted(args[1] for args, _ in
+                  mock_storer.store_file.call_args_list) == ['design',
+                                                             'staff']
+    assert mock_extractor_class.call_count <= 2
+    assert worker_extractor.close.call_count == \
+        mock_extractor_class.call_count
+
+
+@patch('extract_db.storer')
+@patch('extract_db.saver')
+@patch('extract_db.extractor')
+def test_columnar_streamed_extraction_tracks_watermark(
+        mock_extractor, mock_saver, mock_storer):
+    with patch.object(Extractor, 'create_connection'):
+        extractor = Extractor('USER', 'PASSWORD', 'HOST', 'PORT', 'DB')
+    extractor.columnar = True
+    batch = extractor.create_rows(['design_id', 'last_updated'],
+                                  [[1, datetime(2023, 1, 1)],
+                                   [2, datetime(2023, 1, 2)],
+                                   [3, datetime(2023, 1, 3)]])
+    mock_extractor.stream_table.return_value = iter([batch])
+    mock_extractor.get_watermark.side_effect = extractor.get_watermark
+    watermark = extract_table_to_s3(
+        mock_extractor, 'design', datetime(2022, 12, 31),
+        {**EXTRACT_OPTIONS, 'incremental': True, 'batch_size': 5,
+         'columnar': True})
+    assert watermark == datetime(2023, 1, 3)
+    mock_saver.save_data.assert_called_once_with(
+        batch, '/tmp/design.csv', append=False, file_format='csv',
+        schema=None)
+
+
+@patch('extract_db.storer')
+@patch('extract_db.saver')
+@patch('extract_db.extractor')
+def test_parquet_extraction_saves_with_table_schema(
+        mock_extractor, mock_saver, mock_storer):
+    data = [{'currency_id': 1, 'currency_code': 'GBP'}]
+    schema = {'currency_id': 'integer', 'currency_code': 'character varying'}
+    mock_extractor.extract_currency.return_value = data
+    mock_extractor.extract_schema.return_value = schema
+    extract_db_helper(['currency'],
+                      {**EXTRACT_OPTIONS, 'file_format': 'parquet'})
+    mock_extractor.extract_schema.assert_called_once_with('currency')
+    mock_saver.save_data.assert_called_once_with(
+        data, '/tmp/currency.parquet', append=False, file_format='parquet',
+        schema=schema)
+    mock_storer.store_file.assert_called_once_with('/tmp/currency.parquet',
+                                                   'currency')
+
+
+@patch('extract_db.storer')
+@patch('extract_db.saver', Saver())
+@patch('extract_db.extractor')
+def test_in_memory_extraction_uploads_chunks_without_files(
+        mock_extractor, mock_storer):
+    batches = [[{'design_id': 1}, {'design_id': 2}], [{'design_id': 3}]]
+    mock_extractor.stream_table.return_value = iter(batches)
+    uploaded = []
+    mock_storer.store_chunks.side_effect = \
+        lambda chunks, key: uploaded.extend(chunks) or True
+    extract_db_helper(['design'], {**EXTRACT_OPTIONS, 'batch_size': 2,
+                                   'in_memory': True})
+    mock_storer.store_chunks.assert_called_once()
+    assert mock_storer.store_chunks.call_args.args[1] == 'design'
+    assert b''.join(uploaded) == b'design_id\n1\n2\n3\n'
+    mock_storer.store_file.assert_not_called()
+
+
+@patch('extract_db.storer')
+@patch('extract_db.saver')
+@patch('extract_db.extractor')
+def test_in_memory_copy_extraction_streams_to_upload(
+        mock_extractor, mock_saver, mock_storer):
+    def copy_table(table, stream, since, until):
+        stream.write(f'{table}_id\n'.encode('utf-8'))
+        stream.write(b'1\n')
+        return 1
+
+    uploaded = BytesIO()
+    mock_extractor.copy_table.side_effect = copy_table
+    mock_storer.store_stream.side_effect = \
+        lambda write, key: write(uploaded)
+    extract_db_helper(['staff'], {**EXTRACT_OPTIONS, 'copy_tables': ['staff'],
+                                  'in_memory': True})
+    mock_storer.store_stream.assert_called_once()
+    assert mock_storer.store_stream.call_args.args[1] == 'staff'
+    assert uploaded.getvalue() == b'staff_id\n1\n'
+    mock_saver.save_data.assert_not_called()
+    mock_storer.store_file.assert_not_called()
+
+
+@patch('extract_db.call_transform_lambda')
+@patch('extract_db.Monitor.get_changed_tables', return_value=[])
+@patch('extract_db.Extractor')
+@patch('extract_db.retrieve_entry',
+       return_value='{"host": "", "port": "", "user": "",'
+       '"password": "", "database": ""}')
+def test_reuses_extractor_across_invocations_until_error(
+        mock_retrieve, mock_extractor, mock_monitor, mock_tf_lambda, info):
+    extract_db_handler({}, None)
+    extract_db_handler({}, None)
+    mock_extractor.assert_called_once()
+    mock_extractor.close.assert_not_called()
+    mock_monitor.side_effect = Exception('CONNECTION LOST')
+    with pytest.raises(Exception, match='CONNECTION LOST'):
+        extract_db_handler({}, None)
+    mock_extractor.close.assert_called_once_with(
+        mock_extractor.return_value)
+    mock_monitor.side_effect = None
+    extract_db_handler({}, None)
+    assert mock_extractor.call_count == 2
+
+
+@patch.dict(os.environ)
+@patch('extract_db.call_transform_lambda')
+@patch('extract_db.Monitor.get_changed_tables', return_value=[])
+@patch('extract_db.Extractor')
+@patch('extract_db.retrieve_entry',
+       side_effect=['{"host": "", "port": "", "user": "",'
+                    '"password": "OLD", "database": ""}',
+                    '{"host": "", "port": "", "user": "",'
+                    '"password": "NEW", "database": ""}'])
+def test_refreshes_db_credentials_on_authentication_failure(
+        mock_retrieve, mock_extractor, mock_monitor, mock_tf_lambda, info):
+    os.environ.pop('OI_TOTESYS_DB_INFO', None)
+    mock_extractor.side_effect = [
+        Exception({'C': '28P01', 'M': 'password authentication failed'}),
+        mock_extractor.return_value]
+    extract_db_handler({}, None)
+    assert mock_retrieve.call_args_list == [
+        call('OI_TOTESYS_DB_INFO', False), call('OI_TOTESYS_DB_INFO', True)]
+    assert mock_extractor.call_args.kwargs['password'] == 'NEW'
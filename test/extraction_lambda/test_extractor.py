@@ -1,3 +1,8 @@
+from datetime import datetime
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+import pandas as pd
+from pandas.testing import assert_frame_equal
 from secret_manager.retrieve_entry import retrieve_entry
 from extraction.extractor import Extractor
 import pytest
@@ -13,6 +18,17 @@ def extractor():
     return Extractor(**json.loads(creds))
 
 
+@pytest.fixture(scope='function')
+@patch.object(Extractor, 'create_connection')
+def mock_conn_extractor(mock_conn):
+    creds = {"host": "HOST", "port": "PORT", "user": "USER",
+             "password": "PASSWORD", "database": "DB"}
+    extractor = Extractor(**creds)
+    extractor.conn = MagicMock()
+    extractor.conn.columns = [{'name': 'design_id'}, {'name': 'design_name'}]
+    return extractor
+
+
 def test_connect_to_the_Totesys_database(extractor):
     assert len(extractor.conn.run("SELECT * FROM design")) > 0
 
@@ -92,3 +108,71 @@ def test_extract_db_stats(extractor):
     assert set(extractor.extract_db_stats().keys()) == {
         "tup_inserted", "tup_updated", "tup_deleted"
         }
+
+
+def test_stream_table_yields_batches_from_server_side_cursor(
+        mock_conn_extractor):
+    conn = mock_conn_extractor.conn
+    conn.run.side_effect = [None, None, [[1, 'a'], [2, 'b']], [[3, 'c']],
+                            [], None]
+    batches = list(mock_conn_extractor.stream_table('design', 2))
+    assert batches == [
+        [{'design_id': 1, 'design_name': 'a'},
+         {'design_id': 2, 'design_name': 'b'}],
+        [{'design_id': 3, 'design_name': 'c'}]]
+    statements = [args[0] for args, _ in conn.run.call_args_list]
+    assert statements[0] == 'START TRANSACTION'
+    assert statements[1].startswith('DECLARE design_cursor NO SCROLL CURSOR')
+    assert statements[2] == 'FETCH FORWARD 2 FROM design_cursor'
+    assert statements[-1] == 'ROLLBACK'
+
+
+def test_copy_table_writes_csv_to_stream(extractor):
+    stream = BytesIO()
+    row_count = extractor.copy_table('payment', stream)
+    lines = stream.getvalue().decode('utf-8').splitlines()
+    assert lines[0].split(',') == [
+        "payment_id", "created_at", "last_updated", "transaction_id",
+        "counterparty_id", "payment_amount", "currency_id",
+        "payment_type_id", "paid", "payment_date", "company_ac_number",
+        "counterparty_ac_number"]
+    assert len(lines) == row_count + 1
+    assert lines[1].split(',')[8] in ('True', 'False')
+
+
+def test_copy_table_limits_rows_to_watermark_range(mock_conn_extractor):
+    conn = mock_conn_extractor.conn
+    conn.row_count = 3
+    stream = BytesIO()
+    assert mock_conn_extractor.copy_table(
+        'design', stream, datetime(2023, 1, 1), datetime(2023, 2, 1)) == 3
+    (sql,), kwargs = conn.run.call_args
+    assert sql.startswith('COPY (SELECT design_id')
+    assert ("WHERE last_updated > '2023-01-01T00:00:00' "
+            "AND last_updated <= '2023-02-01T00:00:00'") in sql
+    assert sql.endswith('TO STDOUT WITH (FORMAT CSV, HEADER)')
+    assert kwargs == {'stream': stream}
+
+
+def test_create_data_frame_builds_columns_from_rows(mock_conn_extractor):
+    assert_frame_equal(
+        mock_conn_extractor.create_data_frame(
+            ['design_id', 'design_name'], [[1, 'a'], [2, 'b']]),
+        pd.DataFrame({'design_id': [1, 2], 'design_name': ['a', 'b']}))
+
+
+def test_columnar_extractor_returns_data_frame(mock_conn_extractor):
+    mock_conn_extractor.columnar = True
+    mock_conn_extractor.conn.run.return_value = [[1, 'a'], [2, 'b']]
+    data = mock_conn_extractor.extract_design()
+    assert isinstance(data, pd.DataFrame)
+    assert data.shape == (2, 2)
+
+
+def test_extract_table_stats_returns_counters_of_extracted_tables(
+        mock_conn_extractor):
+    mock_conn_extractor.conn.run.return_value = [['staff', 4, 2, 1],
+                                                 ['_prisma_migrations', 1,
+                                                  0, 0]]
+    assert mock_conn_extractor.extract_table_stats() == {
+        'staff': {'n_tup_ins': 4, 'n_tup_upd': 2, 'n_tup_del': 1}}
@@ -1,4 +1,5 @@
 import json
+from datetime import datetime
 from unittest.mock import patch
 from extraction.monitor import Monitor
 import pytest
@@ -54,16 +55,19 @@ def monitor(extractor):
     return Monitor(S3_TEST_BUCKET_NAME, extractor)
 
 
-@patch('extraction.extractor.Extractor.extract_db_stats',
-       return_value={"tup_deleted": 2, "tup_updated": 1, "tup_inserted": 0})
+def table_stats(inserted=0, updated=0, deleted=0):
+    return {'n_tup_ins': inserted, 'n_tup_upd': updated, 'n_tup_del': deleted}
+
+
+@patch('extraction.extractor.Extractor.extract_table_stats',
+       return_value={'staff': table_stats(2, 1, 0)})
 def test_get_db_stats_updates_current_state(m, monitor):
     monitor.get_db_stats()
-    assert set(monitor.new_state.keys()) == {
-        "tup_inserted", "tup_updated", "tup_deleted"}
+    assert monitor.new_state == {'tables': {'staff': table_stats(2, 1, 0)}}
 
 
 def test_get_current_state_returns_1_if_key_exists(s3, monitor):
-    db_state = {"tup_deleted": 0, "tup_updated": 0, "tup_inserted": 0}
+    db_state = {'tables': {'staff': table_stats()}}
     s3.put_object(Bucket=S3_TEST_BUCKET_NAME,
                   Body=json.dumps(db_state), Key=Monitor.DB_STATE_KEY)
     assert monitor.get_current_state() == 1
@@ -74,8 +78,17 @@ def test_get_current_state_returns_minus_1_if_s3_key_does_not_exist(s3,
     assert monitor.get_current_state() == -1
 
 
+def test_get_current_state_returns_minus_1_if_no_table_counters(s3,
+                                                                monitor):
+    db_state = {"tup_deleted": 0, "tup_updated": 0, "tup_inserted": 0}
+    s3.put_object(Bucket=S3_TEST_BUCKET_NAME,
+                  Body=json.dumps(db_state), Key=Monitor.DB_STATE_KEY)
+    assert monitor.get_current_state() == -1
+
+
 def test_get_current_state_returns_0_if_stats_json_mispelt_key(s3, monitor):
-    db_state = {"tup_delete": 0, "tup_update": 0, "tup_inserted": 0}
+    db_state = {'tables': {'staff': {"n_tup_in": 0, "n_tup_upd": 0,
+                                     "n_tup_del": 0}}}
     s3.put_object(Bucket=S3_TEST_BUCKET_NAME,
                   Body=json.dumps(db_state), Key=Monitor.DB_STATE_KEY)
     with pytest.raises(Exception, match="S3 object db_state has missing"):
@@ -83,7 +96,8 @@ def test_get_current_state_returns_0_if_stats_json_mispelt_key(s3, monitor):
 
 
 def test_get_current_state_returns_0_if_stats_json_non_int_values(s3, monitor):
-    db_state = {"tup_deleted": 0, "tup_updated": '0', "tup_inserted": 0}
+    db_state = {'tables': {'staff': {"n_tup_ins": 0, "n_tup_upd": '0',
+                                     "n_tup_del": 0}}}
     s3.put_object(Bucket=S3_TEST_BUCKET_NAME,
                   Body=json.dumps(db_state), Key=Monitor.DB_STATE_KEY)
     with pytest.raises(Exception, match="S3 object db_state has missing"):
@@ -91,7 +105,7 @@ def test_get_current_state_returns_0_if_stats_json_non_int_values(s3, monitor):
 
 
 def test_get_current_state_returns_0_if_stats_json_missing_key(s3, monitor):
-    db_state = {"tup_deleted": 0, "tup_updated": 0}
+    db_state = {'tables': {'staff': {"n_tup_ins": 0, "n_tup_upd": 0}}}
     s3.put_object(Bucket=S3_TEST_BUCKET_NAME,
                   Body=json.dumps(db_state), Key=Monitor.DB_STATE_KEY)
     with pytest.raises(Exception, match="S3 object db_state has missing"):
@@ -110,8 +124,7 @@ def test_save_state_saves_new_state_to_s3_bucket(s3, monitor):
 
         mock_timestamp.return_value = 1679878923.000004
 
-        monitor.new_state = {"tup_deleted": 2,
-                             "tup_updated": 1, "tup_inserted": 2}
+        monitor.new_state = {'tables': {'staff': table_stats(2, 1, 2)}}
         monitor.save_state()
         obj = s3.get_object(Bucket=S3_TEST_BUCKET_NAME,
                             Key=Monitor.DB_STATE_KEY)
@@ -121,35 +134,69 @@ def test_save_state_saves_new_state_to_s3_bucket(s3, monitor):
         assert test_stats['retrieved_at'] == 1679878923.000004
 
 
+def test_save_state_only_updates_given_tables(s3, monitor):
+    monitor.current_state = {'tables': {'staff': table_stats(1),
+                                        'design': table_stats(1)}}
+    monitor.new_state = {'tables': {'staff': table_stats(2),
+                                    'design': table_stats(2),
+                                    'currency': table_stats(2)}}
+    monitor.save_state(['staff'])
+    obj = s3.get_object(Bucket=S3_TEST_BUCKET_NAME, Key=Monitor.DB_STATE_KEY)
+    assert json.loads(obj['Body'].read())['tables'] == {
+        'staff': table_stats(2), 'design': table_stats(1)}
+
+
 @patch("extraction.monitor.Monitor.get_db_stats")
 @patch("extraction.monitor.Monitor.get_current_state", return_value=1)
-def test_has_state_changed_returns_true_if_state_changed(a, b, s3, monitor):
-    monitor.new_state = {"tup_deleted": 1, "tup_updated": 3, "tup_inserted": 0}
-    monitor.current_state = {"tup_deleted": 1,
-                             "tup_updated": 3, "tup_inserted": 12,
+def test_get_changed_tables_returns_tables_with_changed_counters(
+        a, b, s3, monitor):
+    monitor.new_state = {'tables': {'staff': table_stats(1, 3, 0),
+                                    'design': table_stats(1, 3, 0),
+                                    'currency': table_stats(1, 3, 1)}}
+    monitor.current_state = {'tables': {'staff': table_stats(1, 3, 0),
+                                        'design': table_stats(2, 3, 0),
+                                        'currency': table_stats(1, 3, 0)},
                              'retrieved_at': 12345}
-    assert monitor.has_state_changed()
+    assert monitor.get_changed_tables(
+        ['currency', 'design', 'staff', 'payment']) == [
+            'currency', 'design', 'payment']
 
 
 @patch("extraction.monitor.Monitor.get_db_stats")
-@patch("extraction.monitor.Monitor.get_current_state")
-def test_has_state_changed_returns_false_if_state_not_changed(a, b, s3,
-                                                              monitor):
-    monitor.new_state = {"tup_deleted": 1, "tup_updated": 3, "tup_inserted": 4}
-    monitor.current_state = {"tup_deleted": 1,
-                             "tup_updated": 3, "tup_inserted": 4,
+@patch("extraction.monitor.Monitor.get_current_state", return_value=1)
+def test_get_changed_tables_returns_no_tables_if_state_not_changed(
+        a, b, s3, monitor):
+    monitor.new_state = {'tables': {'staff': table_stats(1, 3, 4)}}
+    monitor.current_state = {'tables': {'staff': table_stats(1, 3, 4)},
                              'retrieved_at': 12345}
-    assert not monitor.has_state_changed()
+    assert monitor.get_changed_tables(['staff']) == []
 
 
 @patch("extraction.monitor.Monitor.get_db_stats")
-def test_has_state_changed_is_true_if_no_state_file_and_creates_it(a, s3,
-                                                                   monitor):
-    monitor.new_state = {"tup_deleted": 1, "tup_updated": 3, "tup_inserted": 4}
-    monitor.has_state_changed()
+def test_get_changed_tables_returns_all_tables_if_no_state_file(a, s3,
+                                                                monitor):
+    monitor.new_state = {'tables': {'staff': table_stats(1, 3, 4)}}
+    assert monitor.get_changed_tables(['staff', 'design']) == [
+        'staff', 'design']
+    monitor.save_state(['staff'])
     obj = s3.get_object(Bucket=S3_TEST_BUCKET_NAME, Key=Monitor.DB_STATE_KEY)
     test_stats = json.loads(obj['Body'].read())
-    assert test_stats['tup_deleted'] == 1
-    assert test_stats['tup_updated'] == 3
-    assert test_stats['tup_inserted'] == 4
+    assert test_stats['tables'] == {'staff': table_stats(1, 3, 4)}
     assert 'retrieved_at' in test_stats
+
+
+def test_get_watermarks_returns_empty_dict_if_no_watermarks_file(s3,
+                                                                 monitor):
+    assert monitor.get_watermarks() == {}
+
+
+def test_save_watermarks_saves_watermarks_to_s3_bucket(s3, monitor):
+    watermarks = {'address': datetime(2023, 3, 1, 12, 30, 0, 123000),
+                  'payment': datetime(2023, 3, 2)}
+    monitor.save_watermarks(watermarks)
+    obj = s3.get_object(Bucket=S3_TEST_BUCKET_NAME,
+                        Key=Monitor.WATERMARKS_KEY)
+    assert json.loads(obj['Body'].read()) == {
+        'address': '2023-03-01T12:30:00.123000',
+        'payment': '2023-03-02T00:00:00'}
+    assert monitor.get_watermarks() == watermarks
@@ -1,6 +1,10 @@
+from datetime import date, datetime
+from decimal import Decimal
+import gzip
 from pathlib import Path
 from unittest.mock import patch
 import pytest
+import pandas as pd
 from secret_manager.retrieve_entry import retrieve_entry
 from extraction.saver import Saver
 from extraction.extractor import Extractor
@@ -67,3 +71,80 @@ def test_returns_false_given_invalid_arguments(saver):
     assert not saver.save_data(None, 'file.txt')
     assert not saver.save_data([{'a': 12}], None)
     assert not saver.save_data([{'a': 12}], '')
+
+
+def test_save_data_appends_without_repeating_header(saver, test_file):
+    assert saver.save_data([{'a': 1, 'b': 2}], test_file)
+    assert saver.save_data([{'a': 3, 'b': 4}], test_file, append=True)
+    with open(test_file, 'r', encoding='utf-8') as f:
+        assert f.read().splitlines() == ['a,b', '1,2', '3,4']
+
+
+def test_save_data_saves_data_frame(saver, test_file):
+    assert saver.save_data(pd.DataFrame({'a': [1, 3], 'b': [2, 4]}),
+                           test_file)
+    with open(test_file, 'r', encoding='utf-8') as f:
+        assert f.read().splitlines() == ['a,b', '1,2', '3,4']
+    assert not saver.save_data(pd.DataFrame(), test_file)
+
+
+def test_save_data_saves_parquet_with_schema_dtypes(saver, test_file):
+    data = [{'payment_id': 1, 'payment_amount': Decimal('2.43'),
+             'paid': True, 'created_at': datetime(2022, 11, 3, 14, 20),
+             'transaction_id': None}]
+    schema = {'payment_id': 'integer', 'payment_amount': 'numeric',
+              'paid': 'boolean', 'created_at': 'timestamp without time zone',
+              'transaction_id': 'integer', 'unknown': 'uuid'}
+    assert saver.save_data(data, test_file, file_format='parquet',
+                           schema=schema)
+    assert not saver.save_data(data, test_file, append=True,
+                               file_format='parquet', schema=schema)
+    df = pd.read_parquet(test_file)
+    assert len(df) == 1
+    assert df.dtypes.drop('payment_amount').to_dict() == {
+        'payment_id': 'Int64', 'paid': 'boolean',
+        'created_at': 'datetime64[ns]', 'transaction_id': 'Int64'}
+    assert float(df['payment_amount'][0]) == 2.43
+
+
+def test_save_data_keeps_numerics_as_decimals_and_dates_as_dates(
+        saver, test_file):
+    pq = pytest.importorskip('pyarrow.parquet')
+    data = [{'payment_amount': Decimal('2.43'),
+             'payment_date': date(2022, 11, 3)},
+            {'payment_amount': Decimal('10.50'), 'payment_date': None}]
+    schema = {'payment_amount': 'numeric', 'payment_date': 'date'}
+    assert saver.save_data(data, test_file, file_format='parquet',
+                           schema=schema)
+    table = pq.read_table(test_file)
+    assert str(table.schema.field('payment_amount').type) == \
+        'decimal128(4, 2)'
+    assert str(table.schema.field('payment_date').type) == 'date32[day]'
+    assert table.to_pylist() == [
+        {'payment_amount': Decimal('2.43'),
+         'payment_date': date(2022, 11, 3)},
+        {'payment_amount': Decimal('10.50'), 'payment_date': None}]
+
+
+def test_save_data_saves_gzip_compressed_csv(saver, test_file):
+    assert saver.save_data([{'a': 1, 'b': 2}], test_file,
+                           file_format='csv.gz')
+    assert saver.save_data([{'a': 3, 'b': 4}], test_file, append=True,
+                           file_format='csv.gz')
+    with gzip.open(test_file, 'rt', encoding='utf-8') as f:
+        assert f.read().splitlines() == ['a,b', '1,2', '3,4']
+
+
+def test_returns_false_given_invalid_file_format(saver, test_file):
+    assert not saver.save_data([{'a': 1}], test_file, file_format='xlsx')
+
+
+def test_to_bytes_serialises_concatenable_chunks(saver):
+    first = saver.to_bytes([{'a': 1, 'b': 2}], 'csv.gz')
+    second = saver.to_bytes([{'a': 3, 'b': 4}], 'csv.gz', header=False)
+    assert gzip.decompress(first + second).decode().splitlines() == [
+        'a,b', '1,2', '3,4']
+    parquet = saver.to_bytes([{'a': 1}], 'parquet', schema={'a': 'integer'})
+    assert parquet[:4] == b'PAR1'
+    assert saver.to_bytes([{'a': 1}], 'xlsx') is None
+    assert saver.to_bytes([], 'csv') is None
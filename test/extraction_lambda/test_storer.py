@@ -95,3 +95,41 @@ def test_returns_false_given_invalid_arguments(storer):
     assert not storer.store_file('', 'KEY')
     assert not storer.store_file('file.txt', '')
     assert not storer.store_file('file.txt', None)
+
+
+def test_stores_buffer_into_s3_bucket(s3, storer):
+    assert storer.store_buffer(b'a,b\n1,2\n', 'buffer.csv')
+    obj = s3.get_object(Bucket=S3_TEST_BUCKET_NAME, Key='buffer.csv')
+    assert obj['Body'].read() == b'a,b\n1,2\n'
+    assert not storer.store_buffer('NOT BYTES', 'buffer.csv')
+    assert not storer.store_buffer(b'a,b\n', '')
+
+
+def test_stores_small_chunks_as_single_object(s3, storer):
+    assert storer.store_chunks(iter([b'a,b\n', b'1,2\n']), 'chunks.csv')
+    obj = s3.get_object(Bucket=S3_TEST_BUCKET_NAME, Key='chunks.csv')
+    assert obj['Body'].read() == b'a,b\n1,2\n'
+
+
+def test_stores_large_chunks_with_multipart_upload(s3, storer):
+    chunk = b'x' * (3 * 1024 * 1024)
+    assert storer.store_chunks(iter([chunk] * 5), 'large.csv')
+    obj = s3.get_object(Bucket=S3_TEST_BUCKET_NAME, Key='large.csv')
+    assert obj['Body'].read() == chunk * 5
+    assert '-' in obj['ETag']
+
+
+def test_store_chunks_aborts_upload_on_error(s3, storer):
+    def chunks():
+        yield b'x' * storer.uploader.multipart_chunksize
+        raise Exception('CHUNK ERROR')
+
+    assert not storer.store_chunks(chunks(), 'failed.csv')
+    assert 'Uploads' not in s3.list_multipart_uploads(
+        Bucket=S3_TEST_BUCKET_NAME)
+    assert 'Contents' not in s3.list_objects_v2(Bucket=S3_TEST_BUCKET_NAME)
+
+
+def test_store_chunks_uploads_nothing_without_chunks(s3, storer):
+    assert storer.store_chunks(iter([]), 'empty.csv')
+    assert 'Contents' not in s3.list_objects_v2(Bucket=S3_TEST_BUCKET_NAME)
@@ -1,12 +1,15 @@
 from pathlib import Path
 from moto import mock_s3
 import boto3
-from datetime import datetime
+from datetime import date, datetime, time
 import os
 import json
 import pandas as pd
 import pytest
-from src.load_lambda.load import Loader, loader_handler
+from unittest.mock import MagicMock, patch
+from src.load_lambda.load import (Loader, loader_handler, get_load_options,
+                                  LOAD_OPTIONS, load_tables_concurrently,
+                                  load_tables)
 from pandas.testing import assert_frame_equal
 from sqlalchemy import create_engine, text
 
@@ -79,6 +82,23 @@ def address_loader(s3):
     loader.close()
 
 
+@pytest.fixture(scope='function')
+def dw_loader(s3):
+    loader = Loader(PROCESSED_BUCKET_NAME)
+    loader.connect_db(**json.loads(os.environ.get('OI_TOTESYS_DW_INFO')))
+    for table in list(Loader.FILE_LIST.values())[::-1]:
+        loader.delete_table(table)
+    yield loader
+    for table in list(Loader.FILE_LIST.values())[::-1]:
+        loader.delete_table(table)
+    loader.close()
+
+
+def fetch(loader, sql, params=None):
+    with loader.engine.begin() as conn:
+        return conn.execute(text(sql), params or {}).fetchall()
+
+
 @pytest.fixture(scope='module')
 def all_loader(s3_mod):
     loader = Loader(PROCESSED_BUCKET_NAME)
@@ -149,3 +169,373 @@ def test_loader_handler(all_loader, table_info):
         res = conn.execute(text(f'SELECT * FROM {table_name}'))
         rows = res.fetchall()
     assert len(rows) == expected_row_count
+
+
+def test_get_load_options_defaults_and_validates_types():
+    assert get_load_options({}) == LOAD_OPTIONS
+    assert get_load_options({'to_sql_tables': ['date']})['to_sql_tables'] \
+        == ['date']
+    with pytest.raises(Exception, match='payload requires'):
+        get_load_options({'chunk_size': '100'})
+    with pytest.raises(Exception, match='must be positive'):
+        get_load_options({'chunk_size': 0})
+    with pytest.raises(Exception, match='must be positive'):
+        get_load_options({'concurrency': 0})
+    with pytest.raises(Exception, match="'changed_tables' must contain"):
+        get_load_options({'changed_tables': ['dim_staff']})
+    with pytest.raises(Exception, match='must be one of'):
+        get_load_options({'load_mode': 'merge'})
+
+
+def test_write_to_dw_falls_back_to_to_sql_without_copy(aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME)
+    loader.engine = create_engine('sqlite:///test.db')
+    df = pd.DataFrame({'a': [1, 2], 'b': ['x', None]})
+    try:
+        loader.write_to_dw('copy_test', df, use_copy=True)
+        with loader.engine.connect() as conn:
+            rows = conn.execute(text('SELECT * FROM copy_test')).fetchall()
+        assert [tuple(row) for row in rows] == [(1, 'x'), (2, None)]
+    finally:
+        loader.engine.dispose()
+        Path(TEST_DB).unlink()
+
+
+def mock_postgres_engine():
+    engine = MagicMock()
+    engine.dialect.name = 'postgresql'
+    engine.dialect.driver = 'pg8000'
+    engine.dialect.identifier_preparer.quote = lambda name: f'"{name}"'
+    return engine
+
+
+def test_copy_to_dw_streams_csv_chunks(aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME, chunk_size=2)
+    loader.engine = mock_postgres_engine()
+    raw_conn = loader.engine.raw_connection.return_value
+    cursor = raw_conn.cursor.return_value
+    copied = []
+    cursor.execute.side_effect = \
+        lambda sql, stream: copied.extend([sql, *stream])
+    df = pd.DataFrame({'id': [1.0, 2.0, None], 'name': ['a', '', None]})
+    loader.write_to_dw('dim_test', df, use_copy=True)
+    assert copied == [
+        'COPY "dim_test" ("id", "name") FROM STDIN '
+        "WITH (FORMAT CSV, NULL '\\N')",
+        '1,a\n2,\n', '\\N,\\N\n']
+    raw_conn.commit.assert_called_once()
+    raw_conn.close.assert_called_once()
+
+
+def test_upsert_to_dw_merges_dimension_on_conflict(aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME, load_mode='upsert')
+    loader.engine = mock_postgres_engine()
+    raw_conn = loader.engine.raw_connection.return_value
+    cursor = raw_conn.cursor.return_value
+    cursor.rowcount = 1
+    df = pd.DataFrame({'currency_id': [1], 'currency_code': ['GBP'],
+                       'currency_name': ['British pound']})
+    assert loader.upsert_to_dw('dim_currency', df) == 1
+    statements = [args[0] for args, _ in cursor.execute.call_args_list]
+    assert statements[0] == (
+        'CREATE TEMP TABLE "stage_dim_currency" ON COMMIT DROP AS SELECT '
+        '"currency_id", "currency_code", "currency_name" '
+        'FROM "dim_currency" WITH NO DATA')
+    assert statements[1].startswith('COPY "stage_dim_currency"')
+    assert statements[2] == (
+        'INSERT INTO "dim_currency" AS t ("currency_id", "currency_code", '
+        '"currency_name") SELECT "currency_id", "currency_code", '
+        '"currency_name" FROM "stage_dim_currency" AS s '
+        'ON CONFLICT ("currency_id") DO UPDATE SET '
+        '"currency_code" = EXCLUDED."currency_code", '
+        '"currency_name" = EXCLUDED."currency_name" '
+        'WHERE (t."currency_code", t."currency_name") IS DISTINCT FROM '
+        '(EXCLUDED."currency_code", EXCLUDED."currency_name")')
+    raw_conn.commit.assert_called_once()
+
+
+def test_upsert_to_dw_merges_fact_without_surrogate_key(aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME, load_mode='upsert')
+    loader.engine = mock_postgres_engine()
+    cursor = loader.engine.raw_connection.return_value.cursor.return_value
+    cursor.rowcount = 2
+    df = pd.DataFrame({'payment_record_id': [1], 'payment_id': [7],
+                       'paid': [True]})
+    assert loader.upsert_to_dw('fact_payment', df) == 4
+    statements = [args[0] for args, _ in cursor.execute.call_args_list]
+    assert 'payment_record_id' not in ''.join(statements[:3] +
+                                              statements[4:])
+    assert statements[2] == (
+        'UPDATE "fact_payment" AS t SET "paid" = s."paid" '
+        'FROM "stage_fact_payment" AS s WHERE t."payment_id" = '
+        's."payment_id" AND (t."paid") IS DISTINCT FROM (s."paid")')
+    assert statements[3] == (
+        'SELECT setval(pg_get_serial_sequence(\'"fact_payment"\', '
+        '\'payment_record_id\'), COALESCE(MAX("payment_record_id"), 0) + 1, '
+        'false) FROM "fact_payment"')
+    assert statements[4] == (
+        'INSERT INTO "fact_payment" ("payment_id", "paid") SELECT '
+        '"payment_id", "paid" FROM "stage_fact_payment" AS s WHERE NOT '
+        'EXISTS (SELECT 1 FROM "fact_payment" AS t '
+        'WHERE t."payment_id" = s."payment_id")')
+
+
+def test_upsert_to_dw_requires_postgres(aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME, load_mode='upsert')
+    loader.engine = create_engine('sqlite://')
+    with pytest.raises(Exception, match='requires PostgreSQL'):
+        loader.upsert_to_dw('dim_currency', pd.DataFrame({'currency_id': [1]}))
+
+
+def test_load_shadow_table_loads_rows_then_indexes(aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME, load_mode='swap')
+    loader.engine = mock_postgres_engine()
+    raw_conn = loader.engine.raw_connection.return_value
+    cursor = raw_conn.cursor.return_value
+    cursor.fetchall.side_effect = [
+        [('PRIMARY KEY (currency_id)',)],
+        [('CREATE INDEX ix_code ON public.dim_currency USING btree '
+          '(currency_code)',)],
+        [('PUBLIC', 'SELECT')]]
+    loader.load_shadow_table('dim_currency',
+                             pd.DataFrame({'currency_id': [1]}))
+    statements = [args[0] for args, _ in cursor.execute.call_args_list]
+    assert statements[:3] == [
+        'DROP TABLE IF EXISTS "dim_currency__shadow"',
+        'CREATE TABLE "dim_currency__shadow" (LIKE "dim_currency" '
+        'INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+        'COPY "dim_currency__shadow" ("currency_id") FROM STDIN '
+        "WITH (FORMAT CSV, NULL '\\N')"]
+    assert not any('LOGGED' in statement for statement in statements)
+    assert 'ALTER TABLE "dim_currency__shadow" ADD PRIMARY KEY ' \
+        '(currency_id)' in statements
+    assert 'CREATE INDEX ON "dim_currency__shadow" USING btree ' \
+        '(currency_code)' in statements
+    assert 'GRANT SELECT ON "dim_currency__shadow" TO PUBLIC' in statements
+    assert statements[-1] == 'ANALYZE "dim_currency__shadow"'
+    raw_conn.commit.assert_called_once()
+
+
+def test_swap_tables_renames_in_one_transaction(aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME, load_mode='swap')
+    loader.engine = mock_postgres_engine()
+    raw_conn = loader.engine.raw_connection.return_value
+    cursor = raw_conn.cursor.return_value
+    commits = []
+    raw_conn.commit.side_effect = lambda: commits.append(
+        len(cursor.execute.call_args_list))
+    cursor.fetchall.return_value = [
+        ('fact_payment', 'fk_currency',
+         'FOREIGN KEY (currency_id) REFERENCES dim_currency(currency_id)')]
+    cursor.fetchone.return_value = ['public.fact_payment_record_id_seq']
+    loader.swap_tables(['dim_currency', 'fact_payment'])
+    statements = [args[0] for args, _ in cursor.execute.call_args_list]
+    assert statements[1:commits[0]] == [
+        'ALTER TABLE "fact_payment" DROP CONSTRAINT "fk_currency"',
+        'DROP TABLE "dim_currency"',
+        'ALTER TABLE "dim_currency__shadow" RENAME TO "dim_currency"',
+        'SELECT pg_get_serial_sequence(%s, %s)',
+        'ALTER SEQUENCE public.fact_payment_record_id_seq OWNED BY '
+        '"fact_payment__shadow"."payment_record_id"',
+        'DROP TABLE "fact_payment"',
+        'ALTER TABLE "fact_payment__shadow" RENAME TO "fact_payment"',
+        'ALTER TABLE "fact_payment" ADD CONSTRAINT "fk_currency" FOREIGN KEY '
+        '(currency_id) REFERENCES dim_currency(currency_id) NOT VALID']
+    assert statements[commits[0]:] == [
+        'ALTER TABLE "fact_payment" VALIDATE CONSTRAINT "fk_currency"']
+
+
+def test_copy_to_dw_copies_nulls_and_whole_floats_into_postgres(dw_loader):
+    df = dw_loader.coerce_columns('address', dw_loader.read_s3_parquet(
+        'address')).sort_values('location_id').iloc[:2].copy()
+    df['address_line_2'] = ['', None]
+    dw_loader.chunk_size = 1
+    dw_loader.copy_to_dw('dim_location', df)
+    dw_loader.copy_to_dw('dim_transaction', pd.DataFrame({
+        'transaction_id': [1, 2], 'transaction_type': ['SALE', 'PURCHASE'],
+        'sales_order_id': [1.0, None], 'purchase_order_id': [None, 2.0]}))
+    assert fetch(dw_loader, 'SELECT address_line_2 FROM dim_location '
+                            'ORDER BY location_id') == [('',), (None,)]
+    assert fetch(dw_loader, 'SELECT transaction_id, sales_order_id, '
+                            'purchase_order_id FROM dim_transaction '
+                            'ORDER BY transaction_id') == [
+        (1, 1, None), (2, None, 2)]
+
+
+def test_upsert_to_dw_merges_dimension_rows_in_postgres(dw_loader):
+    df = dw_loader.coerce_columns('address',
+                                  dw_loader.read_s3_parquet('address'))
+    assert dw_loader.upsert_to_dw('dim_location', df) == len(df)
+    assert dw_loader.upsert_to_dw('dim_location', df) == 0
+    location_id = int(df['location_id'][0])
+    changed = df.iloc[:1].assign(city='Changed')
+    added = df.iloc[:1].assign(location_id=int(df['location_id'].max()) + 1)
+    assert dw_loader.upsert_to_dw('dim_location',
+                                  pd.concat([changed, added])) == 2
+    cities = dict(fetch(dw_loader, 'SELECT location_id, city '
+                                   'FROM dim_location'))
+    assert len(cities) == len(df) + 1
+    assert cities[location_id] == 'Changed'
+
+
+def test_upsert_to_dw_numbers_new_fact_rows_after_copied_ones(dw_loader):
+    for key, table_name in Loader.FILE_LIST.items():
+        dw_loader.load_table(key, table_name)
+    df = dw_loader.coerce_columns('sales_order',
+                                  dw_loader.read_s3_parquet('sales_order'))
+    changed = df.iloc[:1].assign(units_sold=1)
+    added = df.iloc[:1].assign(
+        sales_order_id=int(df['sales_order_id'].max()) + 1)
+    assert dw_loader.upsert_to_dw('fact_sales_order',
+                                  pd.concat([changed, added])) == 2
+    rows = fetch(dw_loader, 'SELECT sales_record_id, units_sold '
+                            'FROM fact_sales_order WHERE sales_order_id '
+                            'IN (:changed, :added) ORDER BY sales_order_id',
+                 {'changed': int(changed['sales_order_id'].iloc[0]),
+                  'added': int(added['sales_order_id'].iloc[0])})
+    assert rows == [(int(df['sales_record_id'][0]), 1),
+                    (int(df['sales_record_id'].max()) + 1,
+                     int(added['units_sold'].iloc[0]))]
+
+
+def test_swap_tables_replaces_tables_in_postgres(dw_loader):
+    table_names = list(Loader.FILE_LIST.values())
+    dw_loader.load_mode = 'swap'
+    for key, table_name in Loader.FILE_LIST.items():
+        dw_loader.load_table(key, table_name)
+    dw_loader.swap_tables(table_names)
+    for table_name, expected_row_count in zip(table_names,
+                                              EXPECTED_ROW_COUNTS):
+        assert fetch(dw_loader, f'SELECT COUNT(*) FROM {table_name}') == [
+            (expected_row_count,)]
+    assert fetch(dw_loader, "SELECT relname FROM pg_class WHERE "
+                            "right(relname, 8) = '__shadow' OR "
+                            "(relname = ANY(:tables) AND "
+                            "relpersistence <> 'p')",
+                 {'tables': table_names}) == []
+    assert fetch(dw_loader, "SELECT conname FROM pg_constraint WHERE "
+                            "contype = 'f' AND NOT convalidated AND "
+                            "conrelid::regclass::text = ANY(:tables)",
+                 {'tables': table_names}) == []
+    df = dw_loader.coerce_columns('payment',
+                                  dw_loader.read_s3_parquet('payment'))
+    added = df.iloc[:1].assign(payment_id=int(df['payment_id'].max()) + 1)
+    assert dw_loader.upsert_to_dw('fact_payment', added) == 1
+
+
+def test_load_tables_concurrently_loads_facts_after_their_dims(
+        aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME)
+    finished = []
+    started = {}
+    loader.load_table = MagicMock(
+        side_effect=lambda key, table_name: (
+            started.__setitem__(key, set(finished)), finished.append(key)))
+    load_tables_concurrently(loader, 4)
+    assert sorted(finished) == sorted(Loader.FILE_LIST)
+    for fact, dims in Loader.DEPENDENCIES.items():
+        assert set(dims) <= started[fact]
+
+
+def test_load_tables_concurrently_skips_dependents_of_failed_table(
+        aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME)
+    loaded = []
+
+    def load_table(key, table_name):
+        if key == 'transaction':
+            raise Exception('transaction failed')
+        loaded.append(key)
+
+    loader.load_table = MagicMock(side_effect=load_table)
+    with pytest.raises(Exception, match='transaction failed') as e:
+        load_tables_concurrently(loader, 4)
+    assert 'payment (a table it depends on failed)' in str(e.value)
+    assert 'payment' not in loaded
+    assert {'purchase_order', 'sales_order'} <= set(loaded)
+
+
+def test_coerce_columns_converts_strings_datetimes_and_native_types(
+        aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME)
+    df = pd.DataFrame({
+        'created_date': ['2022-11-03', '2022-11-04'],
+        'created_time': ['14:20:52.186000', '09:05:00'],
+        'last_updated_date': pd.to_datetime(['2022-11-05', '2022-11-06']),
+        'last_updated_time': [time(1, 2, 3), time(4, 5, 6)],
+        'payment_date': [date(2022, 11, 7), None]})
+    df = loader.coerce_columns('payment', df)
+    assert list(df.columns) == ['created_date', 'created_time',
+                                'last_updated_date', 'last_updated',
+                                'payment_date']
+    assert list(df['created_date']) == [date(2022, 11, 3), date(2022, 11, 4)]
+    assert list(df['created_time']) == [time(14, 20, 52, 186000),
+                                        time(9, 5)]
+    assert list(df['last_updated_date']) == [date(2022, 11, 5),
+                                             date(2022, 11, 6)]
+    assert list(df['last_updated']) == [time(1, 2, 3), time(4, 5, 6)]
+    assert df['payment_date'][0] == date(2022, 11, 7)
+
+
+def test_coerce_columns_converts_split_timestamps(aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME)
+    df = pd.DataFrame({
+        'created_date': pd.to_datetime(['2022-11-03']),
+        'created_time': pd.to_timedelta(['14:20:52.186'])})
+    df = loader.coerce_columns('sales_order', df)
+    assert df['created_date'][0] == date(2022, 11, 3)
+    assert df['created_time'][0] == time(14, 20, 52, 186000)
+
+
+def test_loader_loads_changed_tables_and_their_dependents(aws_credentials):
+    assert Loader(PROCESSED_BUCKET_NAME).tables == list(Loader.FILE_LIST)
+    assert Loader(PROCESSED_BUCKET_NAME,
+                  changed_tables=['payment']).tables == ['payment']
+    assert Loader(PROCESSED_BUCKET_NAME,
+                  changed_tables=['staff', 'transaction']).tables == [
+        'staff', 'transaction', 'purchase_order', 'payment', 'sales_order']
+
+
+@patch('src.load_lambda.load.load_tables')
+@patch('src.load_lambda.load.load_env_var',
+       return_value={'s3_bucket_name': PROCESSED_BUCKET_NAME})
+def test_loader_handler_reuses_cached_s3_client(mock_load_env_var,
+                                                mock_load_tables):
+    with patch('src.load_lambda.load.resource_cache') as cache:
+        loader_handler({}, None)
+    assert cache.get.call_args.args[0] == 's3_client'
+    loader = mock_load_tables.call_args.args[0]
+    assert loader.s3_client is cache.get.return_value
+
+
+@patch('src.load_lambda.load.load_tables')
+@patch('src.load_lambda.load.load_env_var',
+       return_value={'s3_bucket_name': PROCESSED_BUCKET_NAME})
+def test_loader_handler_records_manifest_once_tables_are_loaded(
+        mock_load_env_var, mock_load_tables):
+    manifest = {'staff': {'etags': {'staff': '"a"', 'department': '"b"'},
+                          'options': {}}}
+    with patch('src.load_lambda.load.resource_cache') as cache:
+        s3_client = cache.get.return_value
+        mock_load_tables.side_effect = Exception('load failed')
+        with pytest.raises(Exception, match='load failed'):
+            loader_handler({'manifest': manifest}, None)
+        s3_client.put_object.assert_not_called()
+        mock_load_tables.side_effect = None
+        loader_handler({'manifest': manifest}, None)
+    s3_client.put_object.assert_called_once_with(
+        Bucket=PROCESSED_BUCKET_NAME, Key=Loader.MANIFEST_KEY,
+        Body=json.dumps(manifest, indent=2).encode('utf-8'))
+
+
+def test_load_tables_only_replaces_tables_to_load(aws_credentials):
+    loader = Loader(PROCESSED_BUCKET_NAME, changed_tables=['design'])
+    loader.delete_table = MagicMock()
+    loader.load_table = MagicMock()
+    with patch('src.load_lambda.load.resource_cache') as cache:
+        load_tables(loader, {}, concurrency=2)
+    assert loader.engine is cache.get.return_value
+    assert [call.args[0] for call in loader.delete_table.call_args_list] \
+        == ['fact_sales_order', 'dim_design']
+    assert [call.args[0] for call in loader.load_table.call_args_list] \
+        == ['design', 'sales_order']
@@ -0,0 +1,76 @@
+import io
+import json
+from unittest.mock import MagicMock, patch
+import pytest
+from shared.invoker import LambdaInvoker, LocalInvoker
+from shared.resource_cache import resource_cache
+
+
+def test_lambda_invoker_waits_for_response_by_default():
+    client = MagicMock()
+    client.invoke.return_value = {
+        'Payload': io.BytesIO(b'{"result": "success"}')}
+    invoker = LambdaInvoker.from_lambda_info({'load_lambda_arn': 'ARN'},
+                                             lambda_client=client)
+    assert invoker.invoke('ARN', {'changed_tables': ['staff']}) == \
+        {'result': 'success'}
+    client.invoke.assert_called_once_with(
+        FunctionName='ARN', InvocationType='RequestResponse',
+        Payload='{"changed_tables": ["staff"]}')
+
+
+def test_lambda_invoker_raises_if_invoked_lambda_failed():
+    client = MagicMock()
+    client.invoke.return_value = {
+        'FunctionError': 'Unhandled',
+        'Payload': io.BytesIO(b'{"errorMessage": "load failed"}')}
+    invoker = LambdaInvoker(lambda_client=client)
+    with pytest.raises(Exception, match='ARN failed: .*load failed'):
+        invoker.invoke('ARN', {})
+
+
+def test_lambda_invoker_queues_event_invocations():
+    client = MagicMock()
+    invoker = LambdaInvoker.from_lambda_info(
+        {'load_lambda_arn': 'ARN', 'invocation_type': 'Event'},
+        lambda_client=client)
+    assert invoker.invoke('ARN', {}) is None
+    assert client.invoke.call_args.kwargs['InvocationType'] == 'Event'
+
+
+@patch('shared.invoker.boto3')
+def test_lambda_invokers_share_client_across_invocations(mock_boto3):
+    resource_cache.discard('lambda_client')
+    mock_boto3.client.return_value.invoke.return_value = {}
+    try:
+        for _ in range(2):
+            LambdaInvoker('Event').invoke('ARN', {})
+    finally:
+        resource_cache.discard('lambda_client')
+    mock_boto3.client.assert_called_once_with('lambda')
+    assert mock_boto3.client.return_value.invoke.call_count == 2
+
+
+def test_invokers_reject_invalid_invocation_type():
+    with pytest.raises(ValueError, match='invocation_type'):
+        LambdaInvoker('DryRun')
+    with pytest.raises(ValueError, match='invocation_type'):
+        LocalInvoker(invocation_type='DryRun')
+
+
+def test_local_invoker_calls_handlers_in_process():
+    events = []
+
+    def handler(event, context):
+        events.append(event)
+        return {'result': 'success'}
+
+    invoker = LocalInvoker({'ARN': handler})
+    payload = {'changed_tables': ['staff']}
+    assert invoker.invoke('ARN', payload) == {'result': 'success'}
+    assert events == [payload] and events[0] is not payload
+    assert invoker.invoke('OTHER', {}) is None
+    assert invoker.calls == [('ARN', payload), ('OTHER', {})]
+    async_invoker = LocalInvoker({'ARN': handler}, invocation_type='Event')
+    assert async_invoker.invoke('ARN', json.loads('{}')) is None
+    assert len(events) == 1
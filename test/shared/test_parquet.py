@@ -0,0 +1,68 @@
+import pandas as pd
+import pytest
+import fastparquet as fp
+from shared.parquet import (ParquetBuffer, ParquetFileWriter,
+                            get_parquet_kwargs, write_parquet)
+
+
+def test_parquet_buffer_stays_readable_after_close():
+    buffer = ParquetBuffer()
+    pd.DataFrame({'a': [1, 2]}).to_parquet(buffer, engine='fastparquet')
+    assert buffer.getvalue()[:4] == b'PAR1'
+
+
+def test_get_parquet_kwargs_for_pyarrow():
+    assert get_parquet_kwargs('zstd', 1000, False, engine='pyarrow') == {
+        'engine': 'pyarrow', 'compression': 'zstd', 'use_dictionary': False,
+        'row_group_size': 1000}
+    assert get_parquet_kwargs(engine='pyarrow') == {
+        'engine': 'pyarrow', 'compression': 'snappy', 'use_dictionary': True}
+
+
+def test_get_parquet_kwargs_for_fastparquet(tmp_path):
+    kwargs = get_parquet_kwargs('zstd', 2, engine='fastparquet')
+    assert kwargs == {'engine': 'fastparquet', 'compression': 'zstd',
+                      'row_group_offsets': 2}
+    pd.DataFrame({'a': range(5)}).to_parquet(tmp_path / 'a.parq', **kwargs)
+    assert len(fp.ParquetFile(tmp_path / 'a.parq').row_groups) == 3
+
+
+def test_get_parquet_kwargs_rejects_invalid_options():
+    with pytest.raises(ValueError, match='compression'):
+        get_parquet_kwargs('lz4')
+    with pytest.raises(ValueError, match='row_group_size'):
+        get_parquet_kwargs(row_group_size=-1)
+
+
+def test_parquet_file_writer_appends_row_groups(tmp_path):
+    writer = ParquetFileWriter(
+        tmp_path / 'a.parq', **get_parquet_kwargs(engine='fastparquet'))
+    writer.write(pd.DataFrame({'a': [1, 2]}))
+    writer.write(pd.DataFrame({'a': [3]}, index=[2]))
+    writer.close()
+    pf = fp.ParquetFile(tmp_path / 'a.parq')
+    assert len(pf.row_groups) == 2
+    assert list(pf.to_pandas()['a']) == [1, 2, 3]
+
+
+def test_pyarrow_writes_split_timestamps_as_dates_and_times(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    timestamps = pd.Series(pd.to_datetime(['2022-11-03 14:20:52.186',
+                                           '2022-11-04 09:01:02', None]))
+    df = pd.DataFrame({'created_date': timestamps.dt.normalize(),
+                       'created_time': timestamps - timestamps.dt.normalize()})
+    kwargs = get_parquet_kwargs(engine='pyarrow')
+    write_parquet(df, tmp_path / 'a.parq', date_columns=['created_date'],
+                  **kwargs)
+    writer = ParquetFileWriter(tmp_path / 'b.parq',
+                               date_columns=['created_date'], **kwargs)
+    writer.write(df.iloc[:2])
+    writer.write(df.iloc[2:])
+    writer.close()
+    for path in [tmp_path / 'a.parq', tmp_path / 'b.parq']:
+        table = pq.read_table(path)
+        assert str(table.schema.field('created_date').type) == 'date32[day]'
+        assert str(table.schema.field('created_time').type) == 'time64[us]'
+        assert [str(value) for value in
+                table.column('created_time').to_pylist()] == \
+            ['14:20:52.186000', '09:01:02', 'None']
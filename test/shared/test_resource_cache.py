@@ -0,0 +1,58 @@
+from unittest.mock import MagicMock, patch
+import pytest
+from shared.resource_cache import ResourceCache
+
+
+@pytest.fixture(scope='function')
+def cache():
+    return ResourceCache(max_idle_seconds=60)
+
+
+def test_get_creates_resource_once_and_reuses_it(cache):
+    create = MagicMock(side_effect=lambda: object())
+    first = cache.get('conn', create)
+    assert cache.get('conn', create) is first
+    create.assert_called_once()
+
+
+def test_get_recreates_resource_if_config_changed(cache):
+    close = MagicMock()
+    first = cache.get('conn', object, close=close, config={'host': 'A'})
+    second = cache.get('conn', object, close=close, config={'host': 'B'})
+    assert second is not first
+    close.assert_called_once_with(first)
+
+
+def test_get_only_validates_resources_idle_for_too_long(cache):
+    validate = MagicMock()
+    with patch('shared.resource_cache.time.monotonic', return_value=0):
+        first = cache.get('conn', object, validate=validate)
+    with patch('shared.resource_cache.time.monotonic', return_value=30):
+        assert cache.get('conn', object, validate=validate) is first
+    validate.assert_not_called()
+    with patch('shared.resource_cache.time.monotonic', return_value=100):
+        assert cache.get('conn', object, validate=validate) is first
+    validate.assert_called_once_with(first)
+
+
+def test_get_recreates_resource_that_fails_validation(cache):
+    close = MagicMock()
+    validate = MagicMock(side_effect=Exception('connection closed'))
+    with patch('shared.resource_cache.time.monotonic', return_value=0):
+        first = cache.get('conn', object, validate=validate, close=close)
+    with patch('shared.resource_cache.time.monotonic', return_value=100):
+        second = cache.get('conn', object, validate=validate, close=close)
+    assert second is not first
+    close.assert_called_once_with(first)
+
+
+def test_discard_and_clear_close_resources(cache):
+    close = MagicMock()
+    first = cache.get('conn', object, close=close)
+    cache.discard('conn')
+    close.assert_called_once_with(first)
+    assert cache.get('conn', object, close=close) is not first
+    cache.get('client', object)
+    cache.clear()
+    assert cache.entries == {}
+    cache.discard('no_such_resource')
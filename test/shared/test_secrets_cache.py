@@ -0,0 +1,76 @@
+from unittest.mock import patch
+import os
+import boto3
+import pytest
+from moto import mock_secretsmanager
+from shared.secrets_cache import SecretsCache, is_auth_error
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+
+
+@pytest.fixture(scope="function")
+def secretsmanager(aws_credentials):
+    with mock_secretsmanager():
+        client = boto3.client('secretsmanager')
+        client.create_secret(Name='test_secret', SecretString='FIRST')
+        yield client
+
+
+@pytest.fixture(scope="function")
+def cache(secretsmanager):
+    return SecretsCache(ttl_seconds=300, refresh_seconds=60)
+
+
+def test_get_fetches_secret_once_within_ttl(secretsmanager, cache):
+    with patch('shared.secrets_cache.time.monotonic', return_value=0):
+        assert cache.get('test_secret') == 'FIRST'
+    secretsmanager.put_secret_value(SecretId='test_secret',
+                                    SecretString='SECOND')
+    with patch('shared.secrets_cache.time.monotonic', return_value=100):
+        assert cache.get('test_secret') == 'FIRST'
+    with patch('shared.secrets_cache.time.monotonic', return_value=400):
+        assert cache.get('test_secret') == 'SECOND'
+
+
+def test_get_refreshes_secret_in_background_before_expiry(secretsmanager,
+                                                          cache):
+    with patch('shared.secrets_cache.time.monotonic', return_value=0):
+        cache.get('test_secret')
+    with patch('shared.secrets_cache.time.monotonic', return_value=250), \
+            patch.object(cache, 'refresh_in_background') as mock_refresh:
+        assert cache.get('test_secret') == 'FIRST'
+    mock_refresh.assert_called_once_with('test_secret')
+
+
+def test_refresh_in_background_updates_cached_secret(secretsmanager, cache):
+    cache.get('test_secret')
+    secretsmanager.put_secret_value(SecretId='test_secret',
+                                    SecretString='SECOND')
+    with patch('shared.secrets_cache.threading.Thread') as mock_thread:
+        cache.refresh_in_background('test_secret')
+        cache.refresh_in_background('test_secret')
+    mock_thread.assert_called_once()
+    mock_thread.call_args.kwargs['target']()
+    assert cache.entries['test_secret']['value'] == 'SECOND'
+    assert cache.refreshing == set()
+
+
+def test_get_forces_refresh(secretsmanager, cache):
+    cache.get('test_secret')
+    secretsmanager.put_secret_value(SecretId='test_secret',
+                                    SecretString='SECOND')
+    assert cache.get('test_secret', force_refresh=True) == 'SECOND'
+
+
+def test_is_auth_error_recognises_invalid_credentials():
+    assert is_auth_error(Exception({'S': 'FATAL', 'C': '28P01',
+                                    'M': 'password authentication failed'}))
+    assert not is_auth_error(Exception('connection refused'))
@@ -0,0 +1,124 @@
+import logging
+import os
+import pytest
+import boto3
+from moto import mock_s3
+from shared.uploader import Uploader, MiB
+
+S3_TEST_BUCKET_NAME = "test-bucket"
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+    env_vars = ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
+                'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN',
+                'AWS_DEFAULT_REGION']
+    old_env_vars = {var: os.environ.get(var, None) for var in env_vars}
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    yield
+    for var in env_vars:
+        if old_env_vars[var] is not None:
+            os.environ[var] = old_env_vars[var]
+        else:
+            del os.environ[var]
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        s3_client = boto3.client("s3")
+        s3_client.create_bucket(Bucket=S3_TEST_BUCKET_NAME)
+        yield s3_client
+
+
+@pytest.fixture(scope='function')
+def test_file(tmp_path):
+    file_name = tmp_path / '_test_upload.csv'
+    file_name.write_bytes(b'x' * (12 * MiB))
+    return str(file_name)
+
+
+def read_object(s3, key):
+    return s3.get_object(Bucket=S3_TEST_BUCKET_NAME, Key=key)['Body'].read()
+
+
+def test_upload_file_uses_multipart_config_and_reports_metrics(
+        s3, test_file, caplog):
+    uploader = Uploader(multipart_threshold=5 * MiB,
+                        multipart_chunksize=5 * MiB, max_concurrency=2,
+                        s3_client=s3)
+    with caplog.at_level(logging.INFO, logger='MyLogger'):
+        metrics = uploader.upload_file(test_file, S3_TEST_BUCKET_NAME, 'big')
+    assert metrics['bytes'] == 12 * MiB
+    assert metrics['parts'] == 3
+    assert metrics['seconds'] >= 0
+    assert 'Uploaded s3://test-bucket/big: 12582912 bytes' in caplog.text
+    assert s3.head_object(Bucket=S3_TEST_BUCKET_NAME,
+                          Key='big')['ETag'].endswith('-3"')
+
+
+def test_upload_buffer_sends_content_md5_and_checksum(s3):
+    uploader = Uploader(content_md5=True, checksum_algorithm='SHA256',
+                        s3_client=s3)
+    metrics = uploader.upload_buffer(b'a,b\n1,2\n', S3_TEST_BUCKET_NAME,
+                                     'small')
+    assert metrics['parts'] == 1
+    assert read_object(s3, 'small') == b'a,b\n1,2\n'
+
+
+def test_upload_chunks_streams_parts(s3):
+    uploader = Uploader(multipart_chunksize=5 * MiB, s3_client=s3)
+    chunk = b'x' * (2 * MiB)
+    metrics = uploader.upload_chunks(iter([chunk] * 7), S3_TEST_BUCKET_NAME,
+                                     'chunks')
+    assert metrics['parts'] == 3
+    assert metrics['bytes'] == 14 * MiB
+    assert read_object(s3, 'chunks') == chunk * 7
+    assert uploader.upload_chunks(iter([]), S3_TEST_BUCKET_NAME,
+                                  'empty') is None
+
+
+def test_upload_stream_holds_at_most_one_part(s3):
+    uploader = Uploader(multipart_chunksize=5 * MiB, s3_client=s3)
+    chunk = b'x' * MiB
+    held = []
+
+    def write(stream):
+        for _ in range(12):
+            stream.write(chunk)
+            held.append(len(stream.part))
+
+    metrics = uploader.upload_stream(write, S3_TEST_BUCKET_NAME, 'stream')
+    assert max(held) < 5 * MiB
+    assert metrics['parts'] == 3
+    assert read_object(s3, 'stream') == chunk * 12
+    assert uploader.upload_stream(lambda stream: stream.write(chunk) and
+                                  False, S3_TEST_BUCKET_NAME,
+                                  'discarded') is None
+    assert 'Contents' not in s3.list_objects_v2(
+        Bucket=S3_TEST_BUCKET_NAME, Prefix='discarded')
+
+
+def test_from_env_reads_optional_config(s3):
+    os.environ['_TEST_UPLOADER_INFO'] = '{"max_concurrency": 4}'
+    try:
+        uploader = Uploader.from_env('_TEST_UPLOADER_INFO', s3_client=s3)
+    finally:
+        del os.environ['_TEST_UPLOADER_INFO']
+    assert uploader.transfer_config.max_concurrency == 4
+    assert Uploader.from_env('_TEST_NO_SUCH_ENV', s3_client=s3)\
+        .transfer_config.max_concurrency == 10
+
+
+def test_rejects_invalid_config(s3):
+    with pytest.raises(ValueError, match='multipart_chunksize'):
+        Uploader(multipart_chunksize=MiB, s3_client=s3)
+    with pytest.raises(ValueError, match='max_concurrency'):
+        Uploader(max_concurrency=0, s3_client=s3)
+    with pytest.raises(ValueError, match='checksum_algorithm'):
+        Uploader(checksum_algorithm='MD5', s3_client=s3)
@@ -1,4 +1,6 @@
 from pathlib import Path
+from collections import Counter
+import gzip
 from moto import mock_s3
 import boto3
 import os
@@ -8,11 +10,14 @@ import pandas as pd
 import pytest
 from pandas.testing import assert_frame_equal, assert_series_equal
 import tempfile
+from io import BytesIO
 import fastparquet as fp
+from shared.invoker import LocalInvoker
 from unittest.mock import patch
 from unittest.mock import MagicMock
 from src.transform_lambda.transform import (
-    Transformer, transform_handler, load_env_var, call_loader_lambda)
+    Transformer, transform_handler, load_env_var, call_loader_lambda,
+    get_transform_options, TRANSFORM_OPTIONS)
 
 
 BUCKET_NAME = f'test-extraction-bucket-{int(datetime.now().timestamp())}'
@@ -145,6 +150,45 @@ def test_read_csv_returns_data_frame(s3, transformer):
     assert_frame_equal(result, expected_df)
 
 
+def test_read_csv_reads_parquet_and_gzip_csv_files(s3, transformer):
+    expected_df = pd.DataFrame(data={'a': [1], 'b': [2], 'c': [3], 'd': [4]})
+    with tempfile.NamedTemporaryFile() as parquet_file:
+        expected_df.to_parquet(parquet_file.name, index=False)
+        s3.put_object(Bucket=BUCKET_NAME, Key='parquet_test',
+                      Body=parquet_file.read())
+    s3.put_object(Bucket=BUCKET_NAME, Key='gzip_test',
+                  Body=gzip.compress(b'a,b,c,d\n1,2,3,4\n'))
+
+    assert_frame_equal(transformer.read_csv('parquet_test'), expected_df)
+    assert_frame_equal(transformer.read_csv('gzip_test'), expected_df)
+
+
+def test_read_csv_reads_schema_columns_with_their_dtypes(s3, transformer):
+    df_transaction = transformer.read_csv('transaction')
+    assert list(df_transaction.columns) == list(
+        Transformer.CSV_SCHEMAS['transaction'])
+    assert str(df_transaction['purchase_order_id'].dtype) == 'Int64'
+    assert df_transaction['sales_order_id'].isna().any()
+    df_payment = transformer.read_csv('payment')
+    assert pd.api.types.is_datetime64_dtype(df_payment['created_at'])
+    assert df_payment['paid'].dtype == bool
+    assert transformer.get_read_csv_kwargs('unknown') == {}
+
+
+@patch.dict(Transformer.CSV_SCHEMAS, {'cast_test': {
+    'cast_test_id': 'int64', 'amount': 'float64', 'day': 'object'}})
+def test_read_csv_casts_parquet_files_to_schema_dtypes(s3, transformer):
+    df = pd.DataFrame(data={'cast_test_id': [1], 'amount': ['2.43'],
+                            'day': ['2022-11-03'], 'other': [0]})
+    with tempfile.NamedTemporaryFile() as parquet_file:
+        df.to_parquet(parquet_file.name, index=False)
+        s3.put_object(Bucket=BUCKET_NAME, Key='cast_test',
+                      Body=parquet_file.read())
+    expected_df = pd.DataFrame(data={'cast_test_id': [1], 'amount': [2.43],
+                                     'day': ['2022-11-03']})
+    assert_frame_equal(transformer.read_csv('cast_test'), expected_df)
+
+
 def test_store_as_parquet_object_is_stored_bucket(
         s3, transformer, tmp_parquet):
     df = pd.DataFrame(data={'a': [1], 'b': [2], 'c': [3], 'd': [4]})
@@ -174,6 +218,24 @@ def test_store_as_parquet_check_integrity_of_object(
         assert_frame_equal(df, retrieved_df)
 
 
+def test_store_as_parquet_uploads_from_memory_with_options(
+        s3, tmp_parquet):
+    transformer = Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME,
+                              in_memory=True, compression='zstd',
+                              row_group_size=2)
+    df = pd.DataFrame(data={'a': [1, 2, 3], 'b': ['x', 'y', 'z']})
+    with patch.object(transformer.uploader, 'upload_file') as upload_file:
+        transformer.store_as_parquet(tmp_parquet, df)
+    upload_file.assert_not_called()
+    assert not Path(f'/tmp/{tmp_parquet}.parq').exists()
+    with tempfile.NamedTemporaryFile() as temp_file:
+        transformer.s3_client.download_file(
+            PROCESSED_BUCKET_NAME, tmp_parquet, temp_file.name)
+        pf = fp.ParquetFile(temp_file.name)
+        assert len(pf.row_groups) == 2
+        assert_frame_equal(pf.to_pandas(), df)
+
+
 def test_store_as_parquet_incorrect_object_passed_as_df(s3, transformer):
     df = 'not a dataframe'
 
@@ -249,6 +311,39 @@ def test_create_dim_date_creates_data_frame_structure(transformer):
     assert_series_equal(res_df.iloc[0, :], expected_first_row)
 
 
+def test_transform_date_covers_fact_dates(transformer):
+    df_sales_order = pd.DataFrame(data={
+        'created_at': pd.to_datetime(['2022-11-03 14:20:52.186']),
+        'last_updated': pd.to_datetime(['2022-11-04 09:00:00']),
+        'agreed_delivery_date': ['2023-06-02'],
+        'agreed_payment_date': ['2022-11-05']})
+    df_payment = pd.DataFrame(data={
+        'created_at': pd.to_datetime(['2022-11-01 10:00:00']),
+        'last_updated': pd.to_datetime(['2022-11-01 10:00:00']),
+        'payment_date': ['2022-11-02']})
+    df_purchase_order = df_sales_order.iloc[:0]
+    with patch.object(transformer, 'read_dim_date', return_value=None):
+        res_df = transformer.transform_date(
+            df_sales_order, df_payment, df_purchase_order)
+    assert res_df['date_id'].iloc[0] == '2022-11-01'
+    assert res_df['date_id'].iloc[-1] == '2023-06-02'
+    assert len(res_df) == 214
+    assert_frame_equal(res_df, transformer.create_dim_date(
+        '2022-11-01', '2023-06-02'))
+
+
+def test_transform_date_only_extends_stored_dim_date(transformer):
+    df_stored = transformer.create_dim_date('2022-11-01', '2022-11-30')
+    df_facts = [pd.DataFrame(data={'created_at': dates})
+                for dates in [['2022-11-05'], ['2022-11-30'], []]]
+    with patch.object(transformer, 'read_dim_date', return_value=df_stored):
+        assert transformer.transform_date(*df_facts) is None
+        df_facts[2] = pd.DataFrame(data={'created_at': ['2022-12-02']})
+        res_df = transformer.transform_date(*df_facts)
+    assert_frame_equal(res_df.iloc[:30], df_stored)
+    assert list(res_df['date_id'].iloc[30:]) == ['2022-12-01', '2022-12-02']
+
+
 def test_transform_sales_order_returns_correct_data_frame(transformer):
     expected_df_shape = (1544, 15)
     expected_df_cols = {'sales_record_id', 'created_date',
@@ -269,10 +364,10 @@ def test_transform_sales_order_returns_correct_data_frame(transformer):
 def test_transform_sales_order_returns_correct_data(transformer):
     expected_fact_sales = pd.DataFrame(
         data={'sales_record_id': [1], 'sales_order_id': [1],
-              'created_date': ['2022-11-03'],
-              'created_time': ['14:20:52.186000'],
-              'last_updated_date': ['2022-11-03'],
-              'last_updated_time': ['14:20:52.186000'],
+              'created_date': pd.to_datetime(['2022-11-03']),
+              'created_time': pd.to_timedelta(['14:20:52.186000']),
+              'last_updated_date': pd.to_datetime(['2022-11-03']),
+              'last_updated_time': pd.to_timedelta(['14:20:52.186000']),
               'sales_staff_id': [16], 'counterparty_id': [18],
               'units_sold': [84754],
               'unit_price': [2.43], 'currency_id': [3], 'design_id': [9],
@@ -353,10 +448,10 @@ def test_transform_payment_returns_correct_data(transformer):
     expected_dim_payment_shape = (2351, 13)
     expected_fact_payment = pd.DataFrame(
         data={'payment_record_id': [1], 'payment_id': [2],
-              'created_date': ['2022-11-03'],
-              'created_time': ['14:20:52.187000'],
-              'last_updated_date': ['2022-11-03'],
-              'last_updated_time': ['14:20:52.187000'],
+              'created_date': pd.to_datetime(['2022-11-03']),
+              'created_time': pd.to_timedelta(['14:20:52.187000']),
+              'last_updated_date': pd.to_datetime(['2022-11-03']),
+              'last_updated_time': pd.to_timedelta(['14:20:52.187000']),
               'transaction_id': [2], 'counterparty_id': [15],
               'payment_amount': [552548.62],
               'currency_id': [2], 'payment_type_id': [3],
@@ -373,10 +468,10 @@ def test_transform_purchase_order_returns_correct_data(transformer):
     expected_fact_purchase_shape = (807, 15)
     expected_fact_purchase = pd.DataFrame(
         data={'purchase_record_id': [1], 'purchase_order_id': [1],
-              'created_date': ['2022-11-03'],
-              'created_time': ['14:20:52.187000'],
-              'last_updated_date': ['2022-11-03'],
-              'last_updated_time': ['14:20:52.187000'],
+              'created_date': pd.to_datetime(['2022-11-03']),
+              'created_time': pd.to_timedelta(['14:20:52.187000']),
+              'last_updated_date': pd.to_datetime(['2022-11-03']),
+              'last_updated_time': pd.to_timedelta(['14:20:52.187000']),
               'staff_id': [12], 'counterparty_id': [11],
               'item_code': ['ZDOI5EA'], 'item_quantity': [371],
               'item_unit_price': [361.39], 'currency_id': [2],
@@ -390,6 +485,266 @@ def test_transform_purchase_order_returns_correct_data(transformer):
     assert_frame_equal(res_df.iloc[:1], expected_fact_purchase)
 
 
+def test_get_transform_options_defaults_and_validates_types():
+    assert get_transform_options({}) == TRANSFORM_OPTIONS
+    assert get_transform_options({'concurrency': 4})['concurrency'] == 4
+    with pytest.raises(Exception, match='payload requires'):
+        get_transform_options({'concurrency': '4'})
+    with pytest.raises(Exception, match='must be positive'):
+        get_transform_options({'concurrency': 0})
+    with pytest.raises(Exception, match='must be one of'):
+        get_transform_options({'compression': 'lz4'})
+    with pytest.raises(Exception, match='cannot be negative'):
+        get_transform_options({'row_group_size': -1})
+    with pytest.raises(Exception, match='cannot be negative'):
+        get_transform_options({'chunk_size': -1})
+
+
+def test_transform_tables_stores_every_transform_concurrently(s3,
+                                                              transformer):
+    with patch.object(transformer, 'read_csv',
+                      wraps=transformer.read_csv) as read_csv:
+        transformer.transform_tables(4)
+    assert sorted(call.args[0] for call in read_csv.call_args_list) == \
+        sorted(Transformer.FILE_LIST)
+    keys = [item['Key'] for item in s3.list_objects_v2(
+        Bucket=PROCESSED_BUCKET_NAME)['Contents']]
+    assert set(Transformer.TRANSFORMS) <= set(keys)
+    staff = pd.read_parquet(BytesIO(s3.get_object(
+        Bucket=PROCESSED_BUCKET_NAME, Key='staff')['Body'].read()))
+    assert 'department_name' in staff.columns
+
+
+def test_transform_tables_holds_reads_only_until_transformed(s3):
+    transformer = Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME)
+    transformer.list_csv_files()
+    read_csv, transform_table = \
+        transformer.read_csv, transformer.transform_table
+    events = []
+
+    def read(key, columns=None):
+        events.append(('read', key))
+        return read_csv(key, columns)
+
+    def transform(file_name, reads):
+        try:
+            return transform_table(file_name, reads)
+        finally:
+            events.append(('done', file_name))
+    with patch.object(transformer, 'read_csv', side_effect=read), \
+            patch.object(transformer, 'transform_table',
+                         side_effect=transform):
+        transformer.transform_tables(1)
+    assert sorted(key for event, key in events if event == 'read') == \
+        sorted(Transformer.FILE_LIST)
+    dependents = Counter(key for _, inputs in Transformer.TRANSFORMS.values()
+                         for key in inputs)
+    held, peak = set(), 0
+    for event, name in events:
+        if event == 'read':
+            held.add(name)
+            peak = max(peak, len(held))
+            continue
+        for key in Transformer.TRANSFORMS[name][1]:
+            dependents[key] -= 1
+            if not dependents[key]:
+                held.remove(key)
+    # date needs three files at once, the other transforms at most two
+    assert held == set()
+    assert peak == 3
+
+
+def test_transform_table_in_chunks_numbers_records_across_chunks(s3):
+    transformer = Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME,
+                              chunk_size=500)
+    transformer.transform_table_in_chunks('sales_order')
+    with tempfile.NamedTemporaryFile() as temp_file:
+        s3.download_file(PROCESSED_BUCKET_NAME, 'sales_order',
+                         temp_file.name)
+        pf = fp.ParquetFile(temp_file.name)
+        assert len(pf.row_groups) == 4
+        res_df = pf.to_pandas()
+    expected_df = transformer.transform_sales_order(pd.read_csv(
+        f'{TEST_DATA_PATH}/sales_order.csv', encoding='utf-8'))
+    assert list(res_df['sales_record_id']) == list(range(1, 1545))
+    assert_frame_equal(res_df, expected_df)
+
+
+def test_transform_table_in_chunks_stores_empty_table_without_chunks(s3):
+    transformer = Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME,
+                              chunk_size=500)
+    Path('/tmp/payment.parq').write_bytes(b'left by an earlier invocation')
+    with patch.object(transformer, 'read_csv_chunks', return_value=iter([])):
+        assert transformer.transform_table_in_chunks('payment')
+    res_df = pd.read_parquet(BytesIO(s3.get_object(
+        Bucket=PROCESSED_BUCKET_NAME, Key='payment')['Body'].read()))
+    assert len(res_df) == 0
+    assert list(res_df.columns) == list(transformer.transform_payment(
+        transformer.get_empty_frame('payment')).columns)
+
+
+def test_read_csv_chunks_splits_gzip_csv_files(s3):
+    transformer = Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME,
+                              chunk_size=2)
+    df = pd.DataFrame(data={'a': [1, 2, 3], 'b': ['x', 'y', 'z']})
+    s3.put_object(Bucket=BUCKET_NAME, Key='gzip_chunks_test',
+                  Body=gzip.compress(df.to_csv(index=False).encode()))
+    chunks = list(transformer.read_csv_chunks('gzip_chunks_test'))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert_frame_equal(pd.concat(chunks), df)
+
+
+def test_read_csv_chunks_merges_deltas_as_read_csv_does(s3):
+    transformer = Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME,
+                              chunk_size=2)
+    df = pd.DataFrame(data={'deltas_test_id': [1, 2, 3],
+                            'b': ['x', 'y', 'z']})
+    s3.put_object(Bucket=BUCKET_NAME, Key='deltas_test',
+                  Body=df.to_csv(index=False).encode())
+    for watermark, df_delta in [
+            ('20230301000000000000', pd.DataFrame(
+                data={'deltas_test_id': [2, 4], 'b': ['Y', 'w']})),
+            ('20230302000000000000', pd.DataFrame(
+                data={'deltas_test_id': [4], 'b': ['W']}))]:
+        s3.put_object(Bucket=BUCKET_NAME,
+                      Key=f'delta/deltas_test/{watermark}',
+                      Body=df_delta.to_csv(index=False).encode())
+    transformer.list_csv_files()
+    chunks = list(transformer.read_csv_chunks('deltas_test'))
+    assert [len(chunk) for chunk in chunks] == [2, 1, 1]
+    expected_df = pd.DataFrame(data={'deltas_test_id': [1, 2, 3, 4],
+                                     'b': ['x', 'Y', 'z', 'W']})
+    assert_frame_equal(pd.concat(chunks, ignore_index=True), expected_df)
+    assert_frame_equal(transformer.read_csv('deltas_test'), expected_df)
+    transformer.chunk_size = 1
+    assert_frame_equal(pd.concat(transformer.read_csv_chunks('deltas_test'),
+                                 ignore_index=True), expected_df)
+
+
+@pytest.mark.parametrize('chunk_size', [0, 2])
+def test_compact_deltas_merges_deltas_into_extracted_file(s3, chunk_size):
+    transformer = Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME,
+                              chunk_size=chunk_size)
+    key = f'compact_test_{chunk_size}'
+    df = pd.DataFrame(data={f'{key}_id': [1, 2, 3], 'b': ['x', 'y', 'z']})
+    s3.put_object(Bucket=BUCKET_NAME, Key=key,
+                  Body=df.to_csv(index=False).encode())
+    df_delta = pd.DataFrame(data={f'{key}_id': [2, 4], 'b': ['Y', 'W']})
+    s3.put_object(Bucket=BUCKET_NAME, Key=f'delta/{key}/20230301000000000000',
+                  Body=df_delta.to_csv(index=False).encode())
+    transformer.list_csv_files()
+    expected_df = transformer.read_csv(key)
+    transformer.manifest = {
+        'merged': transformer.get_manifest_entry([key]),
+        'other': {'etags': {key: 'old'}, 'options': {}}}
+    transformer.compact_deltas(key)
+    keys = [item['Key'] for item in s3.list_objects_v2(
+        Bucket=BUCKET_NAME, Prefix=f'delta/{key}/').get('Contents', [])]
+    assert keys == []
+    assert transformer.get_delta_keys(key) == []
+    assert_frame_equal(transformer.read_csv(key), expected_df)
+    etag = s3.head_object(Bucket=BUCKET_NAME, Key=key)['ETag']
+    assert transformer.manifest['merged'] == \
+        transformer.get_manifest_entry([key])
+    assert transformer.manifest['merged']['etags'] == {key: etag}
+    assert transformer.manifest['other']['etags'] == {key: 'old'}
+
+
+def test_optimise_dtypes_uses_categoricals_and_downcasts(s3, tmp_parquet):
+    transformer = Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME,
+                              optimise_dtypes=True)
+    df = pd.DataFrame(data={
+        'staff_id': range(1, 101),
+        'department_id': pd.array([1, 2, None, 4] * 25, dtype='Int64'),
+        'location': ['Leeds', 'Manchester'] * 50,
+        'email_address': [f'{i}@terrifictotes.com' for i in range(100)],
+        'amount': [1.5] * 100})
+    res_df = transformer.optimise_dtypes(tmp_parquet, df)
+    assert res_df['staff_id'].dtype == 'int8'
+    assert str(res_df['department_id'].dtype) == 'Int8'
+    assert res_df['location'].dtype == 'category'
+    assert res_df['email_address'].dtype == object
+    assert res_df['amount'].dtype == 'float64'
+    assert transformer.bytes_saved[tmp_parquet] == \
+        df.memory_usage(index=False, deep=True).sum() - \
+        res_df.memory_usage(index=False, deep=True).sum() > 0
+    assert_frame_equal(res_df.astype(df.dtypes), df)
+    transformer.store_as_parquet(tmp_parquet, res_df)
+    with tempfile.NamedTemporaryFile() as temp_file:
+        s3.download_file(PROCESSED_BUCKET_NAME, tmp_parquet, temp_file.name)
+        assert list(fp.ParquetFile(temp_file.name).to_pandas()['location']) \
+            == list(df['location'])
+
+
+def test_transform_tables_skips_transforms_of_unchanged_files(s3):
+    s3.delete_object(Bucket=PROCESSED_BUCKET_NAME,
+                     Key=Transformer.MANIFEST_KEY)
+    transformer = Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME,
+                              skip_unchanged=True)
+    transformer.list_csv_files()
+    with patch.object(Transformer, 'read_dim_date', return_value=None):
+        assert transformer.transform_tables() == \
+            list(Transformer.TRANSFORMS)
+        assert transformer.read_manifest() == {}
+        transformer.write_manifest()
+        transformer.list_csv_files()
+        with patch.object(transformer, 'read_csv') as read_csv:
+            assert transformer.transform_tables() == []
+        read_csv.assert_not_called()
+        with open(f'{TEST_DATA_PATH}/department.csv', 'rb') as f:
+            s3.put_object(Bucket=BUCKET_NAME, Key='department',
+                          Body=f.read() + b'\n')
+        transformer.list_csv_files()
+        assert transformer.transform_tables() == ['staff']
+        transformer.write_manifest()
+        gzip_transformer = Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME,
+                                       compression='gzip',
+                                       skip_unchanged=True)
+        gzip_transformer.list_csv_files()
+        assert gzip_transformer.transform_tables() == \
+            list(Transformer.TRANSFORMS)
+    manifest = transformer.read_manifest()
+    assert manifest['staff'] == {
+        'etags': {'staff': transformer.etags['staff'],
+                  'department': transformer.etags['department']},
+        'options': transformer.output_options}
+
+
+@patch('src.transform_lambda.transform.call_loader_lambda')
+def test_transform_handler_hands_manifest_to_loader(mock_loader_lambda, s3,
+                                                    info):
+    s3.delete_object(Bucket=PROCESSED_BUCKET_NAME,
+                     Key=Transformer.MANIFEST_KEY)
+    with patch.object(Transformer, 'read_dim_date', return_value=None):
+        transform_handler({}, None)
+        manifest = mock_loader_lambda.call_args.kwargs['manifest']
+        assert set(manifest) == set(Transformer.TRANSFORMS)
+        # recorded by the loader once it has loaded the tables
+        assert Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME)\
+            .read_manifest() == {}
+        s3.put_object(Bucket=PROCESSED_BUCKET_NAME,
+                      Key=Transformer.MANIFEST_KEY,
+                      Body=json.dumps(manifest).encode('utf-8'))
+        mock_loader_lambda.reset_mock()
+        transform_handler({}, None)
+    mock_loader_lambda.assert_not_called()
+    assert Transformer(BUCKET_NAME, PROCESSED_BUCKET_NAME)\
+        .read_manifest() == manifest
+
+
+def test_transform_tables_reports_failed_transforms(s3, transformer):
+    with patch.object(transformer, 'transform_staff',
+                      side_effect=Exception('staff failed')), \
+            patch.object(transformer, 'read_dim_date', return_value=None), \
+            patch.object(transformer, 'store_as_parquet') as store:
+        with pytest.raises(Exception,
+                           match=r'Could not transform tables: staff'):
+            transformer.transform_tables(4)
+    stored = [call.args[0] for call in store.call_args_list]
+    assert 'staff' not in stored
+    assert len(stored) == len(Transformer.TRANSFORMS) - 1
+
+
 def test_transform_raises_error_if_env_var_not_set(info, unset_set_env):
     with pytest.raises(Exception, match=unset_set_env):
         transform_handler({}, None)
@@ -419,3 +774,21 @@ def test_extraction_calls_transformation_lambda_if_db_changed():
         call_loader_lambda('fakearn', event, context)
 
         assert mock_client.return_value.invoke.call_count == 1
+        call_loader_lambda('fakearn', event, context, ['staff'])
+        assert json.loads(mock_client.return_value.invoke.call_args.kwargs[
+            'Payload']) == {'changed_tables': ['staff']}
+
+
+def test_call_loader_lambda_hands_changed_tables_to_invoker():
+    events = []
+    invoker = LocalInvoker({'ARN': lambda event, context: events.append(
+        event)}, invocation_type='RequestResponse')
+    call_loader_lambda('ARN', {}, None, ['staff', 'date'], invoker)
+    assert events == [{'changed_tables': ['staff', 'date']}]
+    async_invoker = LocalInvoker(invocation_type='Event')
+    call_loader_lambda('ARN', {}, None, ['staff'], async_invoker)
+    assert async_invoker.calls == [('ARN', {'changed_tables': ['staff']})]
+    manifest = {'staff': {'etags': {'staff': '"a"'}, 'options': {}}}
+    call_loader_lambda('ARN', {}, None, ['staff'], invoker,
+                       manifest=manifest)
+    assert events[-1] == {'changed_tables': ['staff'], 'manifest': manifest}